@@ -3,136 +3,28 @@ Library Management System (Python + MySQL)
 -----------------------------------------
 How to use:
 1) pip install mysql-connector-python
-2) Update DB_CONFIG with your MySQL credentials
-3) Run: python lms.py
+2) Update DB_CONFIG in lms_db.py with your MySQL credentials
+   (or set LMS_BACKEND=sqlite to run on an embedded SQLite file instead)
+3) Run: python LMS01.py
+
+Set LMS_METRICS_FILE=path to write query timings (lms_metrics) there on exit.
 
 """
 
-import sys
-import datetime
+import os
 import csv
 
-try:
-    import mysql.connector as mysql
-except ImportError:
-    print("mysql-connector-python is not installed. Run: pip install mysql-connector-python")
-    sys.exit(1)
-
-# -------------------- CONFIG --------------------
-DB_CONFIG = {
-    "host": "localhost",
-    "user": "root",          # <-- change if needed
-    "password": "yourpassword",  # <-- change to your MySQL password
-    "database": "librarydb",
-}
- 
-ALLOWED_TABLES = {"books", "staff", "members", "issues", "bills", "bill_items"}
+from lms_db import get_pool
+from lms_migrations import migrate
+from lms_import import DEFAULT_BATCH_SIZE, print_progress
+from lms_metrics import METRICS
+from lms_money import money
+from lms_service import DEFAULT_ISSUE_DAYS, LibraryService, ServiceError
 
 # -------------------- DB --------------------
 
-def get_connection(use_db=True):
-    cfg = DB_CONFIG.copy()
-    if not use_db:
-        cfg.pop("database", None)
-    return mysql.connect(**cfg)
-
-
 def init_database_and_tables():
-    con = get_connection(use_db=False)
-    cur = con.cursor()
-    cur.execute("CREATE DATABASE IF NOT EXISTS librarydb")
-    con.commit()
-    cur.close()
-    con.close()
-
-    con = get_connection(use_db=True)
-    cur = con.cursor()
-
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS books (
-            book_id VARCHAR(20) PRIMARY KEY,
-            title   VARCHAR(200) NOT NULL,
-            author  VARCHAR(100) NOT NULL,
-            category VARCHAR(100),
-            price   DECIMAL(10,2) NOT NULL,
-            stock   INT NOT NULL DEFAULT 0
-        ) ENGINE=InnoDB;
-        """
-    )
-
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS staff (
-            staff_id INT AUTO_INCREMENT PRIMARY KEY,
-            name     VARCHAR(100) NOT NULL,
-            role     VARCHAR(100),
-            phone    VARCHAR(20)
-        ) ENGINE=InnoDB;
-        """
-    )
-
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS members (
-            member_id INT AUTO_INCREMENT PRIMARY KEY,
-            name      VARCHAR(100) NOT NULL,
-            phone     VARCHAR(20),
-            email     VARCHAR(100),
-            membership_type VARCHAR(20) NOT NULL DEFAULT 'Regular' -- Regular or VIP
-        ) ENGINE=InnoDB;
-        """
-    )
-
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS issues (
-            issue_id INT AUTO_INCREMENT PRIMARY KEY,
-            member_id INT NOT NULL,
-            book_id   VARCHAR(20) NOT NULL,
-            issue_date DATE NOT NULL,
-            due_date   DATE NOT NULL,
-            return_date DATE,
-            late_fee DECIMAL(8,2) DEFAULT 0.0,
-            CONSTRAINT fk_issue_member FOREIGN KEY (member_id) REFERENCES members(member_id),
-            CONSTRAINT fk_issue_book   FOREIGN KEY (book_id) REFERENCES books(book_id)
-        ) ENGINE=InnoDB;
-        """
-    )
-
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS bills (
-            bill_id        INT AUTO_INCREMENT PRIMARY KEY,
-            member_id      INT,
-            bill_date      DATETIME NOT NULL,
-            subtotal       DECIMAL(10,2) NOT NULL,
-            discount_pct   DECIMAL(5,2)  NOT NULL DEFAULT 0.0,
-            discount_amt   DECIMAL(10,2) NOT NULL,
-            grand_total    DECIMAL(10,2) NOT NULL,
-            CONSTRAINT fk_bill_member FOREIGN KEY (member_id) REFERENCES members(member_id)
-        ) ENGINE=InnoDB;
-        """
-    )
-
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS bill_items (
-            item_id   INT AUTO_INCREMENT PRIMARY KEY,
-            bill_id   INT NOT NULL,
-            book_id   VARCHAR(20) NOT NULL,
-            qty       INT NOT NULL,
-            unit_price DECIMAL(10,2) NOT NULL,
-            line_total DECIMAL(10,2) NOT NULL,
-            CONSTRAINT fk_bill_fk FOREIGN KEY (bill_id) REFERENCES bills(bill_id) ON DELETE CASCADE,
-            CONSTRAINT fk_bill_book FOREIGN KEY (book_id) REFERENCES books(book_id)
-        ) ENGINE=InnoDB;
-        """
-    )
-
-    con.commit()
-    cur.close()
-    con.close()
+    migrate(get_pool())
 
 # -------------------- INPUT --------------------
 
@@ -151,10 +43,11 @@ def input_int(prompt: str, min_val=None, max_val=None):
             print("Please enter a valid integer.")
 
 
-def input_float(prompt: str, min_val=None, max_val=None):
+def input_money(prompt: str, min_val=None, max_val=None):
+    """An amount as a two-place Decimal (lms_money.money), re-asked until it's a number in range."""
     while True:
         try:
-            val = float(input(prompt))
+            val = money(input(prompt).strip())
             if min_val is not None and val < min_val:
                 print(f"Value must be >= {min_val}")
                 continue
@@ -162,56 +55,58 @@ def input_float(prompt: str, min_val=None, max_val=None):
                 print(f"Value must be <= {max_val}")
                 continue
             return val
-        except ValueError:
+        except (ValueError, ArithmeticError):
             print("Please enter a valid number.")
 
 
-def parse_year_month(ym_str: str):
-    """Parse 'YYYY-MM' -> (first_date, last_date). Raises ValueError if invalid."""
-    parts = ym_str.split("-")
-    if len(parts) != 2:
-        raise ValueError("Bad format")
-    year, month = parts
-    year = int(year)
-    month = int(month)
-    first = datetime.date(year, month, 1)
-    if month == 12:
-        last = datetime.date(year + 1, 1, 1) - datetime.timedelta(days=1)
-    else:
-        last = datetime.date(year, month + 1, 1) - datetime.timedelta(days=1)
-    return first, last
+def page_through(fetch, show, empty="(none)"):
+    """Show a listing a page at a time. fetch(token) returns a Page; show(rows) prints it."""
+    token = None
+    while True:
+        page = fetch(token)
+        if not page.rows:
+            print(empty)
+            return
+        show(page.rows)
+        options = []
+        if page.next_token:
+            options.append("n = next")
+        if page.prev_token:
+            options.append("p = previous")
+        if not options:
+            return
+        nav = input(", ".join(options) + ", ENTER = done: ").strip().lower()
+        if nav == 'n' and page.next_token:
+            token = page.next_token
+        elif nav == 'p' and page.prev_token:
+            token = page.prev_token
+        else:
+            return
 
 # -------------------- BOOKS --------------------
 
-def add_book(cur, con):
+def add_book(svc):
     print("-- Add Book --")
     book_id = input("Book ID: ").strip()
     title   = input("Title: ").strip()
     author  = input("Author: ").strip()
     category= input("Category (optional): ").strip()
-    price   = input_float("Price: ", min_val=0)
+    price   = input_money("Price: ", min_val=0)
     stock   = input_int("Opening Stock: ", min_val=0)
 
     try:
-        cur.execute(
-            "INSERT INTO books (book_id, title, author, category, price, stock) VALUES (%s, %s, %s, %s, %s, %s)",
-            (book_id, title, author, category, price, stock)
-        )
-        con.commit()
+        svc.add_book(book_id, title, author, category, price, stock)
         print("Book added.")
+    except ServiceError as e:
+        print(e)
     except Exception as e:
-        msg = str(e)
-        if "Duplicate" in msg or "1062" in msg:
-            print("Book ID already exists.")
-        else:
-            print("Error adding book:", msg)
+        print("Error adding book:", e)
 
 
-def update_book(cur, con):
+def update_book(svc):
     print("-- Update Book --")
     book_id = input("Enter Book ID to update: ").strip()
-    cur.execute("SELECT book_id, title, author, category, price, stock FROM books WHERE book_id=%s", (book_id,))
-    row = cur.fetchone()
+    row = svc.get_book(book_id)
     if not row:
         print("Book not found.")
         return
@@ -222,10 +117,10 @@ def update_book(cur, con):
     new_cat    = input(f"Category [{row[3] or ''}]: ").strip() or row[3]
     try:
         price_in = input(f"Price [{row[4]}]: ").strip()
-        new_price = float(price_in) if price_in else float(row[4])
-    except ValueError:
+        new_price = money(price_in) if price_in else row[4]
+    except (ValueError, ArithmeticError):
         print("Invalid price. Keeping old.")
-        new_price = float(row[4])
+        new_price = row[4]
     try:
         stock_in = input(f"Stock [{row[5]}]: ").strip()
         new_stock = int(stock_in) if stock_in else int(row[5])
@@ -233,331 +128,382 @@ def update_book(cur, con):
         print("Invalid stock. Keeping old.")
         new_stock = int(row[5])
 
-    cur.execute(
-        "UPDATE books SET title=%s, author=%s, category=%s, price=%s, stock=%s WHERE book_id=%s",
-        (new_title, new_author, new_cat, new_price, new_stock, book_id)
-    )
-    con.commit()
-    print("Book updated.")
+    try:
+        svc.update_book(book_id, new_title, new_author, new_cat, new_price, new_stock)
+        print("Book updated.")
+    except ServiceError as e:
+        print(e)
 
 
-def delete_book(cur, con):
+def delete_book(svc):
     print("-- Delete Book --")
     book_id = input("Enter Book ID to delete: ").strip()
-    cur.execute("DELETE FROM books WHERE book_id=%s", (book_id,))
-    con.commit()
-    if cur.rowcount:
+    try:
+        svc.delete_book(book_id)
         print("Book deleted.")
-    else:
-        print("Book not found.")
-
+    except ServiceError as e:
+        print(e)
 
-def view_books(cur):
-    print("-- All Books --")
-    cur.execute("SELECT book_id, title, author, category, price, stock FROM books ORDER BY title")
-    rows = cur.fetchall()
-    if not rows:
-        print("(no books)")
-        return
 
+def print_books(rows):
     print(f"{'ID':<10} {'Title':<30} {'Author':<20} {'Cat':<12} {'Price':>8} {'Stock':>6}")
     print("-" * 90)
     for r in rows:
         print(f"{r[0]:<10} {r[1]:<30.30} {r[2]:<20.20} { (r[3] or '')[:12]:<12} {r[4]:8} {r[5]:6}")
 
 
-def search_books(cur):
+def view_books(svc):
+    print("-- All Books --")
+    page_through(svc.list_books, print_books, "(no books)")
+
+
+def search_books(svc):
     print("-- Search Books --")
-    print("Search by: 1) Book ID  2) Title  3) Author  4) Category")
+    print("Search by: 1) Book ID  2) Title  3) Author  4) Category  5) Any field")
     ch = input("Choice: ").strip()
     if ch == '1':
-        key = input("Enter Book ID: ").strip()
-        cur.execute("SELECT book_id, title, author, category, price, stock FROM books WHERE book_id=%s", (key,))
-    elif ch == '2':
-        key = '%' + input("Enter keyword for title: ").strip() + '%'
-        cur.execute("SELECT book_id, title, author, category, price, stock FROM books WHERE title LIKE %s", (key,))
-    elif ch == '3':
-        key = '%' + input("Enter author name: ").strip() + '%'
-        cur.execute("SELECT book_id, title, author, category, price, stock FROM books WHERE author LIKE %s", (key,))
-    elif ch == '4':
-        key = '%' + input("Enter category: ").strip() + '%'
-        cur.execute("SELECT book_id, title, author, category, price, stock FROM books WHERE category LIKE %s", (key,))
-    else:
+        row = svc.get_book(input("Enter Book ID: ").strip())
+        rows = [row] if row else []
+        if not rows:
+            print("(no results)")
+        for r in rows:
+            print(f"{r[0]} | {r[1]} | {r[2]} | {r[3] or ''} | Rs.{r[4]} | Stock: {r[5]}")
+        return
+    fields = {'2': 'title', '3': 'author', '4': 'category', '5': None}
+    if ch not in fields:
         print("Invalid choice.")
         return
+    query = input("Enter keywords: ").strip()
+    page = 1
+    while True:
+        result = svc.search_books(query, fields[ch], page)
+        if not result.rows:
+            print("(no results)")
+            return
+        print(f"Page {result.page}/{result.pages} ({result.total} matches)")
+        if result.truncated:
+            print("(the last word matched too many words; only the most common were searched)")
+        for r in result.rows:
+            print(f"{r[0]} | {r[1]} | {r[2]} | {r[3] or ''} | Rs.{r[4]} | Stock: {r[5]}")
+        if result.pages == 1:
+            return
+        nav = input("n = next, p = previous, ENTER = done: ").strip().lower()
+        if nav == 'n' and page < result.pages:
+            page += 1
+        elif nav == 'p' and page > 1:
+            page -= 1
+        elif nav not in ('n', 'p'):
+            return
 
-    rows = cur.fetchall()
-    if not rows:
-        print("(no results)")
+
+def bulk_import_books(svc):
+    print("-- Bulk Import Books --")
+    path = input("File (CSV / JSON / JSONL): ").strip()
+    batch_raw = input(f"Batch size [{DEFAULT_BATCH_SIZE}]: ").strip()
+    try:
+        batch_size = int(batch_raw) if batch_raw else DEFAULT_BATCH_SIZE
+    except ValueError:
+        print("Please enter a valid batch size.")
         return
-    for r in rows:
-        print(f"{r[0]} | {r[1]} | {r[2]} | {r[3] or ''} | Rs.{r[4]} | Stock: {r[5]}")
+    try:
+        stats = svc.import_books(path, batch_size=batch_size, progress=print_progress)
+    except Exception as e:
+        print("Import failed:", e)
+        return
+    print(f"Imported {stats.loaded} books, {stats.rejected} rejected in {stats.seconds:.2f}s ({stats.rows_per_sec:,.0f} rows/sec)")
+    if stats.rejected:
+        print(f"Rejected rows written to {path}.rejects.csv")
 
 # -------------------- STAFF --------------------
 
-def add_staff(cur, con):
+def add_staff(svc):
     print("-- Add Staff --")
     name = input("Name: ").strip()
     role = input("Role: ").strip()
     phone = input("Phone: ").strip()
-    cur.execute("INSERT INTO staff (name, role, phone) VALUES (%s, %s, %s)", (name, role, phone))
-    con.commit()
+    svc.add_staff(name, role, phone)
     print("Staff added.")
 
 
-def update_staff(cur, con):
+def update_staff(svc):
     print("-- Update Staff --")
     staff_id = input_int("Staff ID to update: ", min_val=1)
-    cur.execute("SELECT * FROM staff WHERE staff_id=%s", (staff_id,))
-    row = cur.fetchone()
+    row = svc.get_staff(staff_id)
     if not row:
         print("Staff not found.")
         return
     print("Leave blank to keep existing value.")
-    new_name  = input(f"Name [{row[1]}]: ").strip() or row[1]
-    new_role  = input(f"Role [{row[2]}]: ").strip() or row[2]
-    new_phone = input(f"Phone [{row[3]}]: ").strip() or row[3]
-
-    cur.execute(
-        "UPDATE staff SET name=%s, role=%s, phone=%s WHERE staff_id=%s",
-        (new_name, new_role, new_phone, staff_id)
-    )
-    con.commit()
-    print("Staff updated.")
+    new_name  = input(f"Name [{row[1]}]: ").strip()
+    new_role  = input(f"Role [{row[2]}]: ").strip()
+    new_phone = input(f"Phone [{row[3]}]: ").strip()
+    try:
+        svc.update_staff(staff_id, new_name, new_role, new_phone)
+        print("Staff updated.")
+    except ServiceError as e:
+        print(e)
 
 
-def delete_staff(cur, con):
+def delete_staff(svc):
     print("-- Delete Staff --")
     staff_id = input_int("Staff ID to delete: ", min_val=1)
-    cur.execute("DELETE FROM staff WHERE staff_id=%s", (staff_id,))
-    con.commit()
-    if cur.rowcount:
+    try:
+        svc.delete_staff(staff_id)
         print("Staff deleted.")
-    else:
-        print("Staff not found.")
+    except ServiceError as e:
+        print(e)
 
 
-def view_staff(cur):
+def view_staff(svc):
     print("-- All Staff --")
-    cur.execute("SELECT staff_id, name, role, phone FROM staff ORDER BY staff_id")
-    rows = cur.fetchall()
-    if not rows:
-        print("(no staff)")
-        return
-    for r in rows:
-        print(f"{r[0]} | {r[1]} | {r[2]} | {r[3]}")
+
+    def show(rows):
+        for r in rows:
+            print(f"{r[0]} | {r[1]} | {r[2]} | {r[3]}")
+
+    page_through(svc.list_staff, show, "(no staff)")
 
 # -------------------- MEMBERS & ISSUES --------------------
 
-def add_member(cur, con):
+def add_member(svc):
     print("-- Add Member --")
     name = input("Name: ").strip()
     phone = input("Phone: ").strip()
     email = input("Email (optional): ").strip()
     mtype = input("Membership Type (Regular/VIP) [Regular]: ").strip() or 'Regular'
-    if mtype not in ('Regular','VIP'):
-        mtype = 'Regular'
-    cur.execute("INSERT INTO members (name, phone, email, membership_type) VALUES (%s,%s,%s,%s)", (name, phone, email, mtype))
-    con.commit()
+    svc.add_member(name, phone, email, mtype)
     print("Member added.")
 
 
-def update_member(cur, con):
+def update_member(svc):
     print("-- Update Member --")
     member_id = input_int("Member ID to update: ", min_val=1)
-    cur.execute("SELECT member_id, name, phone, email, membership_type FROM members WHERE member_id=%s", (member_id,))
-    row = cur.fetchone()
+    row = svc.get_member(member_id)
     if not row:
         print("Member not found.")
         return
     print("Leave blank to keep existing value.")
-    new_name = input(f"Name [{row[1]}]: ").strip() or row[1]
-    new_phone= input(f"Phone [{row[2]}]: ").strip() or row[2]
-    new_email= input(f"Email [{row[3] or ''}]: ").strip() or row[3]
-    new_type = input(f"Membership Type [{row[4]}]: ").strip() or row[4]
-    if new_type not in ('Regular','VIP'):
-        new_type = row[4]
-    cur.execute("UPDATE members SET name=%s, phone=%s, email=%s, membership_type=%s WHERE member_id=%s", (new_name, new_phone, new_email, new_type, member_id))
-    con.commit()
-    print("Member updated.")
-
-
-def delete_member(cur, con):
+    new_name = input(f"Name [{row[1]}]: ").strip()
+    new_phone= input(f"Phone [{row[2]}]: ").strip()
+    new_email= input(f"Email [{row[3] or ''}]: ").strip()
+    new_type = input(f"Membership Type [{row[4]}]: ").strip()
+    try:
+        svc.update_member(member_id, new_name, new_phone, new_email, new_type)
+        print("Member updated.")
+    except ServiceError as e:
+        print(e)
+
+
+def delete_member(svc):
     print("-- Delete Member --")
     member_id = input_int("Member ID to delete: ", min_val=1)
-    cur.execute("DELETE FROM members WHERE member_id=%s", (member_id,))
-    con.commit()
-    if cur.rowcount:
+    try:
+        svc.delete_member(member_id)
         print("Member deleted.")
-    else:
-        print("Member not found.")
+    except ServiceError as e:
+        print(e)
 
 
-def view_members(cur):
+def view_members(svc):
     print("-- Members --")
-    cur.execute("SELECT member_id, name, phone, email, membership_type FROM members ORDER BY member_id")
-    rows = cur.fetchall()
-    if not rows:
-        print("(no members)")
-        return
-    for r in rows:
-        print(f"{r[0]} | {r[1]} | {r[2]} | {r[3] or ''} | {r[4]}")
 
+    def show(rows):
+        for r in rows:
+            print(f"{r[0]} | {r[1]} | {r[2]} | {r[3] or ''} | {r[4]}")
+
+    page_through(svc.list_members, show, "(no members)")
 
-def issue_book(cur, con):
+
+def issue_book(svc):
     print("-- Issue Book --")
     member_id = input_int("Member ID: ", min_val=1)
-    cur.execute("SELECT name, membership_type FROM members WHERE member_id=%s", (member_id,))
-    mrow = cur.fetchone()
-    if not mrow:
-        print("Member not found.")
-        return
-    member_name, _ = mrow
-
     book_id = input("Book ID: ").strip()
-    cur.execute("SELECT title, stock FROM books WHERE book_id=%s", (book_id,))
-    brow = cur.fetchone()
-    if not brow:
-        print("Book not found.")
-        return
-    title, stock = brow
-    if stock <= 0:
-        print("Book out of stock.")
-        return
-
-    days_raw = input("Issue period (days) [14]: ").strip()
+    days_raw = input(f"Issue period (days) [{DEFAULT_ISSUE_DAYS}]: ").strip()
     if days_raw == "":
-        days = 14
+        days = DEFAULT_ISSUE_DAYS
     else:
         try:
             days = int(days_raw)
-            if days < 1:
-                print("Days must be >= 1")
-                return
         except ValueError:
             print("Please enter a valid number of days.")
             return
 
-    issue_date = datetime.date.today()
-    due_date = issue_date + datetime.timedelta(days=days)
-
-    cur.execute("INSERT INTO issues (member_id, book_id, issue_date, due_date) VALUES (%s,%s,%s,%s)", (member_id, book_id, issue_date, due_date))
-    issue_id = cur.lastrowid
-    cur.execute("UPDATE books SET stock = stock - 1 WHERE book_id=%s", (book_id,))
-    con.commit()
-    print(f"   Issued '{title}' (Book {book_id}) to {member_name} (Member #{member_id}).")
-    print(f"   Issue ID: {issue_id} | Due on {due_date}")
+    try:
+        r = svc.issue(member_id, book_id, days)
+    except ServiceError as e:
+        print(e)
+        return
+    print(f"   Issued '{r.title}' (Book {r.book_id}) to {r.member_name} (Member #{r.member_id}).")
+    print(f"   Issue ID: {r.issue_id} | Due on {r.due_date}")
 
 
-def return_book(cur, con):
+def return_book(svc):
     print("-- Return Book --")
     issue_id = input_int("Issue ID: ", min_val=1)
-    cur.execute("""
-        SELECT i.issue_id, i.member_id, m.name, i.book_id, b.title, i.issue_date, i.due_date, i.return_date
-        FROM issues i
-        JOIN members m ON m.member_id = i.member_id
-        JOIN books b   ON b.book_id   = i.book_id
-        WHERE i.issue_id=%s
-    """, (issue_id,))
-    row = cur.fetchone()
-    if not row:
-        print("Issue record not found.")
-        return
-    if row[7] is not None:
-        print("This book was already returned.")
+    try:
+        r = svc.return_issue(issue_id)
+    except ServiceError as e:
+        print(e)
         return
+    print(f"Returned '{r.title}' from {r.member_name} (Member #{r.member_id}). Late fee: Rs.{r.late_fee:.2f}")
+
 
-    _, member_id, member_name, book_id, title, _, due_date, _ = row
-    return_date = datetime.date.today()
-    late_fee = 0.0
-    if return_date > due_date:
-        days_late = (return_date - due_date).days
-        late_fee = days_late * 5.0  # Rs.5 per day late fee
+def _batch_report(results, ok):
+    failed = [(i, r) for i, r in enumerate(results, 1) if isinstance(r, ServiceError)]
+    print(f"   {len(results) - len(failed)} {ok}, {len(failed)} failed.")
+    for i, e in failed[:20]:
+        print(f"   line {i}: {e}")
+    if len(failed) > 20:
+        print(f"   ... and {len(failed) - 20} more")
 
-    cur.execute("UPDATE issues SET return_date=%s, late_fee=%s WHERE issue_id=%s", (return_date, late_fee, issue_id))
-    cur.execute("UPDATE books SET stock = stock + 1 WHERE book_id=%s", (book_id,))
-    con.commit()
-    print(f"Returned '{title}' from {member_name} (Member #{member_id}). Late fee: Rs.{late_fee:.2f}")
+
+def issue_books_batch(svc):
+    print("-- Issue Books (batch) --")
+    path = input("CSV file of member_id,book_id lines: ").strip()
+    try:
+        with open(path, newline="", encoding="utf-8") as f:
+            loans = [(int(row[0]), row[1].strip()) for row in csv.reader(f) if row and row[0].strip().isdigit()]
+    except (OSError, IndexError, ValueError) as e:
+        print(f"Could not read {path}: {e}")
+        return
+    try:
+        results = svc.issue_many(loans)
+    except ServiceError as e:
+        print(e)
+        return
+    _batch_report(results, "issued")
+
+
+def return_books_batch(svc):
+    print("-- Return Books (batch) --")
+    raw = input("Issue IDs (space/comma separated) or a file with one per line: ").strip()
+    if os.path.isfile(raw):
+        with open(raw, encoding="utf-8") as f:
+            raw = f.read()
+    ids = [t for t in raw.replace(",", " ").split() if t]
+    if not all(t.isdigit() for t in ids):
+        print("Issue IDs must be whole numbers.")
+        return
+    try:
+        results = svc.return_many([int(t) for t in ids])
+    except ServiceError as e:
+        print(e)
+        return
+    _batch_report(results, "returned")
+    fees = sum(r.late_fee for r in results if not isinstance(r, ServiceError))
+    print(f"   Late fees: Rs.{fees:.2f}")
 
 
-def view_active_issues(cur):
+def view_active_issues(svc):
     print("-- Active Issues (Not Yet Returned) --")
-    cur.execute(
-        """
-        SELECT i.issue_id, m.name, m.member_id, b.title, b.book_id, i.issue_date, i.due_date
-        FROM issues i
-        JOIN members m ON m.member_id = i.member_id
-        JOIN books b   ON b.book_id   = i.book_id
-        WHERE i.return_date IS NULL
-        ORDER BY i.issue_date DESC
-        """
-    )
-    rows = cur.fetchall()
-    if not rows:
-        print("(none)")
+
+    def show(rows):
+        for r in rows:
+            print(f"Issue #{r[0]} | Member: {r[1]} (#{r[2]}) | Book: {r[3]} ({r[4]}) | Issued: {r[5]} | Due: {r[6]}")
+
+    page_through(svc.active_issues, show, "(none)")
+
+
+def view_overdue(svc):
+    print("-- Overdue --")
+    mid = input("Member ID (ENTER for totals by membership type): ").strip()
+    if not mid:
+        rows = svc.overdue_summary()
+        if not rows:
+            print("(nothing overdue)")
+        for mtype, items, worst, total in rows:
+            print(f"{mtype:<8} | Overdue: {items} | Worst: {worst} days | Accrued: Rs.{total:.2f}")
         return
-    for r in rows:
-        print(f"Issue #{r[0]} | Member: {r[1]} (#{r[2]}) | Book: {r[3]} ({r[4]}) | Issued: {r[5]} | Due: {r[6]}")
+    try:
+        rows = svc.member_overdue(int(mid))
+    except ValueError:
+        print("Invalid member ID.")
+        return
+    except ServiceError as e:
+        print(e)
+        return
+    if not rows:
+        print("(nothing overdue)")
+    for issue_id, book_id, title, due, days, fee in rows:
+        print(f"Issue #{issue_id} | Book: {title} ({book_id}) | Due: {due} | {days} days late | Rs.{fee:.2f}")
+    if rows:
+        print(f"Total accrued: Rs.{sum(r[5] for r in rows):.2f}")
 
 
-def view_issues_by_month(cur):
+def view_issues_by_month(svc):
     print("-- Issues by Month --")
     ym = input("Enter month (YYYY-MM): ").strip()
+    print("Filter by: 1) Issue Date  2) Return Date  3) Any")
+    f = input("Choice [1/2/3]: ").strip() or '1'
+    by = {'1': 'issue', '2': 'return'}.get(f, 'any')
     try:
-        start, end = parse_year_month(ym)
-    except Exception:
-        print("Invalid format. Example: 2025-08")
+        print_issue_summary(svc.issue_summary(ym))
+    except ServiceError as e:
+        print(e)
         return
 
-    print("Filter by: 1) Issue Date  2) Return Date  3) Any")
-    f = input("Choice [1/2/3]: ").strip() or '1'
+    def show(rows):
+        for r in rows:
+            status = "Returned" if r[7] else "Issued"
+            print(f"Issue #{r[0]} | {status} | Member: {r[1]} (#{r[2]}) | Book: {r[3]} ({r[4]}) | Issue: {r[5]} | Due: {r[6]} | Return: {r[7] or '-'} | Late Fee: Rs.{money(r[8])}")
 
-    if f == '1':
-        where = "i.issue_date BETWEEN %s AND %s"
-        params = (start, end)
-    elif f == '2':
-        where = "i.return_date BETWEEN %s AND %s"
-        params = (start, end)
-    else:
-        where = "(i.issue_date BETWEEN %s AND %s OR i.return_date BETWEEN %s AND %s)"
-        params = (start, end, start, end)
-
-    cur.execute(
-        f"""
-        SELECT i.issue_id, m.name, m.member_id, b.title, b.book_id,
-               i.issue_date, i.due_date, i.return_date, i.late_fee
-        FROM issues i
-        JOIN members m ON m.member_id = i.member_id
-        JOIN books b   ON b.book_id   = i.book_id
-        WHERE {where}
-        ORDER BY COALESCE(i.return_date, i.issue_date) DESC
-        """,
-        params,
-    )
-    rows = cur.fetchall()
-    if not rows:
-        print("(no records)")
+    try:
+        page_through(lambda token: svc.issues_by_month(ym, by, token), show, "(no records)")
+    except ServiceError as e:
+        print(e)
+
+# -------------------- REPORTS --------------------
+
+def print_bill_summary(rows):
+    count = sub = disc = total = 0
+    for _, mtype, bills, subtotal, discount_amt, grand_total in rows:
+        print(f"  {mtype:<8} | Bills: {bills:>5} | Sub: Rs.{subtotal} | Disc: Rs.{discount_amt} | Total: Rs.{grand_total}")
+        count, sub, disc, total = count + bills, sub + subtotal, disc + discount_amt, total + grand_total
+    print(f"  {'All':<8} | Bills: {count:>5} | Sub: Rs.{sub} | Disc: Rs.{disc} | Total: Rs.{total}")
+
+
+def print_issue_summary(rows):
+    issues = sum(r[1] for r in rows)
+    returns = sum(r[2] for r in rows)
+    fees = sum(r[3] for r in rows)
+    print(f"  Issued: {issues} | Returned: {returns} | Late fees: Rs.{fees}")
+
+
+def monthly_report(svc):
+    print("-- Monthly Report --")
+    ym = input("Enter month (YYYY-MM): ").strip()
+    try:
+        bills = svc.bill_summary(ym, daily=True)
+        issues = {r[0]: r for r in svc.issue_summary(ym, daily=True)}
+    except ServiceError as e:
+        print(e)
         return
-    for r in rows:
-        status = "Returned" if r[7] else "Issued"
-        print(f"Issue #{r[0]} | {status} | Member: {r[1]} (#{r[2]}) | Book: {r[3]} ({r[4]}) | Issue: {r[5]} | Due: {r[6]} | Return: {r[7] or '-'} | Late Fee: Rs.{float(r[8]):.2f}")
+    by_day = {}
+    for day, _, count, _, _, grand_total in bills:
+        n, total = by_day.get(day, (0, 0))
+        by_day[day] = (n + count, total + grand_total)
+    days = sorted(set(by_day) | set(issues))
+    if not days:
+        print("(no activity in this month)")
+        return
+    print(f"{'Date':<10} | {'Bills':>5} | {'Takings':>12} | {'Issued':>6} | {'Returned':>8} | {'Late fees':>9}")
+    print("-" * 66)
+    for day in days:
+        n, total = by_day.get(day, (0, 0))
+        _, issued, returned, fees = issues.get(day, (day, 0, 0, 0))
+        print(f"{str(day):<10} | {n:>5} | {total:>12.2f} | {issued:>6} | {returned:>8} | {fees:>9.2f}")
+    print("Totals by membership type:")
+    print_bill_summary(svc.bill_summary(ym))
 
 # -------------------- BILLING --------------------
 
-def create_bill(cur, con):
+def create_bill(svc):
     print("-- Create Bill --")
     member_id_input = input("Member ID (ENTER if none): ").strip()
     member_id = None
-    member_type = 'Regular'
-    member_name = 'Guest'
     if member_id_input:
         try:
             member_id = int(member_id_input)
-            cur.execute("SELECT name, membership_type FROM members WHERE member_id=%s", (member_id,))
-            row = cur.fetchone()
-            if row:
-                member_name, member_type = row[0], row[1]
-            else:
+            if not svc.get_member(member_id):
                 print("Member not found. Billing as guest.")
                 member_id = None
         except ValueError:
@@ -569,105 +515,72 @@ def create_bill(cur, con):
         if book_id == "":
             break
         qty = input_int("Quantity: ", min_val=1)
-        cur.execute("SELECT title, price, stock FROM books WHERE book_id=%s", (book_id,))
-        row = cur.fetchone()
+        row = svc.get_book(book_id)
         if not row:
             print("Book not found.")
             continue
-        title, price, stock = row
+        _, title, _, _, price, stock = row
         if stock < qty:
             print(f"Not enough stock. Available: {stock}")
             continue
-        line_total = float(price) * qty
-        items.append({"book_id": book_id, "title": title, "qty": qty, "unit_price": float(price), "line_total": line_total})
-        print(f"Added: {title} x{qty} = Rs.{line_total}")
+        items.append((book_id, qty))
+        print(f"Added: {title} x{qty} = Rs.{money(price) * qty}")
 
     if not items:
         print("No items added. Bill cancelled.")
         return
 
-    subtotal = sum(i['line_total'] for i in items)
-    discount_pct = input_float("Discount % (0 for none): ", min_val=0, max_val=100)
+    discount_pct = input_money("Discount % (0 for none): ", min_val=0, max_val=100)
+    try:
+        r = svc.create_bill(member_id, items, discount_pct)
+    except ServiceError as e:
+        print(e)
+        print("Bill cancelled.")
+        return
 
-    # VIP extra discount: VIP gets additional 10% off
-    vip_extra = 10.0 if member_type == 'VIP' else 0.0
-    if vip_extra:
+    if r.vip_extra:
         print("VIP member detected: +10% extra discount applied.")
-
-    total_discount_pct = discount_pct + vip_extra
-    # cap discount to 100%
-    total_discount_pct = min(total_discount_pct, 100.0)
-    discount_amt = subtotal * (total_discount_pct / 100.0)
-    grand_total = max(subtotal - discount_amt, 0.0)
-
-    cur.execute("INSERT INTO bills (member_id, bill_date, subtotal, discount_pct, discount_amt, grand_total) VALUES (%s,%s,%s,%s,%s,%s)", (member_id, datetime.datetime.now(), subtotal, total_discount_pct, discount_amt, grand_total))
-    bill_id = cur.lastrowid
-
-    for it in items:
-        cur.execute("INSERT INTO bill_items (bill_id, book_id, qty, unit_price, line_total) VALUES (%s,%s,%s,%s,%s)", (bill_id, it['book_id'], it['qty'], it['unit_price'], it['line_total']))
-        cur.execute("UPDATE books SET stock = stock - %s WHERE book_id=%s", (it['qty'], it['book_id']))
-
-    con.commit()
     print("Bill saved.")
-    print(f"Bill ID: {bill_id} | Customer: {member_name} ({member_type})")
-    print(f"Subtotal: Rs.{subtotal:.2f}")
-    print(f"Total Discount %: {total_discount_pct:.2f}% (Rs.{discount_amt:.2f})")
-    print(f"Grand Total: Rs.{grand_total:.2f}")
+    print(f"Bill ID: {r.bill_id} | Customer: {r.member_name} ({r.member_type})")
+    print(f"Subtotal: Rs.{r.subtotal:.2f}")
+    print(f"Total Discount %: {r.discount_pct:.2f}% (Rs.{r.discount_amt:.2f})")
+    print(f"Grand Total: Rs.{r.grand_total:.2f}")
 
 
-def view_bills(cur):
+def view_bills(svc):
     print("-- Recent Bills --")
-    cur.execute("SELECT bill_id, member_id, bill_date, subtotal, discount_amt, grand_total FROM bills ORDER BY bill_id DESC LIMIT 20")
-    rows = cur.fetchall()
-    if not rows:
-        print("(no bills)")
-        return
-    for r in rows:
-        bid, mid, bdate, sub, damt, total = r
-        print(f"#{bid} | Member: {mid or 'Guest'} | {bdate} | Sub: Rs.{sub} | Disc: Rs.{damt} | Total: Rs.{total}")
+
+    def show(rows):
+        for r in rows:
+            bid, mid, bdate, sub, damt, total = r
+            print(f"#{bid} | Member: {mid or 'Guest'} | {bdate} | Sub: Rs.{sub} | Disc: Rs.{damt} | Total: Rs.{total}")
+
+    page_through(svc.list_bills, show, "(no bills)")
 
 
-def view_bills_by_month(cur):
+def view_bills_by_month(svc):
     print("-- Bills by Month --")
     ym = input("Enter month (YYYY-MM): ").strip()
     try:
-        start, end = parse_year_month(ym)
-    except Exception:
-        print("Invalid format. Example: 2025-08")
+        print_bill_summary(svc.bill_summary(ym))
+    except ServiceError as e:
+        print(e)
         return
-    cur.execute(
-        """
-        SELECT b.bill_id, b.bill_date, COALESCE(m.name,'Guest') AS customer, COALESCE(m.membership_type,'-') AS mtype,
-               b.subtotal, b.discount_pct, b.discount_amt, b.grand_total
-        FROM bills b
-        LEFT JOIN members m ON m.member_id = b.member_id
-        WHERE DATE(b.bill_date) BETWEEN %s AND %s
-        ORDER BY b.bill_date DESC
-        """,
-        (start, end),
-    )
-    rows = cur.fetchall()
-    if not rows:
-        print("(no bills in this month)")
-        return
-    for r in rows:
-        print(f"Bill #{r[0]} | {r[1]} | {r[2]} ({r[3]}) | Sub: {r[4]} | Disc%: {r[5]} | DiscAmt: {r[6]} | Total: {r[7]}")
 
+    def show(rows):
+        for r in rows:
+            print(f"Bill #{r[0]} | {r[1]} | {r[2]} ({r[3]}) | Sub: {r[4]} | Disc%: {r[5]} | DiscAmt: {r[6]} | Total: {r[7]}")
+
+    try:
+        page_through(lambda token: svc.bills_by_month(ym, token), show, "(no bills in this month)")
+    except ServiceError as e:
+        print(e)
 
-def show_bill_details(cur):
+
+def show_bill_details(svc):
     print("-- Bill Details --")
     bill_id = input_int("Enter Bill ID: ", min_val=1)
-    cur.execute(
-        """
-        SELECT bi.item_id, bi.book_id, b.title, bi.qty, bi.unit_price, bi.line_total
-        FROM bill_items bi
-        JOIN books b ON b.book_id = bi.book_id
-        WHERE bi.bill_id = %s
-        ORDER BY bi.item_id
-        """,
-        (bill_id,),
-    )
-    rows = cur.fetchall()
+    rows = svc.bill_items(bill_id)
     if not rows:
         print("(no items found for this bill)")
         return
@@ -679,81 +592,50 @@ def show_bill_details(cur):
 
 # -------------------- CSV EXPORT --------------------
 
-def export_table_csv(cur, table_name, filename):
-    """Raw table export with headers (validated)."""
-    if table_name not in ALLOWED_TABLES:
-        print("Invalid table name for export.")
-        return
+def ask_resume_key(label):
+    raw = input(f"Resume after {label} (ENTER for full export): ").strip()
+    if not raw:
+        return None
+    return int(raw) if raw.isdigit() else raw
+
+
+def ask_workers():
+    raw = input("Parallel worker processes (ENTER for 1): ").strip()
+    return int(raw) if raw.isdigit() and int(raw) > 0 else 1
+
+
+def print_export(stats, what):
+    if not stats.rows:
+        print(f"(no {what} to export)")
+        return False
+    print(f"Exported {stats.rows} rows to {stats.filename} in {stats.seconds:.2f}s "
+          f"(last key {stats.last_key}, peak RSS {stats.peak_rss_kb // 1024} MB)")
+    return True
+
+
+def export_table_csv(svc, table_name, filename, after=None):
+    """Raw table export with headers (validated). Use a .gz filename to compress."""
     try:
-        cur.execute(f"SELECT * FROM {table_name}")
-    except Exception as e:
-        print("Failed to fetch data:", e)
+        stats = svc.export_table_csv(table_name, filename, after)
+    except ServiceError as e:
+        print(e)
         return
-    rows = cur.fetchall()
-    cols = [d[0] for d in cur.description]
-    if not rows:
-        print("(no data to export)")
-        return
-    try:
-        with open(filename, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(cols)
-            writer.writerows(rows)
-        print(f"Exported {table_name} to {filename}")
     except Exception as e:
-        print("Failed to write CSV:", e)
-
-
-def export_issues_detailed_csv(cur, filename):
-    cur.execute(
-        """
-        SELECT i.issue_id,
-               m.member_id, m.name AS member_name, m.membership_type,
-               b.book_id, b.title AS book_title,
-               i.issue_date, i.due_date, i.return_date, i.late_fee
-        FROM issues i
-        JOIN members m ON m.member_id = i.member_id
-        JOIN books b   ON b.book_id   = i.book_id
-        ORDER BY i.issue_id DESC
-        """
-    )
-    rows = cur.fetchall()
-    cols = ["issue_id","member_id","member_name","membership_type","book_id","book_title","issue_date","due_date","return_date","late_fee"]
-    if not rows:
-        print("(no issues to export)")
-        return
-    with open(filename, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(cols)
-        writer.writerows(rows)
-    print(f"Exported detailed Issues to {filename}")
-
-
-def export_bills_detailed_csv(cur, filename):
-    cur.execute(
-        """
-        SELECT b.bill_id, DATE(b.bill_date) AS bill_date, TIME(b.bill_date) AS bill_time,
-               COALESCE(m.name,'Guest') AS customer, COALESCE(m.membership_type,'-') AS membership_type,
-               b.subtotal, b.discount_pct, b.discount_amt, b.grand_total
-        FROM bills b
-        LEFT JOIN members m ON m.member_id = b.member_id
-        ORDER BY b.bill_id DESC
-        """
-    )
-    rows = cur.fetchall()
-    cols = ["bill_id","bill_date","bill_time","customer","membership_type","subtotal","discount_pct","discount_amt","grand_total"]
-    if not rows:
-        print("(no bills to export)")
+        print("Failed to export:", e)
         return
-    with open(filename, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(cols)
-        writer.writerows(rows)
-    print(f"Exported detailed Bills to {filename}")
+    print_export(stats, "data")
+
+
+def export_issues_detailed_csv(svc, filename, after=None, workers=1):
+    print_export(svc.export_issues_csv(filename, after, workers=workers), "issues")
+
+
+def export_bills_detailed_csv(svc, filename, after=None, workers=1):
+    print_export(svc.export_bills_csv(filename, after, workers=workers), "bills")
 
 # -------------------- MENUS --------------------
 
-def books_menu(cur, con):
+def books_menu(svc):
     while True:
         print("=== Books Menu ===")
         print("1. Add Book")
@@ -762,28 +644,31 @@ def books_menu(cur, con):
         print("4. View Books")
         print("5. Search Books")
         print("6. Export Books to CSV")
-        print("7. Back")
+        print("7. Bulk Import Books")
+        print("8. Back")
         choice = input("Choice: ").strip()
         if choice == "1":
-            add_book(cur, con)
+            add_book(svc)
         elif choice == "2":
-            update_book(cur, con)
+            update_book(svc)
         elif choice == "3":
-            delete_book(cur, con)
+            delete_book(svc)
         elif choice == "4":
-            view_books(cur)
+            view_books(svc)
         elif choice == "5":
-            search_books(cur)
+            search_books(svc)
         elif choice == "6":
             fname = input("Filename (e.g., books.csv): ").strip() or 'books.csv'
-            export_table_csv(cur, 'books', fname)
+            export_table_csv(svc, 'books', fname)
         elif choice == "7":
+            bulk_import_books(svc)
+        elif choice == "8":
             break
         else:
             print("Invalid choice.")
 
 
-def staff_menu(cur, con):
+def staff_menu(svc):
     while True:
         print("=== Staff Menu ===")
         print("1. Add Staff")
@@ -794,23 +679,23 @@ def staff_menu(cur, con):
         print("6. Back")
         choice = input("Choice: ").strip()
         if choice == "1":
-            add_staff(cur, con)
+            add_staff(svc)
         elif choice == "2":
-            update_staff(cur, con)
+            update_staff(svc)
         elif choice == "3":
-            delete_staff(cur, con)
+            delete_staff(svc)
         elif choice == "4":
-            view_staff(cur)
+            view_staff(svc)
         elif choice == "5":
             fname = input("Filename (e.g., staff.csv): ").strip() or 'staff.csv'
-            export_table_csv(cur, 'staff', fname)
+            export_table_csv(svc, 'staff', fname)
         elif choice == "6":
             break
         else:
             print("Invalid choice.")
 
 
-def members_menu(cur, con):
+def members_menu(svc):
     while True:
         print("=== Members / Issue-Return Menu ===")
         print("1. Add Member")
@@ -823,58 +708,70 @@ def members_menu(cur, con):
         print("8. View Issues by Month")
         print("9. Export Issues (Detailed CSV)")
         print("10. Export Members to CSV")
-        print("11. Back")
+        print("11. View Overdue")
+        print("12. Issue Books (batch, from CSV)")
+        print("13. Return Books (batch)")
+        print("14. Back")
         choice = input("Choice: ").strip()
         if choice == "1":
-            add_member(cur, con)
+            add_member(svc)
         elif choice == "2":
-            update_member(cur, con)
+            update_member(svc)
         elif choice == "3":
-            delete_member(cur, con)
+            delete_member(svc)
         elif choice == "4":
-            view_members(cur)
+            view_members(svc)
         elif choice == "5":
-            issue_book(cur, con)
+            issue_book(svc)
         elif choice == "6":
-            return_book(cur, con)
+            return_book(svc)
         elif choice == "7":
-            view_active_issues(cur)
+            view_active_issues(svc)
         elif choice == "8":
-            view_issues_by_month(cur)
+            view_issues_by_month(svc)
         elif choice == "9":
-            fname = input("Filename (e.g., issues_detailed.csv): ").strip() or 'issues_detailed.csv'
-            export_issues_detailed_csv(cur, fname)
+            fname = input("Filename (e.g., issues_detailed.csv or .csv.gz): ").strip() or 'issues_detailed.csv'
+            export_issues_detailed_csv(svc, fname, ask_resume_key("issue_id"), ask_workers())
         elif choice == "10":
             fname = input("Filename (e.g., members.csv): ").strip() or 'members.csv'
-            export_table_csv(cur, 'members', fname)
+            export_table_csv(svc, 'members', fname)
         elif choice == "11":
+            view_overdue(svc)
+        elif choice == "12":
+            issue_books_batch(svc)
+        elif choice == "13":
+            return_books_batch(svc)
+        elif choice == "14":
             break
         else:
             print("Invalid choice.")
 
 
-def billing_menu(cur, con):
+def billing_menu(svc):
     while True:
         print("=== Billing Menu ===")
         print("1. Create Bill")
-        print("2. View Recent Bills")
+        print("2. View Bills")
         print("3. View Bills by Month")
         print("4. View Bill Details")
         print("5. Export Bills (Detailed CSV)")
-        print("6. Back")
+        print("6. Monthly Report")
+        print("7. Back")
         choice = input("Choice: ").strip()
         if choice == "1":
-            create_bill(cur, con)
+            create_bill(svc)
         elif choice == "2":
-            view_bills(cur)
+            view_bills(svc)
         elif choice == "3":
-            view_bills_by_month(cur)
+            view_bills_by_month(svc)
         elif choice == "4":
-            show_bill_details(cur)
+            show_bill_details(svc)
         elif choice == "5":
-            fname = input("Filename (e.g., bills_detailed.csv): ").strip() or 'bills_detailed.csv'
-            export_bills_detailed_csv(cur, fname)
+            fname = input("Filename (e.g., bills_detailed.csv or .csv.gz): ").strip() or 'bills_detailed.csv'
+            export_bills_detailed_csv(svc, fname, ask_resume_key("bill_id"), ask_workers())
         elif choice == "6":
+            monthly_report(svc)
+        elif choice == "7":
             break
         else:
             print("Invalid choice.")
@@ -888,13 +785,7 @@ def main():
         print("Failed to initialize database:", e)
         return
 
-    try:
-        con = get_connection(use_db=True)
-    except Exception as e:
-        print("Could not connect to database. Check DB_CONFIG.", e)
-        return
-
-    cur = con.cursor()
+    svc = LibraryService(get_pool())
 
     while True:
         print("==============================")
@@ -907,20 +798,21 @@ def main():
         print("5. Exit")
         choice = input("Choice: ").strip()
         if choice == "1":
-            books_menu(cur, con)
+            books_menu(svc)
         elif choice == "2":
-            staff_menu(cur, con)
+            staff_menu(svc)
         elif choice == "3":
-            members_menu(cur, con)
+            members_menu(svc)
         elif choice == "4":
-            billing_menu(cur, con)
+            billing_menu(svc)
         elif choice == "5":
             break
         else:
             print("Invalid choice.")
 
-    cur.close()
-    con.close()
+    get_pool().close()
+    if os.environ.get("LMS_METRICS_FILE"):
+        METRICS.dump_json(os.environ["LMS_METRICS_FILE"])
     print("Goodbye!")
 
 
@@ -0,0 +1,424 @@
+"""
+Circulation and sales analytics
+-------------------------------
+Reports the rollups can't answer: top books by issues or revenue, sales by
+category, how active members are, and stock turnover. The rows they need
+are loaded as Arrow tables (typed columnar arrays), one record batch at a
+time, and every report is a vectorized filter / hash join / group-by over
+them (pyarrow.compute) instead of a Python loop. Needs pyarrow, like
+lms_parquet.
+
+    an = Analytics(pool, cache_dir="/var/cache/lms")
+    an.top_books(by="revenue", n=10, start=date(2025, 1, 1), end=date(2026, 1, 1))
+    python lms_analytics.py top-books --by revenue --from 2025-01-01 --to 2026-01-01
+
+Loaded frames are cached, keyed by data version. The issues columns used
+here never change after the insert, and bills / bill_items only grow, so
+their version is the highest key and the row count: when the key moves,
+only the rows above the cached one are read and appended. Ids are not
+handed out in commit order, though (MySQL assigns them at INSERT), so if
+the frame then still has fewer rows than the table, a row below that key
+committed late and the frame is reloaded. The books frame (id, title,
+category) can change in place, so its version is a hash of those columns
+over every row, and any edit reloads it. That takes a scan of books, so it
+is checked at most every VERSION_TTL seconds, which bounds how stale
+titles and categories can be. The category of every issue and
+bill item is kept as a column alongside those frames, extended with them
+and rebuilt only when books reloads. Stock changes with every loan, so
+stock_turnover reads it afresh. With cache_dir the frames also persist as
+Arrow IPC files, memory-mapped on load, so a new process starts warm.
+
+Date ranges are half-open [start, end); None leaves that side open.
+
+"""
+
+import os
+import sys
+import json
+import hashlib
+import time
+import argparse
+import datetime
+import threading
+from dataclasses import dataclass
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:     # optional: only the analytics need it
+    pa = pc = None
+
+from lms_export import stream_rows
+from lms_parquet import arrow_schema, converters, record_batch
+
+CHUNK_ROWS = 65536
+DEFAULT_TOP = 10
+ACTIVITY_BUCKETS = (1, 2, 5, 10, 20)     # lower bounds of the issues-per-member bands after "0"
+NO_CATEGORY = "(none)"
+VERSION_TTL = 60.0      # seconds between version checks of frames that change in place
+
+
+@dataclass(frozen=True)
+class Frame:
+    """A table (or the columns of it the reports use) as loaded into memory."""
+    table: str
+    key: str
+    columns: list           # [(name, type)] as in lms_parquet.TABLE_COLUMNS
+    append_only: bool = True
+
+    @property
+    def sql(self):
+        return f"SELECT {', '.join(c for c, _ in self.columns)} FROM {self.table} {{where}} ORDER BY {self.key}"
+
+
+FRAMES = {
+    "issues": Frame("issues", "issue_id", [("issue_id", "int"), ("member_id", "int"), ("book_id", "str"),
+                                           ("issue_date", "date")]),
+    "bills": Frame("bills", "bill_id", [("bill_id", "int"), ("member_id", "int"), ("bill_date", "datetime"),
+                                        ("grand_total", "dec(10,2)")]),
+    "bill_items": Frame("bill_items", "item_id", [("item_id", "int"), ("bill_id", "int"), ("book_id", "str"),
+                                                  ("qty", "int"), ("line_total", "dec(10,2)")]),
+    "books": Frame("books", "book_id", [("book_id", "str"), ("title", "str"), ("category", "str")],
+                   append_only=False),
+}
+# stock moves with every loan and sale, so it isn't part of the cached books frame
+STOCK = Frame("books", "book_id", [("book_id", "str"), ("stock", "int")], append_only=False)
+OPEN_ISSUES_BY_BOOK_SQL = "SELECT book_id, COUNT(*) FROM issues WHERE return_date IS NULL GROUP BY book_id"
+STOCK_BY_CATEGORY_SQL = "SELECT category, COUNT(*), SUM(stock) FROM books GROUP BY category"
+OPEN_ISSUES_BY_CATEGORY_SQL = ("SELECT b.category, COUNT(*) FROM issues i JOIN books b ON b.book_id = i.book_id "
+                               "WHERE i.return_date IS NULL GROUP BY b.category")
+MEMBER_COUNT_SQL = "SELECT COUNT(*) FROM members"
+
+
+def _require():
+    if pa is None:
+        raise RuntimeError("pyarrow is not installed. Run: pip install pyarrow")
+
+
+def _bound(value, arrow_type):
+    """A date bound as a scalar comparable with a date32 or timestamp column."""
+    if pa.types.is_timestamp(arrow_type) and not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+    return pa.scalar(value, arrow_type)
+
+
+def between(table, column, start=None, end=None):
+    """The rows of table with start <= column < end."""
+    arrow_type = table.schema.field(column).type
+    mask = None
+    if start is not None:
+        mask = pc.greater_equal(table[column], _bound(start, arrow_type))
+    if end is not None:
+        below = pc.less(table[column], _bound(end, arrow_type))
+        mask = below if mask is None else pc.and_(mask, below)
+    return table if mask is None else table.filter(mask)
+
+
+def _rows(table, columns):
+    """[(...)] tuples of the given columns, in table order."""
+    return list(zip(*(table[c].to_pylist() for c in columns)))
+
+
+class Analytics:
+    """Reports over cached Arrow frames of one database. Safe to share between threads."""
+
+    def __init__(self, pool, cache_dir=None, chunk_size=CHUNK_ROWS):
+        self.pool = pool
+        self.cache_dir = cache_dir
+        self.chunk_size = chunk_size
+        self._frames = {}           # name -> (version, pa.Table)
+        self._checked = {}          # name -> time.monotonic() of the last version check, for VERSION_TTL
+        self._categories = {}       # frame name -> category per row, aligned with the frame
+        self._lock = threading.Lock()
+        self.rows_loaded = 0        # read from the database so far, for seeing what the cache saves
+
+    def _fetchall(self, sql):
+        with self.pool.connection() as con:
+            cur = con.cursor()
+            cur.execute(sql)
+            rows = cur.fetchall()
+            cur.close()
+            return rows
+
+    def version(self, name):
+        """The data version of frame `name` in the database now (JSON-able, so it can go on disk)."""
+        frame = FRAMES[name]
+        if not frame.append_only:
+            return self._content_hash(frame)
+        sql = f"SELECT MAX({frame.key}), COUNT(*) FROM {frame.table}"
+        return json.loads(json.dumps(list(self._fetchall(sql)[0]), default=str))
+
+    def _loaded_version(self, name, table, version):
+        """The version of what was actually loaded: rows can commit between version() and the load."""
+        if not FRAMES[name].append_only:
+            return version
+        return [pc.max(table[FRAMES[name].key]).as_py(), table.num_rows]
+
+    def _content_hash(self, frame):
+        """[rows, sha1 of every row's frame columns in key order]: changes with any insert, edit or delete."""
+        digest = hashlib.sha1()
+        n = 0
+        with self.pool.connection() as con:
+            for _, chunk in stream_rows(con, frame.sql.format(where=""), (), self.chunk_size):
+                digest.update("".join(repr(row) + "\n" for row in chunk).encode())
+                n += len(chunk)
+        return [n, digest.hexdigest()]
+
+    def _load(self, frame, after=None):
+        schema = arrow_schema(frame.columns)
+        convert = converters(frame.columns)
+        where, params = ("", ()) if after is None else (f"WHERE {frame.key} > %s", (after,))
+        batches = []
+        with self.pool.connection() as con:
+            for _, chunk in stream_rows(con, frame.sql.format(where=where), params, self.chunk_size):
+                batches.append(record_batch(schema, convert, chunk))
+                self.rows_loaded += len(chunk)
+        return pa.Table.from_batches(batches, schema=schema)
+
+    def _cache_paths(self, name):
+        base = os.path.join(self.cache_dir, f"analytics-{name}")
+        return base + ".arrow", base + ".json"
+
+    def _read_cached(self, name):
+        if not self.cache_dir:
+            return None
+        data, meta = self._cache_paths(name)
+        if not (os.path.exists(data) and os.path.exists(meta)):
+            return None
+        with open(meta, encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved.get("columns") != [list(c) for c in FRAMES[name].columns]:
+            return None     # written by a version with other columns
+        return saved["version"], pa.ipc.open_file(pa.memory_map(data)).read_all()
+
+    def _write_cached(self, name, version, table):
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data, meta = self._cache_paths(name)
+        with pa.OSFile(data + ".tmp", "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(data + ".tmp", data)
+        with open(meta + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"version": version, "columns": FRAMES[name].columns}, f)
+        os.replace(meta + ".tmp", meta)
+
+    def frame(self, name):
+        """The current pa.Table for FRAMES[name]: cached, topped up or reloaded as its version says."""
+        _require()
+        frame = FRAMES[name]
+        with self._lock:
+            now = time.monotonic()
+            if not frame.append_only and name in self._frames and now - self._checked[name] < VERSION_TTL:
+                return self._frames[name][1]
+            version = self.version(name)
+            self._checked[name] = now
+            cached = self._frames.get(name) or self._read_cached(name)
+            if cached and cached[0] == version:
+                self._frames[name] = cached
+                return cached[1]
+            grown = (cached and frame.append_only and cached[0][0] is not None and version[0] is not None
+                     and version[0] > cached[0][0])
+            table = None
+            if grown:
+                table = pa.concat_tables([cached[1], self._load(frame, after=cached[0][0])])
+                if table.num_rows < version[1]:     # a row below the cached key committed late
+                    table = None
+            if table is None:
+                table = self._load(frame)
+                if frame.append_only:
+                    self._categories.pop(name, None)
+                else:
+                    self._categories.clear()
+            version = self._loaded_version(name, table, version)
+            self._frames[name] = (version, table)
+            self._write_cached(name, version, table)
+            return table
+
+    def categories(self, name):
+        """
+        The book category of each row of frame `name` ("issues" or
+        "bill_items"), as a column aligned with frame(name): NO_CATEGORY for
+        books without one, null for books no longer in the catalogue.
+        """
+        rows = self.frame(name)
+        books = self.frame("books")
+        with self._lock:
+            done = self._categories.get(name) or pa.chunked_array([], pa.string())
+            if len(done) < len(rows):
+                index = pc.index_in(rows.slice(len(done))["book_id"], value_set=books["book_id"])
+                new = pc.take(pc.fill_null(books["category"], NO_CATEGORY), index)
+                done = pa.chunked_array(done.chunks + new.chunks, pa.string())
+                self._categories[name] = done
+            return done
+
+    def clear(self):
+        """Drop the in-memory frames (the files in cache_dir stay)."""
+        with self._lock:
+            self._frames.clear()
+            self._checked.clear()
+            self._categories.clear()
+
+    # ---- reports ----
+
+    def _items(self, start, end, with_category=False):
+        """bill_items of the bills made in [start, end)."""
+        items = self.frame("bill_items")
+        if with_category:
+            items = items.append_column("category", self.categories("bill_items"))
+        if start is None and end is None:
+            return items
+        bills = between(self.frame("bills"), "bill_date", start, end).select(["bill_id"])
+        return items.join(bills, "bill_id", join_type="inner")
+
+    def _with_titles(self, table, sort_keys):
+        books = self.frame("books").select(["book_id", "title"])
+        books = books.filter(pc.is_in(books["book_id"], value_set=table["book_id"]))   # join a handful, not all
+        titled = table.join(books, "book_id", join_type="left outer")
+        return titled.sort_by(sort_keys)     # a join doesn't keep row order
+
+    def top_books(self, by="issues", n=DEFAULT_TOP, start=None, end=None):
+        """
+        by="issues": [(book_id, title, issues)]; by="revenue": [(book_id,
+        title, copies_sold, revenue)]. The n best over [start, end), ties
+        broken by book_id. Deleted books have title None.
+        """
+        if by == "issues":
+            issues = between(self.frame("issues"), "issue_date", start, end)
+            counts = issues.group_by("book_id").aggregate([("issue_id", "count")])
+            keys = [("issue_id_count", "descending"), ("book_id", "ascending")]
+            top = self._with_titles(counts.sort_by(keys).slice(0, n), keys)
+            return _rows(top, ["book_id", "title", "issue_id_count"])
+        if by == "revenue":
+            sums = self._items(start, end).group_by("book_id").aggregate([("qty", "sum"), ("line_total", "sum")])
+            keys = [("line_total_sum", "descending"), ("book_id", "ascending")]
+            top = self._with_titles(sums.sort_by(keys).slice(0, n), keys)
+            return _rows(top, ["book_id", "title", "qty_sum", "line_total_sum"])
+        raise ValueError("by must be 'issues' or 'revenue'.")
+
+    def category_sales(self, start=None, end=None):
+        """[(category, bills, copies_sold, revenue)] over [start, end), highest revenue first."""
+        items = self._items(start, end, with_category=True)
+        items = items.set_column(items.schema.get_field_index("category"), "category",
+                                 pc.fill_null(items["category"], NO_CATEGORY))
+        sums = items.group_by("category").aggregate([("bill_id", "count_distinct"), ("qty", "sum"),
+                                                     ("line_total", "sum")])
+        sums = sums.sort_by([("line_total_sum", "descending"), ("category", "ascending")])
+        return _rows(sums, ["category", "bill_id_count_distinct", "qty_sum", "line_total_sum"])
+
+    def member_activity(self, start=None, end=None, buckets=ACTIVITY_BUCKETS):
+        """
+        How many issues members took out in [start, end), as bands:
+        [(band, members, share of all members)], e.g. ("0", ...), ("1", ...),
+        ("2-4", ...), ... ("20+", ...).
+        """
+        issues = between(self.frame("issues"), "issue_date", start, end)
+        per_member = issues.group_by("member_id").aggregate([("issue_id", "count")])["issue_id_count"]
+        total = self._fetchall(MEMBER_COUNT_SQL)[0][0]
+        bands = [("0", max(total - len(per_member), 0))]
+        for i, lo in enumerate(buckets):
+            hi = buckets[i + 1] if i + 1 < len(buckets) else None
+            mask = pc.greater_equal(per_member, lo)
+            if hi is not None:
+                mask = pc.and_(mask, pc.less(per_member, hi))
+            label = f"{lo}+" if hi is None else (str(lo) if hi == lo + 1 else f"{lo}-{hi - 1}")
+            bands.append((label, pc.sum(pc.cast(mask, pa.int64())).as_py() or 0))
+        return [(label, count, count / total if total else 0.0) for label, count in bands]
+
+    def stock_turnover(self, start=None, end=None, by="category", n=DEFAULT_TOP):
+        """
+        Issues in [start, end) per copy the library holds now (on the shelf +
+        out on loan). by="category": [(category, titles, copies, issues,
+        turnover)] for every category; by="book": the n busiest copies,
+        [(book_id, title, copies, issues, turnover)].
+        """
+        if by not in ("category", "book"):
+            raise ValueError("by must be 'category' or 'book'.")
+        if by == "category":
+            return self._turnover_by_category(start, end)
+        issues = between(self.frame("issues"), "issue_date", start, end)
+        counts = issues.group_by("book_id").aggregate([("issue_id", "count")])
+        out = self._fetchall(OPEN_ISSUES_BY_BOOK_SQL)
+        on_loan = pa.table({"book_id": pa.array([r[0] for r in out], pa.string()),
+                            "on_loan": pa.array([r[1] for r in out], pa.int64())})
+        books = (self.frame("books")
+                 .join(self._load(STOCK), "book_id", join_type="left outer")
+                 .join(counts, "book_id", join_type="left outer")
+                 .join(on_loan, "book_id", join_type="left outer"))
+        copies = pc.add(pc.cast(pc.fill_null(books["stock"], 0), pa.int64()), pc.fill_null(books["on_loan"], 0))
+        issued = pc.fill_null(books["issue_id_count"], 0)
+        books = books.append_column("copies", copies).append_column("issues", issued)
+        books = books.filter(pc.greater(books["copies"], 0))
+        books = books.append_column("turnover", pc.divide(pc.cast(books["issues"], pa.float64()), books["copies"]))
+        keys = [("turnover", "descending"), ("book_id", "ascending")]
+        top = books.sort_by(keys).slice(0, n)
+        return [(b, t, c, i, round(x, 3)) for b, t, c, i, x in
+                _rows(top, ["book_id", "title", "copies", "issues", "turnover"])]
+
+    def _turnover_by_category(self, start, end):
+        # per-category stock is a GROUP BY the database does well; only the issues need the frames
+        issues = self.frame("issues").append_column("category", self.categories("issues"))
+        issues = between(issues, "issue_date", start, end)
+        issues = issues.filter(pc.is_valid(issues["category"]))     # books since deleted
+        counts = dict(_rows(issues.group_by("category").aggregate([("issue_id", "count")]),
+                            ["category", "issue_id_count"]))
+        on_loan = {}
+        for cat, out in self._fetchall(OPEN_ISSUES_BY_CATEGORY_SQL):
+            on_loan[cat or NO_CATEGORY] = on_loan.get(cat or NO_CATEGORY, 0) + out
+        totals = {}
+        for cat, titles, stock in self._fetchall(STOCK_BY_CATEGORY_SQL):
+            cat = cat or NO_CATEGORY
+            t, s = totals.get(cat, (0, 0))
+            totals[cat] = (t + titles, s + int(stock or 0))
+        result = []
+        for cat in sorted(totals):
+            titles, stock = totals[cat]
+            copies = stock + on_loan.get(cat, 0)
+            issued = counts.get(cat, 0)
+            result.append((cat, titles, copies, issued, round(issued / copies, 3) if copies else None))
+        return result
+
+# -------------------- CLI --------------------
+
+def _date(text):
+    return datetime.date.fromisoformat(text)
+
+
+def main(argv=None):
+    from lms_db import get_pool
+
+    ap = argparse.ArgumentParser(description="Circulation and sales analytics.")
+    ap.add_argument("report", choices=("top-books", "categories", "members", "turnover"))
+    ap.add_argument("--by", help="top-books: issues (default) or revenue; turnover: category (default) or book")
+    ap.add_argument("-n", type=int, default=DEFAULT_TOP, help=f"rows for top-N reports (default: {DEFAULT_TOP})")
+    ap.add_argument("--from", dest="start", type=_date, help="first day, YYYY-MM-DD (default: all history)")
+    ap.add_argument("--to", dest="end", type=_date, help="day after the last one, YYYY-MM-DD")
+    ap.add_argument("--cache-dir", help="keep the loaded frames here between runs")
+    args = ap.parse_args(argv)
+
+    pool = get_pool()
+    an = Analytics(pool, args.cache_dir)
+    started = time.perf_counter()
+    try:
+        if args.report == "top-books":
+            rows = an.top_books(args.by or "issues", args.n, args.start, args.end)
+        elif args.report == "categories":
+            rows = an.category_sales(args.start, args.end)
+        elif args.report == "members":
+            rows = an.member_activity(args.start, args.end)
+        else:
+            rows = an.stock_turnover(args.start, args.end, args.by or "category", args.n)
+    except (ValueError, RuntimeError) as e:
+        print(e)
+        return 1
+    finally:
+        pool.close()
+    for row in rows:
+        print(" | ".join(f"{v:.2%}" if isinstance(v, float) and args.report == "members" else str(v) for v in row))
+    print(f"({time.perf_counter() - started:.2f}s, {an.rows_loaded:,} rows read from the database)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,606 @@
+"""
+Async service for the Library Management System
+-----------------------------------------------
+The book, member, circulation and billing operations of LibraryService as
+coroutines over an async driver, so one process can keep hundreds of
+requests in flight while each waits on the database:
+
+  mysql   -> aiomysql    (pip install aiomysql)
+  sqlite  -> aiosqlite   (pip install aiosqlite)
+
+The statements are the ones lms_service runs (its *_SQL constants,
+Keysets and rollup updates), and so are the results and errors, so both
+modes can serve the same database side by side. The schema must already
+be migrated (run LMS01.py or lms_migrations.py once).
+
+    pool = AsyncConnectionPool(make_async_backend())
+    svc = AsyncLibraryService(pool)
+    receipt = await svc.issue(member_id=1, book_id="B1", days=14)
+    await pool.close()
+
+"""
+
+import time
+import random
+import asyncio
+import sqlite3
+import datetime
+from contextlib import asynccontextmanager
+
+from lms_cache import LRUCache
+from lms_db import DB_BACKEND, POOL_CONFIG, MySQLBackend, PoolTimeout, SQLiteBackend, _to_sqlite, multirow_insert_sql
+from lms_events import open_log
+from lms_metrics import METRICS_ENABLED, AsyncInstrumentedCursor, operations
+from lms_paging import DEFAULT_PAGE_SIZE, page_from_rows, page_size
+from lms_overdue import fee_for
+from lms_records import BillItem, Book, Member, record, records
+from lms_rollups import GUEST, bill_updates, issue_updates, return_updates
+from lms_stock import STOCK_LEDGER_DIR
+from lms_service import (
+    ACTIVE_ISSUES, BILL_INSERT_SQL, BILL_ITEM_COLS, BILL_ITEMS_SQL, BILLS_BY_MONTH, BILLS_LISTING,
+    BOOK_DELETE_SQL, BOOK_INSERT_SQL, BOOK_SQL, BOOK_UPDATE_SQL, BOOKS_IN_SQL, BOOKS_LISTING,
+    BOOKS_STOCK_IN_SQL, CACHE_SIZE, CACHE_TTL, CLOSE_ISSUE_SQL, DEFAULT_ISSUE_DAYS, ISSUE_INSERT_SQL,
+    ISSUES_BY_MONTH, MEMBER_DELETE_SQL, MEMBER_INSERT_SQL, MEMBER_SQL, MEMBER_UPDATE_SQL, MEMBERS_LISTING,
+    MEMBERSHIP_TYPES, RESTOCK_SQL, RETURN_LOOKUP_SQL, STOCK_SQL, TAKE_COPY_SQL,
+    AlreadyExists, InvalidInput, IssueReceipt, NotFound, OutOfStock, ReturnReceipt,
+    _is_duplicate, _month, bill_lines_params, bill_quantities, price_bill, short_stock, take_stock_sql,
+    valid_discount, valid_price, valid_stock,
+)
+
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+ASYNC_POOL_SIZE = 20    # connections; requests beyond this wait for one, they don't each get a thread
+
+# -------------------- BACKENDS --------------------
+# Subclasses of the sync backends: the SQL they generate (ddl, upserts,
+# date arithmetic) is shared, only connecting and transaction control await.
+
+class AsyncMySQLBackend(MySQLBackend):
+    async def connect(self, use_db=True):
+        if aiomysql is None:
+            raise RuntimeError("aiomysql is not installed. Run: pip install aiomysql")
+        cfg = self.config.copy()
+        database = cfg.pop("database", None)
+        if use_db:
+            cfg["db"] = database
+        return await aiomysql.connect(autocommit=False, **cfg)
+
+    async def ping(self, con):
+        try:
+            await con.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    async def begin(self, con):
+        await con.begin()
+
+    async def close(self, con):
+        con.close()
+
+    def is_retryable(self, exc):
+        """Deadlock victim (1213) or lock wait timeout (1205); PyMySQL errors carry the code in args[0]."""
+        return bool(getattr(exc, "args", None)) and exc.args[0] in (1205, 1213)
+
+
+class AsyncSQLiteBackend(SQLiteBackend):
+    async def connect(self, use_db=True):
+        if aiosqlite is None:
+            raise RuntimeError("aiosqlite is not installed. Run: pip install aiosqlite")
+        raw = await aiosqlite.connect(self.path, timeout=30.0, detect_types=sqlite3.PARSE_DECLTYPES)
+        await raw.execute("PRAGMA foreign_keys = ON")
+        if self.path != ":memory:":
+            await raw.execute("PRAGMA journal_mode = WAL")
+            await raw.execute("PRAGMA synchronous = NORMAL")
+        return AsyncSQLiteConnection(raw)
+
+    async def ping(self, con):
+        try:
+            cur = await con.raw.execute("SELECT 1")
+            await cur.fetchone()
+            await cur.close()
+            return True
+        except Exception:
+            return False
+
+    async def begin(self, con):
+        await con.raw.execute("BEGIN IMMEDIATE")
+
+    async def close(self, con):
+        await con.close()
+
+
+class AsyncSQLiteCursor:
+    """aiosqlite cursor that accepts the app's %s placeholders."""
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    async def execute(self, sql, params=()):
+        await self.raw.execute(_to_sqlite(sql), params)
+        return self
+
+    async def fetchone(self):
+        return await self.raw.fetchone()
+
+    async def fetchall(self):
+        return await self.raw.fetchall()
+
+    async def close(self):
+        await self.raw.close()
+
+    @property
+    def rowcount(self):
+        return self.raw.rowcount
+
+    @property
+    def lastrowid(self):
+        return self.raw.lastrowid
+
+
+class AsyncSQLiteConnection:
+    def __init__(self, raw):
+        self.raw = raw
+
+    async def cursor(self):
+        return AsyncSQLiteCursor(await self.raw.cursor())
+
+    async def commit(self):
+        await self.raw.commit()
+
+    async def rollback(self):
+        await self.raw.rollback()
+
+    async def close(self):
+        await self.raw.close()
+
+
+def make_async_backend(name=None):
+    name = name or DB_BACKEND
+    if name == "mysql":
+        return AsyncMySQLBackend()
+    if name == "sqlite":
+        return AsyncSQLiteBackend()
+    raise ValueError(f"Unknown backend: {name}")
+
+# -------------------- POOL --------------------
+
+class AsyncPooledConnection:
+    def __init__(self, raw):
+        self.raw = raw
+        self.last_used = time.monotonic()
+        self.broken = False
+
+    async def cursor(self):
+        cur = await self.raw.cursor()
+        return AsyncInstrumentedCursor(cur) if METRICS_ENABLED else cur
+
+    async def commit(self):
+        await self.raw.commit()
+
+    async def rollback(self):
+        await self.raw.rollback()
+
+
+class AsyncConnectionPool:
+    """
+    ConnectionPool for coroutines: at most `size` connections, checkout
+    waits up to `timeout` seconds (then PoolTimeout), idle connections are
+    closed after `idle_timeout` and optionally pinged before reuse.
+    Waiting for a connection suspends the task, not a thread.
+    """
+
+    def __init__(self, backend, size=None, timeout=None, idle_timeout=None, health_check=None):
+        self.backend = backend
+        self.size = size or ASYNC_POOL_SIZE
+        self.timeout = POOL_CONFIG["timeout"] if timeout is None else timeout
+        self.idle_timeout = POOL_CONFIG["idle_timeout"] if idle_timeout is None else idle_timeout
+        self.health_check = POOL_CONFIG["health_check"] if health_check is None else health_check
+        self.retries = POOL_CONFIG["retries"]
+        self._idle = []                 # LIFO: most recently used on top
+        self._open = 0
+        self._slots = asyncio.Semaphore(self.size)     # one per checked-out connection
+        self._closed = False
+
+    async def _discard(self, pc):
+        self._open -= 1
+        try:
+            await self.backend.close(pc.raw)
+        except Exception:
+            pass
+
+    async def _evict_idle(self):
+        now = time.monotonic()
+        stale = [pc for pc in self._idle if now - pc.last_used > self.idle_timeout]
+        if stale:
+            self._idle = [pc for pc in self._idle if now - pc.last_used <= self.idle_timeout]
+            for pc in stale:
+                await self._discard(pc)
+
+    async def acquire(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        if self._closed:
+            raise RuntimeError("Pool is closed")
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(f"No free connection after {timeout:.1f}s (pool size {self.size})")
+        try:
+            await self._evict_idle()
+            while self._idle:
+                pc = self._idle.pop()
+                if not self.health_check or await self.backend.ping(pc.raw):
+                    return pc
+                await self._discard(pc)
+            self._open += 1
+            try:
+                return AsyncPooledConnection(await self.backend.connect())
+            except BaseException:
+                self._open -= 1
+                raise
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def release(self, pc):
+        try:
+            if not pc.broken:
+                try:
+                    await pc.rollback()     # never hand out a half-finished transaction
+                except Exception:
+                    pc.broken = True
+            if pc.broken or self._closed:
+                await self._discard(pc)
+            else:
+                pc.last_used = time.monotonic()
+                self._idle.append(pc)
+        finally:
+            self._slots.release()
+
+    @asynccontextmanager
+    async def connection(self, timeout=None):
+        pc = await self.acquire(timeout)
+        try:
+            yield pc
+        except asyncio.CancelledError:
+            # the connection may be mid-statement, so don't reuse it
+            pc.broken = True
+            raise
+        finally:
+            await self.release(pc)     # rolls back whatever the caller left open
+
+    async def run_in_transaction(self, work, retries=None):
+        """
+        await work(cur) inside one explicit transaction and commit, with the
+        same rollback and deadlock / lock-timeout retry rules as
+        ConnectionPool.run_in_transaction. Returns whatever work returns.
+        """
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            try:
+                async with self.connection() as con:
+                    cur = await con.cursor()
+                    try:
+                        await self.backend.begin(con.raw)
+                        result = await work(cur)
+                        await con.commit()
+                        return result
+                    finally:
+                        await cur.close()
+            except Exception as e:
+                if attempt >= retries or not self.backend.is_retryable(e):
+                    raise
+            attempt += 1
+            await asyncio.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+
+    def stats(self):
+        return {"size": self.size, "open": self._open, "idle": len(self._idle)}
+
+    async def close(self):
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for pc in idle:
+            await self._discard(pc)
+
+# -------------------- SERVICE --------------------
+
+@operations
+class AsyncLibraryService:
+    """
+    Async counterpart of LibraryService for books, members, circulation
+    and billing. Catalogue search, staff, reports and exports stay on the
+    sync service. It writes books.stock directly, so it refuses to start
+    while a stock ledger (LMS_STOCK_LEDGER) owns the stock.
+    """
+
+    def __init__(self, pool, cache_size=CACHE_SIZE, cache_ttl=CACHE_TTL, events=None):
+        if STOCK_LEDGER_DIR:
+            raise RuntimeError("The async service can't run with a stock ledger (LMS_STOCK_LEDGER is set): "
+                               "the ledger must be the only writer of books.stock.")
+        self.pool = pool
+        self.book_cache = LRUCache(cache_size, cache_ttl)
+        self.member_cache = LRUCache(cache_size, cache_ttl)
+        self.events = open_log() if events is None else events
+
+    async def _fetchone(self, sql, params=()):
+        async with self.pool.connection() as con:
+            cur = await con.cursor()
+            await cur.execute(sql, params)
+            row = await cur.fetchone()
+            await cur.close()
+            return row
+
+    async def _fetchall(self, sql, params=()):
+        async with self.pool.connection() as con:
+            cur = await con.cursor()
+            await cur.execute(sql, params)
+            rows = await cur.fetchall()
+            await cur.close()
+            return rows
+
+    async def _log(self, kind, *values):
+        """Append a committed change to the event log; the loop keeps running while it syncs."""
+        if self.events:
+            future = self.events.submit(kind, values)
+            if self.events.sync == "group":
+                await asyncio.wrap_future(future)
+
+    async def _write(self, sql, params=()):
+        """Run one statement and commit. Returns (rowcount, lastrowid)."""
+        async with self.pool.connection() as con:
+            cur = await con.cursor()
+            await cur.execute(sql, params)
+            result = cur.rowcount, cur.lastrowid
+            await con.commit()
+            await cur.close()
+            return result
+
+    async def _page(self, keyset, params=(), token=None, limit=DEFAULT_PAGE_SIZE):
+        limit = page_size(limit)
+        try:
+            sql, params, backwards = keyset.query(params, token, limit)
+        except ValueError as e:
+            raise InvalidInput(str(e))
+        return page_from_rows(keyset, await self._fetchall(sql, params), token, limit, backwards)
+
+    async def _cached(self, cache, key, sql, cls):
+        row = cache.get(key)
+        if row is None:
+            generation = cache.generation()
+            row = record(cls, await self._fetchone(sql, (key,)))
+            if row is not None:
+                cache.put(key, row, generation)
+        return row
+
+    def cache_stats(self):
+        return {"books": self.book_cache.stats(), "members": self.member_cache.stats()}
+
+    # ---- books ----
+
+    async def add_book(self, book_id, title, author, category, price, stock):
+        price, stock = valid_price(price), valid_stock(stock)
+        try:
+            await self._write(BOOK_INSERT_SQL, (book_id, title, author, category, price, stock))
+        except Exception as e:
+            if _is_duplicate(e):
+                raise AlreadyExists("Book ID already exists.")
+            raise
+        self.book_cache.invalidate(book_id)
+        await self._log("book_added", book_id, title, author, category, price, stock)
+
+    async def get_book(self, book_id):
+        return await self._cached(self.book_cache, book_id, BOOK_SQL, Book)
+
+    async def get_books(self, book_ids):
+        found, missing = {}, []
+        for book_id in book_ids:
+            row = self.book_cache.get(book_id)
+            if row is None:
+                missing.append(book_id)
+            else:
+                found[book_id] = row
+        if missing:
+            generation = self.book_cache.generation()
+            marks = ",".join(["%s"] * len(missing))
+            for book in records(Book, await self._fetchall(BOOKS_IN_SQL.format(marks=marks), missing)):
+                found[book.book_id] = book
+                self.book_cache.put(book.book_id, book, generation)
+        return found
+
+    async def update_book(self, book_id, title=None, author=None, category=None, price=None, stock=None):
+        row = await self._fetchone(BOOK_SQL, (book_id,))
+        if not row:
+            raise NotFound("Book not found.")
+        values = (
+            row[1] if title is None else title,
+            row[2] if author is None else author,
+            row[3] if category is None else category,
+            row[4] if price is None else valid_price(price),
+            row[5] if stock is None else valid_stock(stock),
+        )
+        await self._write(BOOK_UPDATE_SQL, values + (book_id,))
+        self.book_cache.invalidate(book_id)
+        await self._log("book_updated", book_id, *values)
+
+    async def delete_book(self, book_id):
+        count, _ = await self._write(BOOK_DELETE_SQL, (book_id,))
+        if not count:
+            raise NotFound("Book not found.")
+        self.book_cache.invalidate(book_id)
+        await self._log("book_deleted", book_id)
+
+    async def list_books(self, token=None, limit=DEFAULT_PAGE_SIZE):
+        return await self._page(BOOKS_LISTING, (), token, limit)
+
+    # ---- members ----
+
+    async def add_member(self, name, phone, email, membership_type='Regular'):
+        if membership_type not in MEMBERSHIP_TYPES:
+            membership_type = 'Regular'
+        _, member_id = await self._write(MEMBER_INSERT_SQL, (name, phone, email, membership_type))
+        await self._log("member_added", member_id, name, phone, email, membership_type)
+        return member_id
+
+    async def get_member(self, member_id):
+        return await self._cached(self.member_cache, member_id, MEMBER_SQL, Member)
+
+    async def update_member(self, member_id, name=None, phone=None, email=None, membership_type=None):
+        row = await self._fetchone(MEMBER_SQL, (member_id,))
+        if not row:
+            raise NotFound("Member not found.")
+        if membership_type not in MEMBERSHIP_TYPES:
+            membership_type = row[4]
+        name, phone, email = name or row[1], phone or row[2], email or row[3]
+        await self._write(MEMBER_UPDATE_SQL, (name, phone, email, membership_type, member_id))
+        self.member_cache.invalidate(member_id)
+        await self._log("member_updated", member_id, name, phone, email, membership_type)
+
+    async def delete_member(self, member_id):
+        count, _ = await self._write(MEMBER_DELETE_SQL, (member_id,))
+        if not count:
+            raise NotFound("Member not found.")
+        self.member_cache.invalidate(member_id)
+        await self._log("member_deleted", member_id)
+
+    async def list_members(self, token=None, limit=DEFAULT_PAGE_SIZE):
+        return await self._page(MEMBERS_LISTING, (), token, limit)
+
+    # ---- circulation ----
+
+    async def issue(self, member_id, book_id, days=DEFAULT_ISSUE_DAYS):
+        if days < 1:
+            raise InvalidInput("Days must be >= 1")
+        member = await self.get_member(member_id)
+        if not member:
+            raise NotFound("Member not found.")
+        book = await self.get_book(book_id)
+        if not book:
+            raise NotFound("Book not found.")
+
+        async def work(cur):
+            await cur.execute(TAKE_COPY_SQL, (book_id,))
+            if cur.rowcount != 1:
+                await cur.execute(STOCK_SQL, (book_id,))
+                if await cur.fetchone() is None:
+                    raise NotFound("Book not found.")
+                raise OutOfStock("Book out of stock.")
+
+            issue_date = datetime.date.today()
+            due_date = issue_date + datetime.timedelta(days=days)
+            await cur.execute(ISSUE_INSERT_SQL, (member_id, book_id, issue_date, due_date))
+            issue_id = cur.lastrowid
+            for sql, params in issue_updates(self.pool.backend, issue_date):
+                await cur.execute(sql, params)
+            return IssueReceipt(issue_id, member_id, member[1], book_id, book[1], issue_date, due_date)
+
+        try:
+            receipt = await self.pool.run_in_transaction(work)
+        finally:
+            self.book_cache.invalidate(book_id)
+        await self._log("book_issued", receipt.issue_id, member_id, book_id, receipt.issue_date, receipt.due_date)
+        return receipt
+
+    async def return_issue(self, issue_id):
+        async def work(cur):
+            await cur.execute(RETURN_LOOKUP_SQL, (issue_id,))
+            row = await cur.fetchone()
+            if not row:
+                raise NotFound("Issue record not found.")
+            if row[7] is not None:
+                raise InvalidInput("This book was already returned.")
+
+            _, member_id, member_name, book_id, title, _, due_date, _, membership_type = row
+            return_date = datetime.date.today()
+            late_fee = fee_for(membership_type, (return_date - due_date).days)
+
+            await cur.execute(CLOSE_ISSUE_SQL, (return_date, late_fee, issue_id))
+            if cur.rowcount != 1:
+                raise InvalidInput("This book was already returned.")
+            await cur.execute(RESTOCK_SQL, (book_id,))
+            for sql, params in return_updates(self.pool.backend, return_date, late_fee):
+                await cur.execute(sql, params)
+            return ReturnReceipt(issue_id, member_id, member_name, book_id, title, return_date, late_fee)
+
+        receipt = await self.pool.run_in_transaction(work)
+        self.book_cache.invalidate(receipt.book_id)
+        await self._log("book_returned", issue_id, receipt.book_id, receipt.return_date, receipt.late_fee)
+        return receipt
+
+    async def active_issues(self, token=None, limit=DEFAULT_PAGE_SIZE):
+        return await self._page(ACTIVE_ISSUES, (), token, limit)
+
+    async def issues_by_month(self, ym, by='issue', token=None, limit=DEFAULT_PAGE_SIZE):
+        start, end = _month(ym)
+        keyset = ISSUES_BY_MONTH.get(by, ISSUES_BY_MONTH['any'])
+        params = (start, end) * (keyset.where.count("%s") // 2)
+        return await self._page(keyset, params, token, limit)
+
+    # ---- billing ----
+
+    async def create_bill(self, member_id, items, discount_pct=0.0):
+        """Same rules and round trips as LibraryService.create_bill."""
+        wanted = bill_quantities(items)
+        discount_pct = valid_discount(discount_pct)
+        ids = sorted(wanted)
+        bill_date = None
+
+        async def work(cur):
+            nonlocal bill_date
+            # as lms_service.bill_parties: prices and membership from the bill's transaction, not the caches
+            member_name, member_type = 'Guest', 'Regular'
+            if member_id is not None:
+                await cur.execute(MEMBER_SQL, (member_id,))
+                member = await cur.fetchone()
+                if not member:
+                    raise NotFound("Member not found.")
+                member_name, member_type = member[1], member[4]
+            await cur.execute(BOOKS_IN_SQL.format(marks=",".join(["%s"] * len(ids))), ids)
+            books = {book.book_id: book for book in records(Book, await cur.fetchall())}
+            for book_id in ids:
+                if book_id not in books:
+                    raise NotFound(f"Book not found: {book_id}")
+
+            await cur.execute(*take_stock_sql(wanted))
+            if cur.rowcount != len(ids):
+                await cur.execute(BOOKS_STOCK_IN_SQL.format(marks=",".join(["%s"] * len(ids))), ids)
+                raise short_stock(wanted, await cur.fetchall())
+
+            receipt = price_bill(member_id, member_name, member_type, items, books, discount_pct)
+            bill_date = datetime.datetime.now()
+            await cur.execute(BILL_INSERT_SQL, (member_id, bill_date, receipt.subtotal, receipt.discount_pct,
+                                                receipt.discount_amt, receipt.grand_total))
+            receipt.bill_id = cur.lastrowid
+            for sql, params in bill_updates(self.pool.backend, bill_date, GUEST if member_id is None else member_type,
+                                            receipt.subtotal, receipt.discount_amt, receipt.grand_total):
+                await cur.execute(sql, params)
+            await cur.execute(multirow_insert_sql("bill_items", BILL_ITEM_COLS, len(receipt.lines)),
+                              bill_lines_params(receipt))
+            return receipt
+
+        try:
+            receipt = await self.pool.run_in_transaction(work)
+        finally:
+            self.book_cache.invalidate(*ids)
+        await self._log("bill_created", receipt.bill_id, member_id, GUEST if member_id is None else receipt.member_type,
+                        bill_date, receipt.subtotal, receipt.discount_pct, receipt.discount_amt, receipt.grand_total,
+                        [(line.book_id, line.qty, line.unit_price, line.line_total) for line in receipt.lines])
+        return receipt
+
+    async def list_bills(self, token=None, limit=DEFAULT_PAGE_SIZE):
+        return await self._page(BILLS_LISTING, (), token, limit)
+
+    async def bills_by_month(self, ym, token=None, limit=DEFAULT_PAGE_SIZE):
+        start, end = _month(ym)
+        return await self._page(BILLS_BY_MONTH, (start, end), token, limit)
+
+    async def bill_items(self, bill_id):
+        return records(BillItem, await self._fetchall(BILL_ITEMS_SQL, (bill_id,)))
@@ -0,0 +1,925 @@
+"""
+Load and stress tests
+---------------------
+Run against a scratch database, never the live one: the scenarios create
+their own books and members and leave them behind.
+
+    LMS_BACKEND=sqlite LMS_SQLITE_PATH=/tmp/bench.db python lms_bench.py stress --workers 1,2,4,8
+
+stress  N desks hammer one hot book with issues and returns. Every run must
+        end with stock >= 0 and stock + open issues == the starting stock,
+        and exactly `stock` issues may succeed while returns are paused.
+bill    per-bill latency at 1, 10 and 100 line items, batched create_bill
+        against the old one-statement-per-line path.
+ledger  issues/sec on one hot title with N desks, stock written straight to
+        books against an lms_stock ledger flushing behind; after a flush
+        the table must agree with the open issues.
+batch   items/sec issuing and returning N books one call at a time against
+        issue_many / return_many, checking the stock comes back.
+prepared issue/return pair latency (p50, p99) with the registered statements
+        run on cursors prepared once per connection against a pool that
+        sends every statement as plain text, and how often each ran.
+cache   book lookups with a skewed (Zipf-like) access pattern at several
+        cache sizes: hit rate and mean lookup time, for tuning CACHE_SIZE.
+records memory and build time per million books rows held as plain
+        tuples, as dicts (one per row) and as lms_records.Book.
+money   prices N bill line items with create_bill's exact Decimal
+        arithmetic against the float arithmetic it replaced: time, and
+        bills whose stored amounts don't add up.
+overdue seeds N open issues (once) and times the set-based overdue summary
+        and snapshot against pricing every open issue in Python.
+load    N concurrent clients send a mix of book lookups, listing pages and
+        issues/returns, through the sync service (a thread per client)
+        and the async one (a task per client): requests/sec, p50 and p99.
+http    starts lms_http.py on a free local port and drives it with N
+        keep-alive client processes: requests/sec for issue/return pairs
+        and for catalogue search.
+
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import socket
+import random
+import asyncio
+import argparse
+import datetime
+import tempfile
+import statistics
+import threading
+import subprocess
+import tracemalloc
+import http.client
+from urllib.parse import urlencode
+from concurrent.futures import ProcessPoolExecutor
+
+from lms_db import STATEMENTS, ConnectionPool, make_backend
+from lms_migrations import migrate
+from lms_money import ZERO, from_paise, money, total
+from lms_overdue import fee_for, overdue_summary, snapshot
+from lms_records import Book, records
+from lms_service import BillLine, BillReceipt, LibraryService, OutOfStock, ServiceError, price_bill
+from lms_stock import StockLedger
+
+
+def _new_book(svc, stock):
+    book_id = "HOT-" + uuid.uuid4().hex[:12]
+    svc.add_book(book_id, "Hot Book", "Bench", "Bench", 10.0, stock)
+    return book_id
+
+
+def _invariant(svc, book_id, start_stock):
+    """(stock, open issues) for the book; raises AssertionError if copies appeared or vanished."""
+    stock = svc.get_book(book_id)[5]
+    open_issues = svc._fetchone(
+        "SELECT COUNT(*) FROM issues WHERE book_id=%s AND return_date IS NULL", (book_id,))[0]
+    assert stock >= 0, f"stock went negative: {stock}"
+    assert stock + open_issues == start_stock, f"stock {stock} + open {open_issues} != {start_stock}"
+    return stock, open_issues
+
+# -------------------- STRESS --------------------
+
+def oversell_check(svc, member_id, workers, stock):
+    """workers race for `stock` copies with no returns: exactly `stock` issues may win."""
+    book_id = _new_book(svc, stock)
+    won = []
+    lost = []
+    barrier = threading.Barrier(workers)
+
+    def desk():
+        barrier.wait()
+        while True:
+            try:
+                won.append(svc.issue(member_id, book_id).issue_id)
+            except OutOfStock:
+                lost.append(1)
+                return
+
+    threads = [threading.Thread(target=desk) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stock_left, open_issues = _invariant(svc, book_id, stock)
+    assert len(won) == stock and stock_left == 0, f"{len(won)} issued from {stock} copies, {stock_left} left"
+    return len(won), len(lost)
+
+
+def churn(svc, member_id, workers, stock, seconds):
+    """
+    Mixed issue/return traffic on one book for `seconds`. Returns
+    (operations per second, out-of-stock refusals, errors).
+    """
+    book_id = _new_book(svc, stock)
+    stop = time.monotonic() + seconds
+    ops = [0] * workers
+    refused = [0] * workers
+    errors = []
+    barrier = threading.Barrier(workers)
+
+    def desk(n):
+        rng = random.Random(n)
+        held = []
+        barrier.wait()
+        while time.monotonic() < stop:
+            try:
+                if held and (rng.random() < 0.5 or len(held) > 3):
+                    svc.return_issue(held.pop(rng.randrange(len(held))))
+                else:
+                    held.append(svc.issue(member_id, book_id).issue_id)
+                ops[n] += 1
+            except OutOfStock:
+                refused[n] += 1
+            except ServiceError as e:
+                errors.append(str(e))
+            except Exception as e:      # deadlock retries exhausted, pool timeout, ...
+                errors.append(repr(e))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=desk, args=(n,)) for n in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    _invariant(svc, book_id, stock)
+    return sum(ops) / elapsed, sum(refused), errors
+
+
+def run_stress(args):
+    worker_counts = [int(w) for w in args.workers.split(",")]
+    pool = ConnectionPool(make_backend(), size=max(worker_counts) + 1, timeout=60.0)
+    migrate(pool)
+    svc = LibraryService(pool)
+    member_id = svc.add_member("Bench Desk", "-", None)
+
+    print(f"{'workers':>7} | {'oversell':>12} | {'ops/sec':>9} | {'refused':>7} | errors")
+    print("-" * 56)
+    failed = False
+    for workers in worker_counts:
+        try:
+            won, _ = oversell_check(svc, member_id, workers, args.stock)
+            rate, refused, errors = churn(svc, member_id, workers, args.stock, args.seconds)
+        except AssertionError as e:
+            print(f"{workers:>7} | FAILED: {e}")
+            failed = True
+            continue
+        print(f"{workers:>7} | {f'{won}/{args.stock} ok':>12} | {rate:>9,.0f} | {refused:>7} | {len(errors)}")
+        for e in errors[:3]:
+            print(f"        {e}")
+        failed = failed or bool(errors)
+    pool.close()
+    return 1 if failed else 0
+
+# -------------------- STOCK LEDGER --------------------
+
+def hot_issues(svc, member_id, book_id, workers, seconds):
+    """`workers` desks issue copies of one book for `seconds`. Returns (issues per second, errors)."""
+    stop = time.monotonic() + seconds
+    issued = [0] * workers
+    errors = []
+    barrier = threading.Barrier(workers)
+
+    def desk(n):
+        barrier.wait()
+        while time.monotonic() < stop:
+            try:
+                svc.issue(member_id, book_id)
+                issued[n] += 1
+            except Exception as e:
+                errors.append(repr(e))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=desk, args=(n,)) for n in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(issued) / (time.perf_counter() - started), errors
+
+
+def run_ledger(args):
+    worker_counts = [int(w) for w in args.workers.split(",")]
+    pool = ConnectionPool(make_backend(), size=max(worker_counts) + 2, timeout=60.0)
+    migrate(pool)
+    directory = tempfile.mkdtemp(prefix="lms-stock-")
+    ledger = StockLedger(pool, directory)
+    direct = LibraryService(pool, ledger=False)
+    ledgered = LibraryService(pool, ledger=ledger)
+    member_id = direct.add_member("Bench Desk", "-", None)
+
+    print(f"{'workers':>7} | {'direct':>9} | {'ledger':>9} | {'speed-up':>8}    (issues/sec on one title)")
+    print("-" * 48)
+    failed = False
+    try:
+        for workers in worker_counts:
+            rates = []
+            for svc in (direct, ledgered):
+                book_id = _new_book(direct, args.stock)
+                rate, errors = hot_issues(svc, member_id, book_id, workers, args.seconds)
+                ledger.flush()
+                try:
+                    _invariant(direct, book_id, args.stock)     # direct: what the books table says
+                except AssertionError as e:
+                    errors.append(str(e))
+                rates.append(rate)
+                for e in errors[:3]:
+                    print(f"        {e}")
+                failed = failed or bool(errors)
+            print(f"{workers:>7} | {rates[0]:>9,.0f} | {rates[1]:>9,.0f} | {rates[1] / rates[0]:>7.1f}x")
+        stats = ledger.stats()
+        print(f"ledger: {stats['flushes']} flushes wrote {stats['books_written']} book rows")
+    finally:
+        ledger.close()
+        shutil.rmtree(directory, ignore_errors=True)
+        pool.close()
+    return 1 if failed else 0
+
+# -------------------- BILLING --------------------
+
+def per_item_bill(pool, member_id, items):
+    """The pre-batching create_bill: a SELECT, an INSERT and an UPDATE per line. Baseline only."""
+    def work(cur):
+        lines = []
+        for book_id, qty in sorted(items):
+            cur.execute("UPDATE books SET stock = stock - %s WHERE book_id=%s AND stock >= %s", (qty, book_id, qty))
+            if cur.rowcount != 1:
+                raise OutOfStock(book_id)
+        for book_id, qty in items:
+            cur.execute("SELECT title, price FROM books WHERE book_id=%s", (book_id,))
+            _, price = cur.fetchone()
+            lines.append((book_id, qty, float(price), float(price) * qty))
+        subtotal = sum(line[3] for line in lines)
+        cur.execute("INSERT INTO bills (member_id, bill_date, subtotal, discount_pct, discount_amt, grand_total) VALUES (%s,%s,%s,%s,%s,%s)",
+                    (member_id, datetime.datetime.now(), subtotal, 0, 0, subtotal))
+        bill_id = cur.lastrowid
+        for book_id, qty, price, total in lines:
+            cur.execute("INSERT INTO bill_items (bill_id, book_id, qty, unit_price, line_total) VALUES (%s,%s,%s,%s,%s)",
+                        (bill_id, book_id, qty, price, total))
+        return bill_id
+    return pool.run_in_transaction(work)
+
+
+def _latency_ms(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times)
+
+
+def run_bill(args):
+    pool = ConnectionPool(make_backend(), size=2)
+    migrate(pool)
+    svc = LibraryService(pool)
+    member_id = svc.add_member("Bench Till", "-", None)
+    sizes = [int(n) for n in args.items.split(",")]
+    prefix = "BILL-" + uuid.uuid4().hex[:8] + "-"
+    book_ids = [f"{prefix}{i}" for i in range(max(sizes))]
+    with pool.connection() as con:
+        cur = con.cursor()
+        cur.executemany("INSERT INTO books (book_id, title, author, category, price, stock) VALUES (%s,%s,%s,%s,%s,%s)",
+                        [(b, f"Bench title {b}", "Bench", "Bench", 9.99, 10 ** 6) for b in book_ids])
+        con.commit()
+        cur.close()
+
+    print(f"{'items':>5} | {'per-item p50':>12} | {'batched p50':>11} | {'speed-up':>8}    (ms, {args.repeat} bills each)")
+    print("-" * 58)
+    for n in sizes:
+        items = [(b, 1) for b in book_ids[:n]]
+        old = _latency_ms(lambda: per_item_bill(pool, member_id, items), args.repeat)
+        new = _latency_ms(lambda: svc.create_bill(member_id, items), args.repeat)
+        print(f"{n:>5} | {old:>12.2f} | {new:>11.2f} | {old / new:>7.1f}x")
+    pool.close()
+    return 0
+
+# -------------------- BATCH CIRCULATION --------------------
+
+def _rate(fn, items):
+    started = time.perf_counter()
+    results = fn()
+    return results, len(items) / (time.perf_counter() - started)
+
+
+def run_batch(args):
+    pool = ConnectionPool(make_backend(), size=2)
+    migrate(pool)
+    svc = LibraryService(pool)
+    sizes = [int(n) for n in args.items.split(",")]
+    members = [svc.add_member(f"Bench Class {i}", "-", None) for i in range(args.members)]
+    prefix = "BATCH-" + uuid.uuid4().hex[:8] + "-"
+    book_ids = [f"{prefix}{i}" for i in range(args.books)]
+    stock = max(sizes)
+    with pool.connection() as con:
+        cur = con.cursor()
+        cur.executemany("INSERT INTO books (book_id, title, author, category, price, stock) VALUES (%s,%s,%s,%s,%s,%s)",
+                        [(b, f"Bench title {b}", "Bench", "Bench", 9.99, stock) for b in book_ids])
+        con.commit()
+        cur.close()
+
+    failed = False
+    print(f"{'items':>6} | {'issue 1-by-1':>12} | {'issue_many':>10} | {'return 1-by-1':>13} | {'return_many':>11}"
+          f"    (items/sec)")
+    print("-" * 68)
+    for n in sizes:
+        loans = [(members[i % len(members)], book_ids[i % len(book_ids)]) for i in range(n)]
+        receipts, issue_one = _rate(lambda: [svc.issue(m, b) for m, b in loans], loans)
+        _, return_one = _rate(lambda: [svc.return_issue(r.issue_id) for r in receipts], receipts)
+        results, issue_batch = _rate(lambda: svc.issue_many(loans), loans)
+        ids = [r.issue_id for r in results if not isinstance(r, ServiceError)]
+        returned, return_batch = _rate(lambda: svc.return_many(ids), ids)
+        errors = [r for r in results + returned if isinstance(r, ServiceError)]
+        print(f"{n:>6} | {issue_one:>12,.0f} | {issue_batch:>10,.0f} | {return_one:>13,.0f} | {return_batch:>11,.0f}"
+              f"{'    ' + str(len(errors)) + ' failed' if errors else ''}")
+        failed = failed or bool(errors)
+    left = svc._fetchone("SELECT MIN(stock), MAX(stock) FROM books WHERE book_id LIKE %s", (prefix + "%",))
+    if tuple(left) != (stock, stock):
+        print(f"stock did not come back: min/max {left}, expected {stock}")
+        failed = True
+    pool.close()
+    return 1 if failed else 0
+
+# -------------------- PREPARED STATEMENTS --------------------
+
+def circulation_pairs(svc, member_id, book_id, pairs):
+    """Issue and return one copy `pairs` times. Returns the latency of each pair in seconds."""
+    latencies = []
+    for _ in range(pairs):
+        started = time.perf_counter()
+        svc.return_issue(svc.issue(member_id, book_id).issue_id)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def run_prepared(args):
+    backend = make_backend()
+    plain_pool = ConnectionPool(backend, size=2, prepared=False)
+    prepared_pool = ConnectionPool(backend, size=2, prepared=True)
+    migrate(plain_pool)
+    plain = LibraryService(plain_pool, ledger=False)
+    prepared = LibraryService(prepared_pool, ledger=False)
+    member_id = plain.add_member("Bench Desk", "-", None)
+    book_id = _new_book(plain, 10)
+
+    # warm both (connections open, caches filled), then alternate rounds so drift hits both alike
+    for svc in (plain, prepared):
+        circulation_pairs(svc, member_id, book_id, 50)
+    STATEMENTS.reset()
+    timings = {"plain": [], "prepared": []}
+    per_round = max(1, args.pairs // args.rounds)
+    for _ in range(args.rounds):
+        for name, svc in (("plain", plain), ("prepared", prepared)):
+            timings[name] += circulation_pairs(svc, member_id, book_id, per_round)
+    _invariant(plain, book_id, 10)
+
+    print(f"{backend.name}: {per_round * args.rounds:,} issue/return pairs each, {args.rounds} alternating rounds")
+    print(f"{'statements':<10} | {'p50 ms':>7} | {'p99 ms':>7} | {'pairs/sec':>9}")
+    print("-" * 44)
+    p50s = {}
+    for name, latencies in timings.items():
+        p50s[name], p99 = _percentiles(latencies)
+        print(f"{name:<10} | {p50s[name]:>7.3f} | {p99:>7.3f} | {len(latencies) / sum(latencies):>9,.0f}")
+    print(f"p50 speed-up: {p50s['plain'] / p50s['prepared']:.2f}x")
+    print()
+    print(f"{'runs':>7} | {'prepared':>8} | statement")
+    for row in STATEMENTS.stats():
+        if row["executions"]:
+            print(f"{row['executions']:>7,} | {row['prepares']:>8} | {row['sql'][:70]}")
+    plain_pool.close()
+    prepared_pool.close()
+    return 0
+
+# -------------------- CACHE --------------------
+
+def run_cache(args):
+    pool = ConnectionPool(make_backend(), size=2)
+    migrate(pool)
+    with pool.connection() as con:
+        cur = con.cursor()
+        cur.execute("SELECT book_id FROM books ORDER BY book_id LIMIT %s", (args.books,))
+        book_ids = [r[0] for r in cur.fetchall()]
+        cur.close()
+    if not book_ids:
+        print("No books in the database; import some first.")
+        return 1
+    # rank r is looked up with probability ~ 1/r: a few titles get most of the traffic
+    rng = random.Random(42)
+    weights = [1.0 / (r + 1) for r in range(len(book_ids))]
+    lookups = rng.choices(book_ids, weights, k=args.lookups)
+
+    print(f"{len(book_ids)} books, {args.lookups} lookups")
+    print(f"{'size':>7} | {'hit rate':>8} | {'evictions':>9} | {'us/lookup':>9}")
+    print("-" * 44)
+    for size in [int(n) for n in args.sizes.split(",")]:
+        svc = LibraryService(pool, cache_size=size)
+        started = time.perf_counter()
+        for book_id in lookups:
+            svc.get_book(book_id)
+        elapsed = time.perf_counter() - started
+        st = svc.book_cache.stats()
+        print(f"{size:>7} | {st['hit_rate']:>8.1%} | {st['evictions']:>9} | {elapsed / len(lookups) * 1e6:>9.1f}")
+    pool.close()
+    return 0
+
+# -------------------- RECORDS --------------------
+
+def _book_values(n):
+    """n books rows' values, as lists so each way of holding a row has to build its own container."""
+    return [[f"B{i:07d}", f"Title {i}", f"Author {i % 5000}", "Fiction", 10.0 + i % 90, i % 20] for i in range(n)]
+
+
+def _hold(kind, values):
+    if kind == "tuple":
+        return list(map(tuple, values))
+    if kind == "dict":
+        cols = Book._fields
+        return [dict(zip(cols, v)) for v in values]
+    return records(Book, values)
+
+
+def _timed(fn):
+    """Seconds for one call, with the cyclic GC paused as timeit does."""
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        fn()
+        return time.perf_counter() - started
+    finally:
+        gc.enable()
+
+
+def run_records(args):
+    values = _book_values(args.rows)
+    per_million = 10 ** 6 / args.rows
+    print(f"{args.rows:,} books rows, per million rows")
+    print(f"{'held as':<8} | {'memory MB':>9} | {'build ms':>8}")
+    print("-" * 32)
+    for kind in ("tuple", "dict", "record"):
+        best = min(_timed(lambda: _hold(kind, values)) for _ in range(args.repeat))
+        tracemalloc.start()
+        held = _hold(kind, values)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del held
+        print(f"{kind:<8} | {size * per_million / 2 ** 20:>9.1f} | {best * per_million * 1000:>8.1f}")
+    return 0
+
+# -------------------- MONEY --------------------
+
+def float_bill(member_id, member_name, member_type, items, books, discount_pct):
+    """price_bill as it was before lms_money, in float arithmetic. Baseline only."""
+    lines = []
+    for book_id, qty in items:
+        _, title, _, _, price, _ = books[book_id]
+        lines.append(BillLine(book_id, title, qty, float(price), float(price) * qty))
+
+    subtotal = sum(line.line_total for line in lines)
+    vip_extra = 10.0 if member_type == 'VIP' else 0.0
+    total_discount_pct = min(discount_pct + vip_extra, 100.0)
+    discount_amt = subtotal * (total_discount_pct / 100.0)
+    grand_total = max(subtotal - discount_amt, 0.0)
+    return BillReceipt(None, member_id, member_name, member_type, subtotal, total_discount_pct,
+                       discount_amt, grand_total, vip_extra, lines)
+
+
+def run_money(args):
+    rng = random.Random(7)
+    books = {f"M{i}": (f"M{i}", f"Title {i}", None, None, from_paise(rng.randrange(100, 50000)), None)
+             for i in range(args.books)}
+    ids = list(books)
+    bills = [[(rng.choice(ids), 1 if rng.random() < 0.85 else rng.randint(2, 3)) for _ in range(args.lines)]
+             for _ in range(args.items // args.lines)]
+    items = len(bills) * args.lines
+    pct = args.discount
+
+    paths = (("float", float_bill), ("exact", price_bill))
+    times = {path: [] for path, _ in paths}
+    for _ in range(args.repeat):        # interleaved, so both see the same machine
+        for path, price in paths:
+            times[path].append(_timed(lambda: [price(None, None, "Regular", b, books, pct) for b in bills]))
+
+    # a bill is off when the amounts its DECIMAL(10,2) columns end up holding (rounded half up,
+    # as MySQL stores them) don't add up: subtotal != sum of line totals, or subtotal - discount != grand total
+    off, sums = {}, {}
+    for path, price in paths:
+        off[path], sums[path] = 0, ZERO
+        for b in bills:
+            receipt = price(None, None, "Regular", b, books, pct)
+            subtotal, discount_amt, grand_total = map(money, (receipt.subtotal, receipt.discount_amt,
+                                                               receipt.grand_total))
+            off[path] += (subtotal != total(money(line.line_total) for line in receipt.lines)
+                          or subtotal - discount_amt != grand_total)
+            sums[path] += grand_total
+
+    print(f"{items:,} line items in {len(bills):,} bills of {args.lines}, {pct}% discount")
+    print(f"{'path':<6} | {'seconds':>7} | {'ns/item':>7} | {'bills off':>9} | {'grand totals':>14}")
+    print("-" * 58)
+    for path, _ in paths:
+        seconds = min(times[path])
+        print(f"{path:<6} | {seconds:>7.2f} | {seconds / items * 1e9:>7.0f} | {off[path]:>9,} | {sums[path]:>14,}")
+    return 1 if off["exact"] else 0
+
+# -------------------- OVERDUE --------------------
+
+def _seed_open_issues(pool, target, batch=50000):
+    """Top the database up to `target` open issues spread over many members and due dates."""
+    with pool.connection() as con:
+        cur = con.cursor()
+        cur.execute("SELECT COUNT(*) FROM issues WHERE return_date IS NULL")
+        have = cur.fetchone()[0]
+        if have >= target:
+            cur.close()
+            return have
+        need = target - have
+        rng = random.Random(7)
+        prefix = "OD-" + uuid.uuid4().hex[:8] + "-"
+        books = [f"{prefix}{i}" for i in range(100)]
+        cur.executemany("INSERT INTO books (book_id, title, author, category, price, stock) VALUES (%s,%s,%s,%s,%s,%s)",
+                        [(b, "Overdue bench", "Bench", "Bench", 1, 0) for b in books])
+        n_members = max(need // 20, 1)
+        cur.executemany("INSERT INTO members (name, phone, email, membership_type) VALUES (%s,%s,%s,%s)",
+                        [(f"Borrower {i}", "-", None, "VIP" if i % 5 == 0 else "Regular") for i in range(n_members)])
+        cur.execute("SELECT MAX(member_id) FROM members")
+        last = cur.fetchone()[0]
+        first = last - n_members + 1
+        today = datetime.date.today()
+        for done in range(0, need, batch):
+            rows = []
+            for _ in range(min(batch, need - done)):
+                due = today - datetime.timedelta(days=rng.randint(-14, 120))
+                rows.append((rng.randint(first, last), rng.choice(books), due - datetime.timedelta(days=14), due))
+            cur.executemany("INSERT INTO issues (member_id, book_id, issue_date, due_date) VALUES (%s,%s,%s,%s)", rows)
+            con.commit()
+            print(f"  seeded {done + len(rows):,} / {need:,} open issues")
+        cur.close()
+    return target
+
+
+def python_overdue(pool, as_of):
+    """Baseline: fetch every overdue open issue and price it row by row in Python."""
+    totals = {}
+    with pool.connection() as con:
+        cur = con.cursor()
+        cur.execute("""
+            SELECT m.membership_type, i.due_date FROM issues i JOIN members m ON m.member_id = i.member_id
+            WHERE i.return_date IS NULL AND i.due_date < %s
+        """, (as_of,))
+        while True:
+            chunk = cur.fetchmany(10000)
+            if not chunk:
+                break
+            for mtype, due in chunk:
+                n, fee = totals.get(mtype, (0, ZERO))
+                totals[mtype] = (n + 1, fee + fee_for(mtype, (as_of - due).days))
+        cur.close()
+    return totals
+
+
+def run_overdue(args):
+    pool = ConnectionPool(make_backend(), size=2)
+    migrate(pool)
+    open_issues = _seed_open_issues(pool, args.issues)
+    today = datetime.date.today()
+    print(f"{open_issues:,} open issues")
+
+    started = time.perf_counter()
+    baseline = python_overdue(pool, today)
+    t_python = time.perf_counter() - started
+    started = time.perf_counter()
+    summary = overdue_summary(pool, today)
+    t_summary = time.perf_counter() - started
+    stats = snapshot(pool, today)
+
+    for mtype, items, _, total in summary:
+        n, fee = baseline[mtype]
+        assert (n, round(fee, 2)) == (items, round(total, 2)), f"{mtype}: SQL {items}/{total} != Python {n}/{fee}"
+    print(f"{'per-row Python':<22} {t_python:>7.2f}s")
+    print(f"{'set-based summary':<22} {t_summary:>7.2f}s   ({t_python / t_summary:.1f}x)")
+    print(f"{'snapshot':<22} {stats.seconds:>7.2f}s   ({stats.members:,} members, {stats.items:,} overdue, "
+          f"Rs.{stats.accrued_fee:,.2f}, {stats.chunks} chunks)")
+    pool.close()
+    return 0
+
+# -------------------- LOAD --------------------
+# One request = one service call: 40% get_book, 30% a listing page,
+# 30% circulation (return a held copy, or issue one).
+
+def _request(rng, book_ids, held):
+    r = rng.random()
+    if r < 0.3:
+        return ("return", held.pop()) if held else ("issue", rng.choice(book_ids))
+    return ("list", None) if r < 0.6 else ("get", rng.choice(book_ids))
+
+
+def _percentiles(latencies):
+    """(p50, p99) in milliseconds."""
+    if len(latencies) < 2:
+        return (latencies[0] * 1000,) * 2 if latencies else (0.0, 0.0)
+    cuts = statistics.quantiles(latencies, n=100)
+    return cuts[49] * 1000, cuts[98] * 1000
+
+
+def sync_load(svc, member_id, book_ids, clients, requests):
+    """-> (latencies in seconds, errors, elapsed seconds)."""
+    latencies, errors = [], []
+    barrier = threading.Barrier(clients)
+
+    def client(n):
+        rng = random.Random(n)
+        held = []
+        barrier.wait()
+        for _ in range(requests):
+            op, arg = _request(rng, book_ids, held)
+            started = time.perf_counter()
+            try:
+                if op == "issue":
+                    held.append(svc.issue(member_id, arg).issue_id)
+                elif op == "return":
+                    svc.return_issue(arg)
+                elif op == "list":
+                    svc.list_books(limit=20)
+                else:
+                    svc.get_book(arg)
+            except Exception as e:
+                errors.append(repr(e))
+                continue
+            latencies.append(time.perf_counter() - started)
+        for issue_id in held:
+            svc.return_issue(issue_id)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors, time.perf_counter() - started
+
+
+async def async_load(svc, member_id, book_ids, clients, requests):
+    """sync_load with one task per client on a single event loop."""
+    latencies, errors = [], []
+
+    async def client(n):
+        rng = random.Random(n)
+        held = []
+        for _ in range(requests):
+            op, arg = _request(rng, book_ids, held)
+            started = time.perf_counter()
+            try:
+                if op == "issue":
+                    held.append((await svc.issue(member_id, arg)).issue_id)
+                elif op == "return":
+                    await svc.return_issue(arg)
+                elif op == "list":
+                    await svc.list_books(limit=20)
+                else:
+                    await svc.get_book(arg)
+            except Exception as e:
+                errors.append(repr(e))
+                continue
+            latencies.append(time.perf_counter() - started)
+        for issue_id in held:
+            await svc.return_issue(issue_id)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(n) for n in range(clients)))
+    return latencies, errors, time.perf_counter() - started
+
+
+async def _async_round(pool_size, member_id, book_ids, clients, requests):
+    from lms_async import AsyncConnectionPool, AsyncLibraryService, make_async_backend
+    pool = AsyncConnectionPool(make_async_backend(), size=pool_size, timeout=60.0)
+    try:
+        return await async_load(AsyncLibraryService(pool), member_id, book_ids, clients, requests)
+    finally:
+        await pool.close()
+
+
+def run_load(args):
+    client_counts = [int(c) for c in args.clients.split(",")]
+    pool = ConnectionPool(make_backend(), size=args.pool, timeout=60.0)
+    migrate(pool)
+    svc = LibraryService(pool)
+    member_id = svc.add_member("Bench Client", "-", None)
+    book_ids = [_new_book(svc, 10 ** 6) for _ in range(args.books)]
+
+    print(f"{args.requests} requests per client, pool size {args.pool}")
+    print(f"{'mode':>5} | {'clients':>7} | {'req/sec':>9} | {'p50 ms':>8} | {'p99 ms':>8} | errors")
+    print("-" * 60)
+    failed = False
+    for clients in client_counts:
+        rounds = (
+            ("sync", lambda: sync_load(svc, member_id, book_ids, clients, args.requests)),
+            ("async", lambda: asyncio.run(_async_round(args.pool, member_id, book_ids, clients, args.requests))),
+        )
+        for mode, run in rounds:
+            latencies, errors, elapsed = run()
+            p50, p99 = _percentiles(latencies)
+            print(f"{mode:>5} | {clients:>7} | {len(latencies) / elapsed:>9,.0f} | {p50:>8.2f} | {p99:>8.2f} | {len(errors)}")
+            for e in errors[:3]:
+                print(f"        {e}")
+            failed = failed or bool(errors)
+    pool.close()
+    return 1 if failed else 0
+
+# -------------------- HTTP --------------------
+
+SEARCH_WORDS = ("river", "garden", "night", "stone", "empire", "glass", "winter", "shadow",
+                "ocean", "fire", "silver", "crown", "forest", "storm", "iron", "paper")
+
+
+def _seed_catalogue(pool, target):
+    """Top the catalogue up to `target` searchable bench books (titles drawn from SEARCH_WORDS)."""
+    with pool.connection() as con:
+        cur = con.cursor()
+        cur.execute("SELECT COUNT(*) FROM books WHERE category=%s", ("HTTP Bench",))
+        have = cur.fetchone()[0]
+        rng = random.Random(have)
+        prefix = "CAT-" + uuid.uuid4().hex[:8] + "-"
+        rows = [(f"{prefix}{i}", " ".join(rng.sample(SEARCH_WORDS, 3)).title(), rng.choice(SEARCH_WORDS).title(),
+                 "HTTP Bench", 10, 1) for i in range(max(target - have, 0))]
+        cur.executemany("INSERT INTO books (book_id, title, author, category, price, stock) VALUES (%s,%s,%s,%s,%s,%s)", rows)
+        con.commit()
+        cur.close()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_server(port, workers):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lms_http.py")
+    proc = subprocess.Popen([sys.executable, script, "--port", str(port), "--workers", str(workers)],
+                            stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None or time.monotonic() > deadline:
+                proc.kill()
+                raise RuntimeError("lms_http.py did not start")
+            time.sleep(0.1)
+
+
+def http_client(port, scenario, seconds, member_id, book_ids, seed):
+    """One keep-alive client running `scenario` for `seconds` -> (latencies, errors)."""
+    rng = random.Random(seed)
+    con = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    headers = {"Content-Type": "application/json", "Accept-Encoding": "gzip"}
+    latencies, errors = [], []
+
+    def call(method, path, body=None):
+        started = time.perf_counter()
+        con.request(method, path, None if body is None else json.dumps(body), headers)
+        resp = con.getresponse()
+        data = resp.read()
+        latencies.append(time.perf_counter() - started)
+        if resp.status >= 400:
+            errors.append(f"{resp.status} {method} {path}: {data[:100]!r}")
+            return None
+        return data
+
+    stop = time.monotonic() + seconds
+    while time.monotonic() < stop:
+        if scenario == "circulation":
+            data = call("POST", "/issues", {"member_id": member_id, "book_id": rng.choice(book_ids)})
+            if data:
+                call("POST", f"/issues/{json.loads(data)['issue_id']}/return")
+        else:
+            words = rng.sample(SEARCH_WORDS, rng.randint(1, 2))
+            call("GET", "/books/search?" + urlencode({"q": " ".join(words)}))
+    con.close()
+    return latencies, errors
+
+
+def _http_round(port, scenario, clients, seconds, member_id, book_ids):
+    with ProcessPoolExecutor(clients) as ex:
+        futures = [ex.submit(http_client, port, scenario, seconds, member_id, book_ids, n) for n in range(clients)]
+        results = [f.result() for f in futures]
+    return [t for lat, _ in results for t in lat], [e for _, errs in results for e in errs]
+
+
+def run_http(args):
+    client_counts = [int(c) for c in args.clients.split(",")]
+    workers = args.workers or os.cpu_count() or 1
+    pool = ConnectionPool(make_backend(), size=2)
+    migrate(pool)
+    svc = LibraryService(pool)
+    member_id = svc.add_member("HTTP Bench", "-", None)
+    book_ids = [_new_book(svc, 10 ** 6) for _ in range(args.books)]
+    _seed_catalogue(pool, args.catalogue)
+    pool.close()
+
+    port = _free_port()
+    server = _start_server(port, workers)
+    failed = False
+    try:
+        # every worker builds its search index on first use; keep that out of the numbers
+        _http_round(port, "search", workers * 2, 1.0, member_id, book_ids)
+        print(f"{workers} server worker(s), {args.seconds:.0f}s per run, {args.catalogue} catalogue books")
+        print(f"{'scenario':>11} | {'clients':>7} | {'req/sec':>9} | {'p50 ms':>8} | {'p99 ms':>8} | errors")
+        print("-" * 66)
+        for scenario in ("circulation", "search"):
+            for clients in client_counts:
+                latencies, errors = _http_round(port, scenario, clients, args.seconds, member_id, book_ids)
+                p50, p99 = _percentiles(latencies)
+                print(f"{scenario:>11} | {clients:>7} | {len(latencies) / args.seconds:>9,.0f} | {p50:>8.2f} | "
+                      f"{p99:>8.2f} | {len(errors)}")
+                for e in errors[:3]:
+                    print(f"        {e}")
+                failed = failed or bool(errors)
+    finally:
+        server.terminate()
+        server.wait()
+    return 1 if failed else 0
+
+# -------------------- CLI --------------------
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Library load and stress tests (use a scratch database).")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("stress", help="concurrent issue/return on one hot book")
+    p.add_argument("--workers", default="1,2,4,8", help="comma-separated worker counts (default: 1,2,4,8)")
+    p.add_argument("--stock", type=int, default=200, help="copies of the hot book (default: 200)")
+    p.add_argument("--seconds", type=float, default=3.0, help="churn duration per worker count (default: 3)")
+    p.set_defaults(run=run_stress)
+
+    p = sub.add_parser("ledger", help="issues/sec on one hot title, with and without the stock ledger")
+    p.add_argument("--workers", default="1,4,16", help="comma-separated desk counts (default: 1,4,16)")
+    p.add_argument("--stock", type=int, default=10 ** 6, help="copies of the hot title (default: 1,000,000)")
+    p.add_argument("--seconds", type=float, default=3.0, help="duration per run (default: 3)")
+    p.set_defaults(run=run_ledger)
+
+    p = sub.add_parser("bill", help="per-bill latency by number of line items")
+    p.add_argument("--items", default="1,10,100", help="comma-separated line counts (default: 1,10,100)")
+    p.add_argument("--repeat", type=int, default=50, help="bills per measurement (default: 50)")
+    p.set_defaults(run=run_bill)
+
+    p = sub.add_parser("batch", help="items/sec for batch issue/return against one call per book")
+    p.add_argument("--items", default="100,1000,5000", help="comma-separated batch sizes (default: 100,1000,5000)")
+    p.add_argument("--books", type=int, default=200, help="books the loans spread over (default: 200)")
+    p.add_argument("--members", type=int, default=30, help="members the loans spread over (default: 30)")
+    p.set_defaults(run=run_batch)
+
+    p = sub.add_parser("prepared", help="issue/return latency with and without prepared statements")
+    p.add_argument("--pairs", type=int, default=5000, help="issue/return pairs per variant")
+    p.add_argument("--rounds", type=int, default=10, help="alternating rounds the pairs are split into")
+    p.set_defaults(run=run_prepared)
+
+    p = sub.add_parser("cache", help="book cache hit rate by cache size")
+    p.add_argument("--sizes", default="100,1000,10000", help="comma-separated cache sizes (default: 100,1000,10000)")
+    p.add_argument("--books", type=int, default=50000, help="distinct books to draw from (default: 50000)")
+    p.add_argument("--lookups", type=int, default=100000, help="lookups per size (default: 100000)")
+    p.set_defaults(run=run_cache)
+
+    p = sub.add_parser("records", help="memory and build time per million rows: tuple, dict, record")
+    p.add_argument("--rows", type=int, default=10 ** 6, help="rows to build (default: 1,000,000)")
+    p.add_argument("--repeat", type=int, default=3, help="timed builds per kind, best kept (default: 3)")
+    p.set_defaults(run=run_records)
+
+    p = sub.add_parser("money", help="bill pricing, exact Decimal against float, per million line items")
+    p.add_argument("--items", type=int, default=10 ** 6, help="line items to price (default: 1,000,000)")
+    p.add_argument("--lines", type=int, default=10, help="line items per bill (default: 10)")
+    p.add_argument("--books", type=int, default=5000, help="distinct books priced (default: 5000)")
+    p.add_argument("--discount", type=float, default=12.5, help="discount %% on every bill (default: 12.5)")
+    p.add_argument("--repeat", type=int, default=5, help="timed runs per path, best kept (default: 5)")
+    p.set_defaults(run=run_money)
+
+    p = sub.add_parser("overdue", help="overdue summary / snapshot over many open issues")
+    p.add_argument("--issues", type=int, default=1000000, help="open issues to seed up to (default: 1,000,000)")
+    p.set_defaults(run=run_overdue)
+
+    p = sub.add_parser("load", help="p50/p99 latency under many clients, sync vs async service")
+    p.add_argument("--clients", default="10,100,300", help="comma-separated client counts (default: 10,100,300)")
+    p.add_argument("--requests", type=int, default=100, help="requests per client (default: 100)")
+    p.add_argument("--pool", type=int, default=20, help="connections per pool (default: 20)")
+    p.add_argument("--books", type=int, default=50, help="books the clients spread over (default: 50)")
+    p.set_defaults(run=run_load)
+
+    p = sub.add_parser("http", help="requests/sec through the HTTP API (issue/return, search)")
+    p.add_argument("--clients", default="4,16", help="comma-separated client process counts (default: 4,16)")
+    p.add_argument("--seconds", type=float, default=5.0, help="duration per run (default: 5)")
+    p.add_argument("--workers", type=int, help="server worker processes (default: one per core)")
+    p.add_argument("--books", type=int, default=50, help="books the issue/return clients spread over (default: 50)")
+    p.add_argument("--catalogue", type=int, default=20000, help="searchable books to seed up to (default: 20000)")
+    p.set_defaults(run=run_http)
+
+    args = ap.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""
+In-process record cache
+-----------------------
+A bounded LRU map with a per-entry time-to-live, for hot point lookups
+(book and member rows). Writers invalidate the keys they touch; the TTL
+bounds how stale an entry can get when another process changes the row.
+
+    books = LRUCache(maxsize=10000, ttl=60)
+    row = books.get_or_load("B1", lambda: fetch_book("B1"))
+    books.invalidate("B1")
+    books.stats()   # {'size': ..., 'hits': ..., 'misses': ..., 'evictions': ..., ...}
+
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=60.0):
+        if maxsize < 1:
+            raise ValueError("maxsize must be >= 1")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()      # key -> (expires_at, value); most recently used last
+        self._lock = threading.Lock()
+        self._generation = 0            # bumped by every invalidation
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0              # dropped to stay within maxsize
+        self.expirations = 0            # dropped because the TTL ran out
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                if entry[0] > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._data[key]
+                self.expirations += 1
+            self.misses += 1
+            return default
+
+    def put(self, key, value, generation=None):
+        """
+        Store a value. With generation (from generation()) the put is dropped
+        if anything was invalidated since, so a slow load that raced a
+        write can't put the old row back.
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def get_or_load(self, key, load):
+        """Cached value, or load() stored and returned. None results are not cached."""
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        generation = self.generation()
+        value = load()
+        if value is not None:
+            self.put(key, value, generation)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                if self._data.pop(key, _MISSING) is not _MISSING:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,645 @@
+"""
+Storage layer for the Library Management System
+-----------------------------------------------
+Backends:
+  mysql   -> MySQL server via mysql-connector-python (default)
+  sqlite  -> embedded SQLite file, same schema, no server needed
+
+Pick one with DB_BACKEND below or the LMS_BACKEND environment variable.
+All SQL in the app is written MySQL-style with %s placeholders; the SQLite
+backend translates it on the way in.
+
+Hot statements are registered with prepare() where they are defined; each
+pooled connection prepares one the first time it runs it and reuses it
+after (see STATEMENTS below).
+
+"""
+
+import os
+import re
+import time
+import random
+import sqlite3
+import datetime
+import threading
+from decimal import Decimal
+from contextlib import contextmanager
+
+from lms_metrics import METRICS_ENABLED, InstrumentedCursor
+
+try:
+    import mysql.connector as mysql
+except ImportError:
+    mysql = None
+
+# -------------------- CONFIG --------------------
+DB_BACKEND = os.environ.get("LMS_BACKEND", "mysql")   # "mysql" or "sqlite"
+
+DB_CONFIG = {
+    "host": "localhost",
+    "user": "root",          # <-- change if needed
+    "password": "yourpassword",  # <-- change to your MySQL password
+    "database": "librarydb",
+}
+
+SQLITE_PATH = os.environ.get("LMS_SQLITE_PATH", "librarydb.sqlite3")
+
+POOL_CONFIG = {
+    "size": 5,              # max open connections
+    "timeout": 10.0,        # seconds to wait for a free connection
+    "idle_timeout": 300.0,  # close connections idle longer than this
+    "health_check": True,   # ping connections before handing them out
+    "retries": 5,           # times a transaction is re-run after a deadlock / lock timeout
+    "prepared": True,       # run registered statements on cursors prepared once per connection
+}
+
+ALLOWED_TABLES = {"books", "staff", "members", "issues", "bills", "bill_items"}
+
+class PoolTimeout(Exception):
+    """No connection became free within the checkout timeout."""
+
+# -------------------- BACKENDS --------------------
+
+class MySQLBackend:
+    name = "mysql"
+    lock_rows = " FOR UPDATE"   # appended to a SELECT whose rows the transaction goes on to update
+
+    def __init__(self, config=None):
+        self.config = dict(config or DB_CONFIG)
+
+    def connect(self, use_db=True):
+        if mysql is None:
+            raise RuntimeError("mysql-connector-python is not installed. Run: pip install mysql-connector-python")
+        cfg = self.config.copy()
+        if not use_db:
+            cfg.pop("database", None)
+        return mysql.connect(**cfg)
+
+    def create_database(self):
+        con = self.connect(use_db=False)
+        cur = con.cursor()
+        cur.execute(f"CREATE DATABASE IF NOT EXISTS {self.config['database']}")
+        con.commit()
+        cur.close()
+        con.close()
+
+    def ddl(self, statement):
+        return statement
+
+    def upsert_sql(self, table, cols, keys, update_cols):
+        """INSERT that overwrites update_cols when a row with the same keys exists."""
+        placeholders = ", ".join(["%s"] * len(cols))
+        sets = ", ".join(f"{c}=VALUES({c})" for c in update_cols)
+        return f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({placeholders}) ON DUPLICATE KEY UPDATE {sets}"
+
+    def accumulate_sql(self, table, cols, keys, add_cols):
+        """INSERT that adds add_cols onto the existing row's values when the keys already exist."""
+        placeholders = ", ".join(["%s"] * len(cols))
+        sets = ", ".join(f"{c}={c}+VALUES({c})" for c in add_cols)
+        return f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({placeholders}) ON DUPLICATE KEY UPDATE {sets}"
+
+    def days_between_sql(self, later, earlier):
+        """SQL for the whole number of days from date expression earlier to later."""
+        return f"DATEDIFF({later}, {earlier})"
+
+    def prepared_cursor(self, con, statement):
+        """Cursor holding statement as a server-side prepared statement (prepared on its first execute)."""
+        return con.cursor(prepared=True)
+
+    def ping(self, con):
+        try:
+            con.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def begin(self, con):
+        con.start_transaction()
+
+    def is_retryable(self, exc):
+        """Deadlock victim (1213) or lock wait timeout (1205): safe to re-run the transaction."""
+        return getattr(exc, "errno", None) in (1205, 1213)
+
+
+class SQLiteBackend:
+    name = "sqlite"
+    lock_rows = ""              # BEGIN IMMEDIATE already keeps other writers out
+
+    def __init__(self, path=None):
+        self.path = path or SQLITE_PATH
+
+    def connect(self, use_db=True):
+        con = sqlite3.connect(
+            self.path,
+            timeout=30.0,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+        )
+        con.execute("PRAGMA foreign_keys = ON")
+        if self.path != ":memory:":
+            con.execute("PRAGMA journal_mode = WAL")
+            con.execute("PRAGMA synchronous = NORMAL")
+        return SQLiteConnection(con)
+
+    def create_database(self):
+        pass    # the file is created on first connect
+
+    def ddl(self, statement):
+        statement = statement.replace("INT AUTO_INCREMENT PRIMARY KEY", "INTEGER PRIMARY KEY AUTOINCREMENT")
+        return statement.replace(" ENGINE=InnoDB", "")
+
+    def upsert_sql(self, table, cols, keys, update_cols):
+        placeholders = ", ".join(["%s"] * len(cols))
+        sets = ", ".join(f"{c}=excluded.{c}" for c in update_cols)
+        return f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({placeholders}) ON CONFLICT({', '.join(keys)}) DO UPDATE SET {sets}"
+
+    def accumulate_sql(self, table, cols, keys, add_cols):
+        placeholders = ", ".join(["%s"] * len(cols))
+        sets = ", ".join(f"{c}={c}+excluded.{c}" for c in add_cols)
+        return f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({placeholders}) ON CONFLICT({', '.join(keys)}) DO UPDATE SET {sets}"
+
+    def days_between_sql(self, later, earlier):
+        return f"CAST(julianday({later}) - julianday({earlier}) AS INTEGER)"
+
+    def prepared_cursor(self, con, statement):
+        """
+        SQLite has no server to prepare on: the statement is translated once,
+        and sqlite3 keeps it compiled in the connection's statement cache.
+        """
+        return SQLitePreparedCursor(con.raw.cursor(), statement.sqlite)
+
+    def ping(self, con):
+        try:
+            con.raw.execute("SELECT 1").fetchone()
+            return True
+        except Exception:
+            return False
+
+    def begin(self, con):
+        # take the write lock up front; a deferred transaction that later
+        # upgrades to a writer can fail with "database is locked" immediately
+        con.raw.execute("BEGIN IMMEDIATE")
+
+    def is_retryable(self, exc):
+        msg = str(exc)
+        return isinstance(exc, sqlite3.OperationalError) and ("locked" in msg or "busy" in msg)
+
+
+def multirow_insert_sql(table, cols, n_rows):
+    """INSERT of n_rows rows in one statement; params are the rows flattened in order."""
+    row = "(" + ", ".join(["%s"] * len(cols)) + ")"
+    return f"INSERT INTO {table} ({', '.join(cols)}) VALUES " + ", ".join([row] * n_rows)
+
+
+_PLACEHOLDER = re.compile(r"%s")
+_FOR_UPDATE = re.compile(r"\s+FOR\s+UPDATE\b", re.IGNORECASE)
+
+
+def _to_sqlite(sql):
+    """MySQL-style SQL -> SQLite: %s -> ?, drop row locking hints."""
+    return _FOR_UPDATE.sub("", _PLACEHOLDER.sub("?", sql))
+
+
+class SQLiteCursor:
+    """DB-API cursor over sqlite3 that accepts the app's %s placeholders."""
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def execute(self, sql, params=()):
+        self.raw.execute(_to_sqlite(sql), params)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self.raw.executemany(_to_sqlite(sql), seq_of_params)
+        return self
+
+    def fetchone(self):
+        return self.raw.fetchone()
+
+    def fetchmany(self, size=None):
+        return self.raw.fetchmany(size or self.raw.arraysize)
+
+    def fetchall(self):
+        return self.raw.fetchall()
+
+    def close(self):
+        self.raw.close()
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    @property
+    def rowcount(self):
+        return self.raw.rowcount
+
+    @property
+    def lastrowid(self):
+        return self.raw.lastrowid
+
+    @property
+    def description(self):
+        return self.raw.description
+
+
+class SQLitePreparedCursor(SQLiteCursor):
+    """SQLiteCursor that always runs the one statement, already translated."""
+
+    def __init__(self, raw, sql):
+        super().__init__(raw)
+        self.sql = sql
+
+    def execute(self, sql, params=()):
+        self.raw.execute(self.sql, params)
+        return self
+
+
+class SQLiteConnection:
+    def __init__(self, raw):
+        self.raw = raw
+
+    def cursor(self, *args, **kwargs):
+        return SQLiteCursor(self.raw.cursor())
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        self.raw.close()
+
+
+sqlite3.register_adapter(Decimal, str)
+sqlite3.register_adapter(datetime.date, lambda d: d.isoformat())
+sqlite3.register_adapter(datetime.datetime, lambda d: d.isoformat(" ", "seconds"))
+# every DECIMAL column in the schema has scale 2, like MySQL hands them back
+sqlite3.register_converter("DECIMAL", lambda b: Decimal(b.decode()).quantize(Decimal("0.01")))
+sqlite3.register_converter("DATE", lambda b: datetime.date.fromisoformat(b.decode()))
+sqlite3.register_converter("DATETIME", lambda b: datetime.datetime.fromisoformat(b.decode()))
+
+
+def make_backend(name=None):
+    name = name or DB_BACKEND
+    if name == "mysql":
+        return MySQLBackend()
+    if name == "sqlite":
+        return SQLiteBackend()
+    raise ValueError(f"Unknown backend: {name}")
+
+# -------------------- STATEMENTS --------------------
+# The module that owns a hot statement registers it where it is defined:
+#     BOOK_SQL = prepare("SELECT ... FROM books WHERE book_id=%s")
+# prepare() hands the text straight back, so the constant still works
+# anywhere SQL does (lms_async, EXPLAIN in lms_migrations). A pooled
+# connection runs a registered statement on a cursor of its own for it,
+# prepared the first time that connection runs it and reused after.
+# Register only statements with a fixed text and a small result (point
+# lookups and single-row writes); the result is read in full at once.
+
+class Statement:
+    __slots__ = ("sql", "sqlite", "executions", "prepares")
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.sqlite = _to_sqlite(sql)
+        self.executions = 0     # runs on a prepared cursor, all connections
+        self.prepares = 0       # times a connection prepared it (again after an error)
+
+
+class StatementRegistry:
+    """The registered statements, by SQL text, with their execution counts."""
+
+    def __init__(self):
+        self._by_sql = {}
+        self._lock = threading.Lock()
+
+    def register(self, sql):
+        statement = self._by_sql.get(sql)
+        if statement is not None:
+            return statement
+        with self._lock:
+            statement = self._by_sql.get(sql)
+            if statement is None:
+                statement = self._by_sql[sql] = Statement(sql)
+            return statement
+
+    def get(self, sql):
+        return self._by_sql.get(sql)
+
+    def executed(self, statement):
+        with self._lock:
+            statement.executions += 1
+
+    def prepared(self, statement):
+        with self._lock:
+            statement.prepares += 1
+
+    def stats(self):
+        """[{"sql", "executions", "prepares"}] for every registered statement, busiest first."""
+        with self._lock:
+            rows = [{"sql": " ".join(st.sql.split()), "executions": st.executions, "prepares": st.prepares}
+                    for st in self._by_sql.values()]
+        return sorted(rows, key=lambda r: -r["executions"])
+
+    def reset(self):
+        """Zero the execution counts (statements stay prepared where they are)."""
+        with self._lock:
+            for st in self._by_sql.values():
+                st.executions = 0
+
+
+STATEMENTS = StatementRegistry()
+
+
+def prepare(sql):
+    """Register sql as a hot statement; returns sql unchanged."""
+    STATEMENTS.register(sql)
+    return sql
+
+
+class StatementCursor:
+    """
+    Cursor of a pooled connection. A registered statement runs on the
+    connection's prepared cursor for it and its rows are read at once, so
+    that cursor is free for the next run; anything else runs on a plain
+    cursor, opened on first use.
+    """
+
+    def __init__(self, con):
+        self._con = con
+        self._plain = None
+        self._cur = None
+        self._rows = None
+
+    def _plain_cursor(self):
+        if self._plain is None:
+            self._plain = self._con.raw.cursor()
+        return self._plain
+
+    def execute(self, sql, params=()):
+        statement = STATEMENTS.get(sql)
+        self._rows = None
+        if statement is None:
+            self._cur = self._plain_cursor()
+            self._cur.execute(sql, params)
+            return self
+        self._cur = cur = self._con.prepared_cursor(statement)
+        try:
+            cur.execute(sql, params)
+            if cur.description is not None:
+                self._rows = iter(cur.fetchall())
+        except Exception:
+            self._con.unprepare(statement)
+            raise
+        STATEMENTS.executed(statement)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._rows = None
+        self._cur = self._plain_cursor()
+        self._cur.executemany(sql, seq_of_params)
+        return self
+
+    def fetchone(self):
+        if self._rows is None:
+            return self._cur.fetchone()
+        return next(self._rows, None)
+
+    def fetchmany(self, size=None):
+        if self._rows is None:
+            return self._cur.fetchmany(size) if size else self._cur.fetchmany()
+        return [row for _, row in zip(range(size or 1), self._rows)]
+
+    def fetchall(self):
+        return self._cur.fetchall() if self._rows is None else list(self._rows)
+
+    def __iter__(self):
+        return iter(self._cur) if self._rows is None else self._rows
+
+    def close(self):
+        # the prepared cursors stay open with the connection
+        if self._plain is not None:
+            self._plain.close()
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cur.lastrowid
+
+    @property
+    def description(self):
+        return self._cur.description if self._cur is not None else None
+
+# -------------------- POOL --------------------
+
+class PooledConnection:
+    """
+    Checked-out connection. close() hands it back to the pool instead of
+    closing it; its cursors are timed by lms_metrics unless LMS_METRICS=0,
+    and run registered statements on its prepared cursors if the pool
+    prepares them.
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self.raw = raw
+        self.last_used = time.monotonic()
+        self.broken = False
+        self._prepared = {}     # Statement -> cursor prepared on this connection
+
+    def cursor(self, *args, **kwargs):
+        if self._pool.prepared and not args and not kwargs:
+            cur = StatementCursor(self)
+        else:
+            cur = self.raw.cursor(*args, **kwargs)
+        return InstrumentedCursor(cur) if METRICS_ENABLED else cur
+
+    def prepared_cursor(self, statement):
+        cur = self._prepared.get(statement)
+        if cur is None:
+            cur = self._prepared[statement] = self._pool.backend.prepared_cursor(self.raw, statement)
+            STATEMENTS.prepared(statement)
+        return cur
+
+    def unprepare(self, statement):
+        """Drop statement's prepared cursor after an error; the next run prepares it again."""
+        cur = self._prepared.pop(statement, None)
+        if cur is not None:
+            try:
+                cur.close()
+            except Exception:
+                pass
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        self._pool.release(self)
+
+
+class ConnectionPool:
+    """
+    Bounded pool. At most `size` connections exist at once; checkout waits up
+    to `timeout` seconds for one to come back, then raises PoolTimeout.
+    Connections idle longer than `idle_timeout` are closed on the next
+    checkout, and (optionally) each one is pinged before it is handed out.
+    """
+
+    def __init__(self, backend, size=None, timeout=None, idle_timeout=None, health_check=None, prepared=None):
+        self.backend = backend
+        self.size = size or POOL_CONFIG["size"]
+        self.timeout = POOL_CONFIG["timeout"] if timeout is None else timeout
+        self.idle_timeout = POOL_CONFIG["idle_timeout"] if idle_timeout is None else idle_timeout
+        self.health_check = POOL_CONFIG["health_check"] if health_check is None else health_check
+        self.retries = POOL_CONFIG["retries"]
+        self.prepared = POOL_CONFIG["prepared"] if prepared is None else prepared
+        self._idle = []                 # LIFO: most recently used on top
+        self._open = 0
+        self._lock = threading.Condition()
+        self._closed = False
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        keep = []
+        for pc in self._idle:
+            if now - pc.last_used > self.idle_timeout:
+                self._discard(pc)
+            else:
+                keep.append(pc)
+        self._idle = keep
+
+    def _discard(self, pc):
+        self._open -= 1
+        try:
+            pc.raw.close()
+        except Exception:
+            pass
+
+    def acquire(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError("Pool is closed")
+                self._evict_idle()
+                pc = None
+                if self._idle:
+                    pc = self._idle.pop()
+                elif self._open < self.size:
+                    self._open += 1
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(f"No free connection after {timeout:.1f}s (pool size {self.size})")
+                    self._lock.wait(remaining)
+                    continue
+
+            if pc is None:
+                try:
+                    return PooledConnection(self, self.backend.connect())
+                except Exception:
+                    with self._lock:
+                        self._open -= 1
+                        self._lock.notify()
+                    raise
+            if self.health_check and not self.backend.ping(pc.raw):
+                with self._lock:
+                    self._discard(pc)
+                    self._lock.notify()
+                continue
+            return pc
+
+    def release(self, pc):
+        if not pc.broken:
+            try:
+                pc.raw.rollback()   # never hand out a half-finished transaction
+            except Exception:
+                pc.broken = True
+        with self._lock:
+            if pc.broken or self._closed:
+                self._discard(pc)
+            else:
+                pc.last_used = time.monotonic()
+                self._idle.append(pc)
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        pc = self.acquire(timeout)
+        try:
+            yield pc
+        except Exception:
+            try:
+                pc.rollback()
+            except Exception:
+                pc.broken = True
+            raise
+        finally:
+            pc.close()
+
+    def run_in_transaction(self, work, retries=None):
+        """
+        Call work(cur) inside one explicit transaction and commit. Any
+        exception rolls it back; deadlocks and lock timeouts re-run work from
+        the start (with a short randomized backoff) up to `retries` times.
+        Returns whatever work returns.
+        """
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            try:
+                with self.connection() as con:
+                    cur = con.cursor()
+                    try:
+                        self.backend.begin(con.raw)
+                        result = work(cur)
+                        con.commit()
+                        return result
+                    finally:
+                        cur.close()
+            except Exception as e:
+                if attempt >= retries or not self.backend.is_retryable(e):
+                    raise
+            attempt += 1
+            time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+
+    def stats(self):
+        with self._lock:
+            return {"size": self.size, "open": self._open, "idle": len(self._idle)}
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for pc in self._idle:
+                self._discard(pc)
+            self._idle = []
+            self._lock.notify_all()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool(make_backend())
+        return _default_pool
+
+
+def get_connection(use_db=True):
+    """Pooled connection (close() returns it). use_db=False gives a raw server connection."""
+    if not use_db:
+        return make_backend().connect(use_db=False)
+    return get_pool().acquire()
+
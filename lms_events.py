@@ -0,0 +1,605 @@
+"""
+Mutation event log
+------------------
+Every write the services make (books, staff, members, issues, returns,
+bills, imports) is also appended to an append-only log of binary-framed
+events, so other systems can follow the changes (change data capture)
+and derived state can be rebuilt without going back to the database:
+
+    python lms_events.py baseline            # once: the database as it is now
+    python lms_events.py replay --rollups    # rebuild the rollup tables from the log
+    python lms_events.py tail -n 20          # the last events, as JSON lines
+
+Set LMS_EVENT_LOG to a directory to turn it on for LibraryService and
+AsyncLibraryService (LMS01, lms_http, ...).
+
+The log is a directory of segment files, events-<first lsn>.log, each
+MAGIC and then records:
+
+    HEADER (payload length, crc32, lsn, unix time, kind) + JSON array payload
+
+lsn numbers the events 1, 2, 3, ... with no gaps; the payload holds the
+values of FIELDS[kind] in order. A segment past SEGMENT_BYTES is closed
+and the next one started.
+
+Events are appended after the transaction they describe commits (they
+carry the ids the database gave out), by a flusher thread per process
+that writes whatever has queued up since its last write and then makes
+one fsync for all of it (group commit). With LMS_EVENT_SYNC=group (the
+default) a mutation returns only once its event is on disk; with
+"interval" it doesn't wait and the flusher syncs every INTERVAL seconds,
+so a crash can lose the last INTERVAL of events. Processes sharing a
+directory (the lms_http workers) take turns with flock, and a record
+torn by a crash mid-write is cut off by the next writer.
+
+The log only knows what happened since it was started. `baseline`
+appends the current catalogue, members, staff and rollups as events after
+a reset marker, and replay starts over from the last marker, so a log
+begun on a database that already had data replays to the same state.
+Take a baseline while the desks are quiet, as for a rollup rebuild.
+
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import fcntl
+import struct
+import atexit
+import argparse
+import datetime
+import threading
+from decimal import Decimal
+from collections import deque
+from concurrent.futures import Future
+
+from lms_export import stream_rows
+from lms_import import BOOK_COLS
+from lms_money import money
+from lms_records import Book, Member, records
+from lms_rollups import BILL_KEYS, BILL_SUMS, ISSUE_KEYS, ISSUE_SUMS, RollupTotals, write_rollups
+from lms_search import SearchIndex
+
+EVENT_LOG_DIR = os.environ.get("LMS_EVENT_LOG", "")     # empty: no event log
+SYNC_MODE = os.environ.get("LMS_EVENT_SYNC", "group")
+SYNC_MODES = ("group", "interval")
+INTERVAL = 0.05                 # seconds between fsyncs with sync="interval"
+SEGMENT_BYTES = 64 * 1024 * 1024
+BASELINE_CHUNK = 10000          # rows per books_imported event in a baseline
+READ_BYTES = 1 << 20
+
+MAGIC = b"LMSEVT1\n"
+HEADER = struct.Struct("<IIQdB")     # payload length, crc32 of everything after it, lsn, time, kind
+LOCK_FILE = "events.lock"
+
+BOOK_FIELDS = ("book_id", "title", "author", "category", "price", "stock")
+STAFF_FIELDS = ("staff_id", "name", "role", "phone")
+MEMBER_FIELDS = ("member_id", "name", "phone", "email", "membership_type")
+
+# the kind byte on disk is the position in this list: only ever append to it
+FIELDS = {
+    "baseline": (),
+    "book_added": BOOK_FIELDS,
+    "book_updated": BOOK_FIELDS,
+    "book_deleted": ("book_id",),
+    "books_imported": ("rows", "update_stock"),
+    "staff_added": STAFF_FIELDS,
+    "staff_updated": STAFF_FIELDS,
+    "staff_deleted": ("staff_id",),
+    "member_added": MEMBER_FIELDS,
+    "member_updated": MEMBER_FIELDS,
+    "member_deleted": ("member_id",),
+    "book_issued": ("issue_id", "member_id", "book_id", "issue_date", "due_date"),
+    "book_returned": ("issue_id", "book_id", "return_date", "late_fee"),
+    "bill_created": ("bill_id", "member_id", "membership_type", "bill_date", "subtotal", "discount_pct",
+                     "discount_amt", "grand_total", "lines"),    # lines: [[book_id, qty, unit_price, line_total]]
+    "rollups_loaded": ("bill_rollups", "issue_rollups"),
+}
+KINDS = list(FIELDS)
+CODES = {kind: code for code, kind in enumerate(KINDS)}
+
+# what each kind of derived state needs replayed; the other kinds are skipped without decoding them
+_CIRCULATION = ("book_issued", "book_returned", "bill_created")
+TARGETS = {
+    "catalogue": ("baseline", "book_added", "book_updated", "book_deleted", "books_imported") + _CIRCULATION,
+    "people": ("baseline", "member_added", "member_updated", "member_deleted", "staff_added", "staff_updated",
+               "staff_deleted"),
+    "rollups": ("baseline", "rollups_loaded") + _CIRCULATION,
+}
+
+
+def _default(o):
+    if isinstance(o, (datetime.date, datetime.datetime, datetime.time)):
+        return o.isoformat()
+    if isinstance(o, Decimal):
+        return str(o)               # exact; replay reads it back with money()
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+
+def encode(lsn, ts, code, payload):
+    """One framed record."""
+    body = HEADER.pack(len(payload), 0, lsn, ts, code)[8:] + payload
+    return HEADER.pack(len(payload), zlib.crc32(body), lsn, ts, code)[:8] + body
+
+
+def segment_name(first_lsn):
+    return f"events-{first_lsn:020d}.log"
+
+
+def segments(directory):
+    """[(first lsn, path)] of the segments in directory, oldest first."""
+    found = []
+    for name in os.listdir(directory) if os.path.isdir(directory) else ():
+        if name.startswith("events-") and name.endswith(".log"):
+            found.append((int(name[7:-4]), os.path.join(directory, name)))
+    return sorted(found)
+
+
+def scan(f, offset):
+    """
+    Yield (lsn, time, code, payload, end offset) for the records of an open
+    segment from offset on. Stops quietly at the end or at a torn / corrupt
+    record; the caller compares the last end offset with the file size.
+    """
+    f.seek(offset)
+    buf, pos = b"", 0
+    while True:
+        if len(buf) - pos < HEADER.size or len(buf) - pos < HEADER.size + HEADER.unpack_from(buf, pos)[0]:
+            more = f.read(READ_BYTES)
+            if not more:
+                return
+            buf, offset, pos = buf[pos:] + more, offset + pos, 0
+            continue
+        length, crc, lsn, ts, code = HEADER.unpack_from(buf, pos)
+        end = pos + HEADER.size + length
+        if zlib.crc32(buf[pos + 8:end]) != crc:
+            return
+        yield lsn, ts, code, buf[pos + HEADER.size:end], offset + end
+        pos = end
+
+# -------------------- WRITING --------------------
+
+class EventLog:
+    """
+    The writing end of a log directory. append() is safe from any thread;
+    one flusher thread per process does the writes and fsyncs.
+    """
+
+    def __init__(self, directory, sync=SYNC_MODE, interval=INTERVAL, segment_bytes=SEGMENT_BYTES):
+        if sync not in SYNC_MODES:
+            raise ValueError(f"sync must be one of: {', '.join(SYNC_MODES)}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.sync = sync
+        self.interval = interval
+        self.segment_bytes = segment_bytes
+        self._cond = threading.Condition()
+        self._pending = []          # (code, time, payload, Future)
+        self._closed = False
+        self._thread = None
+        self._pid = None
+        self._lock_fd = None
+        self._fd = None             # the segment being appended to, with its first lsn and size
+        self._first = self._offset = 0
+        self.last_lsn = 0
+        self.records = self.fsyncs = self.bytes = 0
+
+    def submit(self, kind, values):
+        """Queue an event; the Future resolves to its lsn once it is written and synced."""
+        if kind not in CODES:
+            raise ValueError(f"Unknown event kind: {kind}")
+        payload = json.dumps(values, separators=(",", ":"), default=_default).encode("utf-8")
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("The event log is closed.")
+            if self._pid != os.getpid():    # first use, or in a forked worker: the thread didn't come along
+                self._start()
+            self._pending.append((CODES[kind], time.time(), payload, future))
+            self._cond.notify()
+        return future
+
+    def append(self, kind, values):
+        """Log an event: with sync="group" wait until it is durable and return its lsn."""
+        future = self.submit(kind, values)
+        return future.result() if self.sync == "group" else None
+
+    def append_many(self, events):
+        """Log [(kind, values)] together (one fsync for the lot); with sync="group" wait for all of them."""
+        futures = [self.submit(kind, values) for kind, values in events]
+        if self.sync == "group":
+            for future in futures:
+                future.result()
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._fd = self._lock_fd = None
+        self._thread = threading.Thread(target=self._run, name="lms-events", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+            if self.sync == "interval" and not self._closed:
+                time.sleep(self.interval)
+            with self._cond:
+                batch, self._pending = self._pending, []
+            try:
+                first, last = self._write(batch)
+            except Exception as e:
+                for *_, future in batch:
+                    future.set_exception(e)
+                continue
+            for lsn, (*_, future) in zip(range(first, last + 1), batch):
+                future.set_result(lsn)
+
+    def _write(self, batch):
+        """Write and fsync a batch under the directory lock. Returns its (first, last) lsn."""
+        if self._lock_fd is None:
+            self._lock_fd = os.open(os.path.join(self.directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            self._catch_up()
+            if self._offset >= self.segment_bytes:
+                self._new_segment(self.last_lsn + 1)
+            data = bytearray()
+            lsn = self.last_lsn
+            for code, ts, payload, _ in batch:
+                lsn += 1
+                data += encode(lsn, ts, code, payload)
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self._fd, view):]
+            os.fsync(self._fd)
+            first, self.last_lsn = self.last_lsn + 1, lsn
+            self._offset += len(data)
+            self.records += len(batch)
+            self.bytes += len(data)
+            self.fsyncs += 1
+            return first, lsn
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _catch_up(self):
+        """Find the end of the log: another process may have written or started a segment since."""
+        found = segments(self.directory)
+        if not found:
+            self._new_segment(1)
+            return
+        first, path = found[-1]
+        if self._fd is None or first != self._first:
+            if self._fd is not None:
+                os.close(self._fd)
+            self._fd = os.open(path, os.O_RDWR)
+            self._first, self._offset, self.last_lsn = first, len(MAGIC), first - 1
+        size = os.fstat(self._fd).st_size
+        if size != self._offset:
+            with open(path, "rb") as f:
+                for lsn, _, _, _, end in scan(f, self._offset):
+                    self.last_lsn, self._offset = lsn, end
+            if size != self._offset:        # a writer died mid-record: cut it off
+                os.ftruncate(self._fd, self._offset)
+        os.lseek(self._fd, self._offset, os.SEEK_SET)
+
+    def _new_segment(self, first):
+        if self._fd is not None:
+            os.close(self._fd)
+        path = os.path.join(self.directory, segment_name(first))
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.write(self._fd, MAGIC)
+        os.fsync(self._fd)
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self._first, self._offset, self.last_lsn = first, len(MAGIC), first - 1
+
+    def flush(self):
+        """Wait until everything appended so far is on disk."""
+        with self._cond:
+            pending = [future for *_, future in self._pending]
+        for future in pending:
+            future.exception()
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread if self._pid == os.getpid() else None
+        if thread is not None:
+            thread.join()
+        for fd in (self._fd, self._lock_fd):
+            if fd is not None and self._pid == os.getpid():
+                os.close(fd)
+        self._fd = self._lock_fd = None
+
+    def stats(self):
+        return {"directory": self.directory, "sync": self.sync, "last_lsn": self.last_lsn,
+                "records": self.records, "fsyncs": self.fsyncs, "bytes": self.bytes}
+
+
+_logs = {}
+_logs_lock = threading.Lock()
+
+
+def open_log(directory=None, sync=None):
+    """
+    The process-wide EventLog for directory (default LMS_EVENT_LOG), or None
+    if there is none configured. Closed (flushed) at exit.
+    """
+    directory = directory or EVENT_LOG_DIR
+    if not directory:
+        return None
+    with _logs_lock:
+        log = _logs.get(directory)
+        if log is None:
+            log = _logs[directory] = EventLog(directory, sync or SYNC_MODE)
+            atexit.register(log.close)
+        return log
+
+# -------------------- READING --------------------
+
+class Event:
+    __slots__ = ("lsn", "time", "kind", "values")
+
+    def __init__(self, lsn, ts, kind, values):
+        self.lsn, self.time, self.kind, self.values = lsn, ts, kind, values
+
+    @property
+    def data(self):
+        return dict(zip(FIELDS[self.kind], self.values))
+
+    def to_json(self):
+        return json.dumps({"lsn": self.lsn, "time": self.time, "kind": self.kind, **self.data})
+
+
+def read_events(directory, after=0, kinds=None):
+    """
+    Yield the Events with lsn > after, oldest first, optionally only the
+    given kinds (the others are skipped without decoding). A torn record at
+    the very end (a write in progress or cut short) ends the log; anywhere
+    else it is a ValueError.
+    """
+    wanted = None if kinds is None else {CODES[k] for k in kinds}
+    found = segments(directory)
+    for i, (first, path) in enumerate(found):
+        if i + 1 < len(found) and found[i + 1][0] <= after + 1:
+            continue            # all of it is at or below after
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"Not an event log segment: {path}")
+            end = len(MAGIC)
+            for lsn, ts, code, payload, end in scan(f, len(MAGIC)):
+                if lsn > after and (wanted is None or code in wanted):
+                    yield Event(lsn, ts, KINDS[code], json.loads(payload))
+            if i + 1 < len(found) and end != os.fstat(f.fileno()).st_size:
+                raise ValueError(f"Corrupt record in {path} at byte {end}")
+
+# -------------------- REPLAY --------------------
+
+def _date(v):
+    return datetime.date.fromisoformat(v[:10])
+
+
+class Replay:
+    """
+    Derived state rebuilt from the log: the catalogue (with stock), members,
+    staff and the rollup totals, ready to become a search index, warm
+    caches or the rollup tables. targets (TARGETS keys) limits it to what
+    is needed.
+    """
+
+    def __init__(self, targets=tuple(TARGETS)):
+        unknown = [t for t in targets if t not in TARGETS]
+        if unknown:
+            raise ValueError(f"Unknown replay target: {', '.join(unknown)}")
+        self.kinds = sorted({kind for t in targets for kind in TARGETS[t]})
+        self._handlers = {kind: getattr(self, "_" + kind) for kind in KINDS}
+        self.last_lsn = 0
+        self.events = 0
+        self.reset()
+
+    def reset(self):
+        self.books = {}         # book_id -> [title, author, category, price, stock]
+        self.members = {}       # member_id -> (name, phone, email, membership_type)
+        self.staff = {}         # staff_id -> (name, role, phone)
+        self.rollups = RollupTotals()
+
+    def run(self, directory, after=0):
+        """Apply the events after `after` (and after the last baseline). Returns self."""
+        for event in read_events(directory, after, self.kinds):
+            self.apply(event)
+        return self
+
+    def apply(self, event):
+        self._handlers[event.kind](*event.values)
+        self.last_lsn = event.lsn
+        self.events += 1
+
+    def _baseline(self):
+        self.reset()
+
+    def _book_added(self, book_id, title, author, category, price, stock):
+        self.books[book_id] = [title, author, category, money(price), stock]
+
+    _book_updated = _book_added
+
+    def _book_deleted(self, book_id):
+        self.books.pop(book_id, None)
+
+    def _books_imported(self, rows, update_stock):
+        for book_id, title, author, category, price, stock in rows:
+            old = self.books.get(book_id)
+            self.books[book_id] = [title, author, category, money(price),
+                                   stock if old is None or update_stock else old[4]]
+
+    def _staff_added(self, staff_id, name, role, phone):
+        self.staff[staff_id] = (name, role, phone)
+
+    _staff_updated = _staff_added
+
+    def _staff_deleted(self, staff_id):
+        self.staff.pop(staff_id, None)
+
+    def _member_added(self, member_id, name, phone, email, membership_type):
+        self.members[member_id] = (name, phone, email, membership_type)
+
+    _member_updated = _member_added
+
+    def _member_deleted(self, member_id):
+        self.members.pop(member_id, None)
+
+    def _restock(self, book_id, qty):
+        book = self.books.get(book_id)
+        if book is not None:
+            book[4] += qty
+
+    def _book_issued(self, issue_id, member_id, book_id, issue_date, due_date):
+        self._restock(book_id, -1)
+        self.rollups.add_issues(_date(issue_date), 1)
+
+    def _book_returned(self, issue_id, book_id, return_date, late_fee):
+        self._restock(book_id, 1)
+        self.rollups.add_returns(_date(return_date), 1, late_fee)
+
+    def _bill_created(self, bill_id, member_id, membership_type, bill_date, subtotal, discount_pct,
+                      discount_amt, grand_total, lines):
+        for book_id, qty, _, _ in lines:
+            self._restock(book_id, -qty)
+        self.rollups.add_bills(_date(bill_date), membership_type, 1, subtotal, discount_amt, grand_total)
+
+    def _rollups_loaded(self, bill_rows, issue_rows):
+        self.rollups = RollupTotals()
+        for grain, period, mtype, bills, *amounts in bill_rows:
+            self.rollups.bills[(grain, _date(period), mtype)] = [bills, *map(money, amounts)]
+        for grain, period, issues, returns, late_fees in issue_rows:
+            self.rollups.issues[(grain, _date(period))] = [issues, returns, money(late_fees)]
+
+    # ---- derived state ----
+
+    def book_rows(self):
+        """(book_id, title, author, category, price, stock) rows, as BOOK_SQL returns them."""
+        return [(book_id, *book) for book_id, book in self.books.items()]
+
+    def search_index(self):
+        idx = SearchIndex()
+        idx.add_many((book_id, title, author, category) for book_id, (title, author, category, _, _)
+                     in self.books.items())
+        return idx
+
+    def prime(self, service):
+        """Fill the service's book and member caches, up to their size."""
+        for cache, rows in ((service.book_cache, records(Book, self.book_rows())),
+                            (service.member_cache, [Member(m, *r) for m, r in self.members.items()])):
+            generation = cache.generation()
+            for row in rows[-cache.maxsize:]:
+                cache.put(row[0], row, generation)
+
+    def write_rollups(self, pool):
+        """Replace the rollup tables with the replayed totals. Returns rows written."""
+        return pool.run_in_transaction(lambda cur: write_rollups(cur, self.rollups))
+
+
+def replay(directory, after=0, targets=tuple(TARGETS)):
+    """A Replay of the log in directory."""
+    return Replay(targets).run(directory, after)
+
+# -------------------- BASELINE --------------------
+
+def _query(pool, sql):
+    with pool.connection() as con:
+        for _, chunk in stream_rows(con, sql, (), BASELINE_CHUNK):
+            yield chunk
+
+
+def baseline(pool, log):
+    """
+    Append the database as it is now: a baseline marker, then the books,
+    members, staff and rollup rows. Returns the number of events written.
+    """
+    futures = [log.submit("baseline", [])]
+    for chunk in _query(pool, f"SELECT {', '.join(BOOK_COLS)} FROM books ORDER BY book_id"):
+        futures.append(log.submit("books_imported", [chunk, True]))
+    for chunk in _query(pool, f"SELECT {', '.join(MEMBER_FIELDS)} FROM members ORDER BY member_id"):
+        futures.extend(log.submit("member_added", row) for row in chunk)
+    for chunk in _query(pool, f"SELECT {', '.join(STAFF_FIELDS)} FROM staff ORDER BY staff_id"):
+        futures.extend(log.submit("staff_added", row) for row in chunk)
+    rollups = [[row for chunk in _query(pool, f"SELECT {', '.join(keys + sums)} FROM {table}") for row in chunk]
+               for table, keys, sums in (("bill_rollups", BILL_KEYS, BILL_SUMS),
+                                         ("issue_rollups", ISSUE_KEYS, ISSUE_SUMS))]
+    futures.append(log.submit("rollups_loaded", rollups))
+    for future in futures:
+        future.result()
+    return len(futures)
+
+# -------------------- CLI --------------------
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="The mutation event log: baseline, replay and tail.")
+    ap.add_argument("--dir", default=EVENT_LOG_DIR, help="log directory (default: $LMS_EVENT_LOG)")
+    sub = ap.add_subparsers(dest="command", required=True)
+    sub.add_parser("baseline", help="append the database as it is now")
+    p = sub.add_parser("replay", help="rebuild derived state from the log")
+    p.add_argument("--targets", default=",".join(TARGETS), help=f"comma-separated (default: {','.join(TARGETS)})")
+    p.add_argument("--rollups", action="store_true", help="write the replayed totals to the rollup tables")
+    p = sub.add_parser("tail", help="print events as JSON lines")
+    p.add_argument("-n", type=int, default=20, help="the last n events (default: 20)")
+    p.add_argument("--after", type=int, help="every event after this lsn instead")
+    args = ap.parse_args(argv)
+
+    if not args.dir:
+        print("No log directory: set LMS_EVENT_LOG or pass --dir.")
+        return 1
+    if args.command == "tail":
+        if args.after is not None:
+            events = read_events(args.dir, args.after)
+        else:
+            found = segments(args.dir)      # the last two segments hold the last n unless n is huge
+            events = deque(read_events(args.dir, found[-2][0] - 1 if len(found) > 1 else 0), maxlen=args.n)
+        for event in events:
+            print(event.to_json())
+        return 0
+
+    from lms_db import get_pool
+    pool = get_pool()
+    try:
+        started = time.perf_counter()
+        if args.command == "baseline":
+            log = EventLog(args.dir)
+            try:
+                written = baseline(pool, log)
+            finally:
+                log.close()
+            print(f"Appended {written} baseline events (last lsn {log.last_lsn}) "
+                  f"in {time.perf_counter() - started:.2f}s.")
+            return 0
+        targets = [t.strip() for t in args.targets.split(",")]
+        if args.rollups and "rollups" not in targets:
+            targets.append("rollups")
+        try:
+            state = replay(args.dir, targets=targets)
+        except ValueError as e:
+            print(e)
+            return 1
+        print(f"Replayed {state.events:,} events to lsn {state.last_lsn}: {len(state.books):,} books, "
+              f"{len(state.members):,} members, {len(state.staff):,} staff, "
+              f"{len(state.rollups.bills) + len(state.rollups.issues):,} rollup rows "
+              f"in {time.perf_counter() - started:.2f}s.")
+        if args.rollups:
+            print(f"Wrote {state.write_rollups(pool)} rollup rows.")
+        return 0
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,334 @@
+"""
+Streaming CSV exports
+---------------------
+Rows are fetched in chunks (fetchmany on an unbuffered cursor) and written
+as they arrive, so memory stays flat however large the table is. Output is
+gzipped on the fly when the filename ends in .gz (or compress=True).
+
+Exports run in key order, so an interrupted export can be resumed with
+after=<last key written>: only rows with a larger key are fetched and they
+are appended to the existing file.
+
+The detailed issue / bill exports can also run in parallel (workers=N): the
+key range, or the history by month (by="month"), is cut into partitions
+that a process pool exports concurrently, each worker with its own
+connection, writing its own part file (and gzip stream). The parts are then
+stitched into the one file in partition order (concatenated gzip members
+are a valid gzip file, so compressed parts are joined as bytes), or kept as
+a sharded set with sharded=True: name-00001-of-00016.csv and so on, each with
+its header.
+
+"""
+
+import io
+import os
+import csv
+import gzip
+import time
+import shutil
+import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+
+try:
+    import resource
+except ImportError:     # not available on Windows
+    resource = None
+
+from lms_db import ALLOWED_TABLES, ConnectionPool
+
+CHUNK_SIZE = 5000
+PARTITIONS_PER_WORKER = 4   # more partitions than workers, so gaps in the key range even out
+
+TABLE_KEYS = {
+    "books": "book_id",
+    "staff": "staff_id",
+    "members": "member_id",
+    "issues": "issue_id",
+    "bills": "bill_id",
+    "bill_items": "item_id",
+}
+
+ISSUES_DETAILED_SQL = """
+    SELECT i.issue_id,
+           m.member_id, m.name AS member_name, m.membership_type,
+           b.book_id, b.title AS book_title,
+           i.issue_date, i.due_date, i.return_date, i.late_fee
+    FROM issues i
+    JOIN members m ON m.member_id = i.member_id
+    JOIN books b   ON b.book_id   = i.book_id
+    {where}
+    ORDER BY i.issue_id
+"""
+ISSUES_DETAILED_COLS = ["issue_id","member_id","member_name","membership_type","book_id","book_title","issue_date","due_date","return_date","late_fee"]
+
+BILLS_DETAILED_SQL = """
+    SELECT b.bill_id, DATE(b.bill_date) AS bill_date, TIME(b.bill_date) AS bill_time,
+           COALESCE(m.name,'Guest') AS customer, COALESCE(m.membership_type,'-') AS membership_type,
+           b.subtotal, b.discount_pct, b.discount_amt, b.grand_total
+    FROM bills b
+    LEFT JOIN members m ON m.member_id = b.member_id
+    {where}
+    ORDER BY b.bill_id
+"""
+BILLS_DETAILED_COLS = ["bill_id","bill_date","bill_time","customer","membership_type","subtotal","discount_pct","discount_amt","grand_total"]
+
+
+@dataclass
+class ExportStats:
+    filename: str
+    rows: int = 0
+    last_key: object = None     # pass back as after= to resume
+    seconds: float = 0.0
+    peak_rss_kb: int = 0
+    files: list = field(default_factory=list)   # sharded=True: the part files, in order
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def peak_rss_kb(who=None):
+    """Peak resident set size of this process (or who=RUSAGE_CHILDREN: its largest child) so far, in KB (0 if unknown)."""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    return peak // 1024 if os.uname().sysname == "Darwin" else peak   # macOS reports bytes
+
+
+def _open_output(filename, append, compress):
+    mode = "a" if append else "w"
+    if compress:
+        return gzip.open(filename, mode + "t", newline="", encoding="utf-8")
+    return open(filename, mode, newline="", encoding="utf-8")
+
+
+def stream_rows(con, sql, params=(), chunk_size=CHUNK_SIZE):
+    """Yield (cols, chunk) pairs from an unbuffered cursor, chunk_size rows at a time."""
+    cur = con.cursor()
+    try:
+        cur.execute(sql, params)
+        cols = [d[0] for d in cur.description]
+        while True:
+            chunk = cur.fetchmany(chunk_size)
+            if not chunk:
+                break
+            yield cols, chunk
+    finally:
+        cur.close()
+
+
+def export_query(pool, sql, params, filename, cols=None, key=None, append=False,
+                 compress=None, chunk_size=CHUNK_SIZE, progress=None, header=True):
+    """
+    Stream a query to CSV. The file is only created once the first row
+    arrives; with append=True rows are added to an existing file without a
+    second header (header=False leaves it out of a new file too). key
+    names the resume column (default: the first one). Returns ExportStats.
+    """
+    if compress is None:
+        compress = filename.endswith(".gz")
+    append = append and os.path.exists(filename)
+    stats = ExportStats(filename)
+    started = time.perf_counter()
+    f = writer = None
+    try:
+        with pool.connection() as con:
+            for names, chunk in stream_rows(con, sql, params, chunk_size):
+                if f is None:
+                    key_index = names.index(key) if key else 0
+                    f = _open_output(filename, append, compress)
+                    writer = csv.writer(f)
+                    if header and not append:
+                        writer.writerow(cols or names)
+                writer.writerows(chunk)
+                stats.rows += len(chunk)
+                stats.last_key = chunk[-1][key_index]
+                if progress:
+                    stats.seconds = time.perf_counter() - started
+                    progress(stats)
+    finally:
+        if f is not None:
+            f.close()
+    stats.seconds = time.perf_counter() - started
+    stats.peak_rss_kb = peak_rss_kb()
+    return stats
+
+
+def export_table(pool, table_name, filename, after=None, **kwargs):
+    """Raw table export in primary-key order. after=<key> resumes past that key."""
+    if table_name not in ALLOWED_TABLES:
+        raise ValueError("Invalid table name for export.")
+    key = TABLE_KEYS[table_name]
+    where, params = ("", ()) if after is None else (f"WHERE {key} > %s", (after,))
+    return export_query(pool, f"SELECT * FROM {table_name} {where} ORDER BY {key}", params, filename,
+                        key=key, append=after is not None, **kwargs)
+
+
+def export_issues_detailed(pool, filename, after=None, workers=1, by="key", sharded=False, **kwargs):
+    """
+    Issues joined with member and book, in issue_id order. after=<issue_id>
+    resumes. workers > 1 (or sharded=True) exports partitions in parallel;
+    by="month" partitions on issue_date, so the output is in month order
+    and then issue_id order.
+    """
+    if workers > 1 or sharded:
+        return export_partitioned(pool, ISSUES_PARALLEL, filename, after, workers, by, sharded, **kwargs)
+    where, params = ("", ()) if after is None else ("WHERE i.issue_id > %s", (after,))
+    return export_query(pool, ISSUES_DETAILED_SQL.format(where=where), params, filename,
+                        ISSUES_DETAILED_COLS, append=after is not None, **kwargs)
+
+
+def export_bills_detailed(pool, filename, after=None, workers=1, by="key", sharded=False, **kwargs):
+    """Bills with customer details, in bill_id order. after=<bill_id> resumes. workers / by / sharded as for issues."""
+    if workers > 1 or sharded:
+        return export_partitioned(pool, BILLS_PARALLEL, filename, after, workers, by, sharded, **kwargs)
+    where, params = ("", ()) if after is None else ("WHERE b.bill_id > %s", (after,))
+    return export_query(pool, BILLS_DETAILED_SQL.format(where=where), params, filename,
+                        BILLS_DETAILED_COLS, append=after is not None, **kwargs)
+
+# -------------------- PARALLEL --------------------
+
+@dataclass(frozen=True)
+class Partitioned:
+    """How to cut one detailed export into ranges."""
+    sql: str                # with a {where} slot
+    cols: list
+    table: str              # the table the key / date belong to
+    key: str                # integer key column, as in the table
+    key_ref: str            # the same column as the query names it
+    date: str
+    date_ref: str
+
+
+ISSUES_PARALLEL = Partitioned(ISSUES_DETAILED_SQL, ISSUES_DETAILED_COLS, "issues",
+                              "issue_id", "i.issue_id", "issue_date", "i.issue_date")
+BILLS_PARALLEL = Partitioned(BILLS_DETAILED_SQL, BILLS_DETAILED_COLS, "bills",
+                             "bill_id", "b.bill_id", "bill_date", "b.bill_date")
+
+
+def _first_of_month(v):
+    if isinstance(v, str):      # SQLite hands DATETIME columns back as text
+        v = datetime.date.fromisoformat(v[:10])
+    return datetime.date(v.year, v.month, 1)
+
+
+def key_partitions(pool, part, parts, after=None):
+    """Up to `parts` equal slices of the key range (above after) -> [(where, params)]."""
+    with pool.connection() as con:
+        cur = con.cursor()
+        where, params = ("", ()) if after is None else (f"WHERE {part.key} > %s", (after,))
+        cur.execute(f"SELECT MIN({part.key}), MAX({part.key}) FROM {part.table} {where}", params)
+        lo, hi = cur.fetchone()
+        cur.close()
+    if lo is None:
+        return []
+    step = -(-(hi - lo + 1) // parts)
+    return [(f"WHERE {part.key_ref} >= %s AND {part.key_ref} < %s", (start, min(start + step, hi + 1)))
+            for start in range(lo, hi + 1, step)]
+
+
+def month_partitions(pool, part):
+    """One partition per calendar month between the first and last row -> [(where, params)]."""
+    with pool.connection() as con:
+        cur = con.cursor()
+        cur.execute(f"SELECT MIN({part.date}), MAX({part.date}) FROM {part.table}")
+        first, last = cur.fetchone()
+        cur.close()
+    if first is None:
+        return []
+    month, last = _first_of_month(first), _first_of_month(last)
+    ranges = []
+    while month <= last:
+        following = (month + datetime.timedelta(days=32)).replace(day=1)
+        ranges.append((f"WHERE {part.date_ref} >= %s AND {part.date_ref} < %s", (month, following)))
+        month = following
+    return ranges
+
+
+def shard_name(filename, index, count):
+    """issues.csv.gz -> issues-00003-of-00016.csv.gz (index counts from 0)."""
+    base, gz = (filename[:-3], ".gz") if filename.endswith(".gz") else (filename, "")
+    stem, ext = os.path.splitext(base)
+    return f"{stem}-{index + 1:05d}-of-{count:05d}{ext}{gz}"
+
+
+def _export_part(backend, sql, params, filename, cols, compress, chunk_size, header):
+    """Worker process: export one partition over a connection of its own."""
+    pool = ConnectionPool(backend, size=1)
+    try:
+        return export_query(pool, sql, params, filename, cols, compress=compress,
+                            chunk_size=chunk_size, header=header)
+    finally:
+        pool.close()
+
+
+def _stitch(filename, parts, cols, append, compress):
+    """Concatenate the part files (in order) behind one header, deleting them as they go."""
+    with open(filename, "ab" if append else "wb") as out:
+        if not append:
+            line = io.StringIO()
+            csv.writer(line).writerow(cols)
+            data = line.getvalue().encode("utf-8")
+            out.write(gzip.compress(data) if compress else data)
+        for part in parts:
+            if os.path.exists(part):
+                with open(part, "rb") as f:
+                    shutil.copyfileobj(f, out, 1 << 20)
+                os.remove(part)
+
+
+def export_partitioned(pool, part, filename, after=None, workers=None, by="key", sharded=False,
+                       compress=None, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Export part.sql in parallel over `workers` processes (default: one per
+    core). by="key" cuts the key range above after into equal slices;
+    by="month" makes one partition per month (after can't be used then).
+    Stitches the parts into filename, or with sharded=True keeps them as
+    shard_name(filename, i, n) files listed in ExportStats.files. progress
+    (if given) gets the running ExportStats as each partition finishes.
+    """
+    if by not in ("key", "month"):
+        raise ValueError("by must be 'key' or 'month'.")
+    if by == "month" and after is not None:
+        raise ValueError("Resuming (after=) needs by='key'.")
+    if sharded and after is not None:
+        raise ValueError("A sharded export can't be resumed; export again.")
+    if compress is None:
+        compress = filename.endswith(".gz")
+    workers = workers if workers and workers > 0 else os.cpu_count() or 1
+    append = after is not None and os.path.exists(filename)
+    stats = ExportStats(filename)
+    started = time.perf_counter()
+
+    ranges = (key_partitions(pool, part, workers * PARTITIONS_PER_WORKER, after) if by == "key"
+              else month_partitions(pool, part))
+    names = [shard_name(filename, i, len(ranges)) if sharded else f"{filename}.part{i:05d}"
+             for i in range(len(ranges))]
+    results = [None] * len(ranges)
+    try:
+        with ProcessPoolExecutor(min(workers, max(len(ranges), 1))) as ex:
+            futures = {ex.submit(_export_part, pool.backend, part.sql.format(where=where), params, name,
+                                 part.cols, compress, chunk_size, sharded): i
+                       for i, ((where, params), name) in enumerate(zip(ranges, names))}
+            for future in as_completed(futures):
+                results[futures[future]] = done = future.result()
+                stats.rows += done.rows
+                if progress:
+                    stats.seconds = time.perf_counter() - started
+                    progress(stats)
+        if not sharded:
+            _stitch(filename, names, part.cols, append, compress)
+    except BaseException:
+        for name in names:
+            if os.path.exists(name):
+                os.remove(name)
+        raise
+
+    written = [r for r in results if r.rows]
+    stats.last_key = written[-1].last_key if written and by == "key" else None
+    if sharded:
+        stats.files = [r.filename for r in written]
+    stats.seconds = time.perf_counter() - started
+    stats.peak_rss_kb = max(peak_rss_kb(), peak_rss_kb(resource.RUSAGE_CHILDREN) if resource else 0)
+    return stats
@@ -0,0 +1,674 @@
+"""
+HTTP/JSON API for the Library Management System
+-----------------------------------------------
+The operations behind the Books, Staff, Members and Billing menus as JSON
+endpoints, for desks and kiosks that can't run the terminal menus.
+
+    python lms_http.py --port 8080                 # one worker per core
+    python lms_http.py --port 8080 --workers 2
+
+Workers are processes sharing one listening socket, each with its own
+LibraryService and connection pool and a thread per client connection.
+Connections are kept alive (HTTP/1.1) until idle for KEEPALIVE_TIMEOUT.
+A database connection is checked out per service call, not per client,
+so idle keep-alive clients hold none. Responses are gzip'd when the
+client accepts it. `all=1` on a listing streams every row as one chunked
+JSON array, read page by page. Prices and amounts go out as strings
+("12.50"), exactly as stored, never as floats.
+
+  GET  /books?token=&limit=&all=        POST /books
+  GET  /books/search?q=&field=&page=&page_size=
+  GET|PUT|DELETE /books/<book_id>
+  GET  /staff                           POST /staff
+  GET|PUT|DELETE /staff/<staff_id>
+  GET  /members                         POST /members
+  GET|PUT|DELETE /members/<member_id>   GET  /members/<member_id>/overdue
+  GET  /issues                          POST /issues {member_id, book_id, days}
+  POST /issues/<issue_id>/return        GET  /issues/month/<YYYY-MM>?by=issue|return|any
+  POST /issues/batch {loans: [[member_id, book_id]], days}
+  POST /issues/returns {issue_ids: [...]}  (both: one result per item, in order)
+  GET  /overdue
+  GET  /bills                           POST /bills {member_id, items: [[book_id, qty]], discount_pct}
+  GET  /bills/month/<YYYY-MM>           GET  /bills/<bill_id>/items
+  GET  /reports/bills/<YYYY-MM>?daily=  GET  /reports/issues/<YYYY-MM>?daily=
+
+With LMS_STOCK_LEDGER set (see lms_stock) there is always one worker:
+the ledger must be the only writer of stock.
+
+GET /metrics is the Prometheus text exposition of lms_metrics, summed
+over all workers (?format=json for the JSON snapshot).
+
+Errors come back as {"error": message} with 400 (bad input), 404, 409
+(duplicate / out of stock), 503 (pool exhausted) or 500.
+
+"""
+
+import os
+import re
+import sys
+import glob
+import json
+import zlib
+import time
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import datetime
+import threading
+import traceback
+import dataclasses
+from decimal import Decimal
+from urllib.parse import parse_qs, unquote, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lms_db import ConnectionPool, PoolTimeout, make_backend
+from lms_metrics import METRICS, merge_snapshots, prometheus_text
+from lms_money import money
+from lms_paging import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from lms_records import Bill, BillItem, Book, Issue, Member, MonthBill, OpenIssue, OverdueItem, Staff
+from lms_service import (
+    DEFAULT_ISSUE_DAYS, AlreadyExists, InvalidInput, LibraryService, NotDone, NotFound, OutOfStock, ServiceError,
+)
+from lms_stock import STOCK_LEDGER_DIR
+
+HOST = "127.0.0.1"
+PORT = 8080
+HTTP_POOL_SIZE = 10         # database connections per worker
+KEEPALIVE_TIMEOUT = 15.0    # seconds an idle client connection is kept open
+MAX_BODY = 1 << 20          # largest request body accepted, bytes
+GZIP_MIN_BYTES = 1024       # smaller responses aren't worth compressing
+GZIP_LEVEL = 5
+SEARCH_REFRESH = 60.0       # seconds; picks up books added through the other workers
+METRICS_PUBLISH = 5.0       # seconds between each worker's metrics snapshots on disk
+
+BOOK_COLS = Book._fields
+STAFF_COLS = Staff._fields
+MEMBER_COLS = Member._fields
+ACTIVE_ISSUE_COLS = OpenIssue._fields
+MONTH_ISSUE_COLS = Issue._fields
+BILL_COLS = Bill._fields
+MONTH_BILL_COLS = MonthBill._fields
+BILL_ITEM_COLS = BillItem._fields
+MEMBER_OVERDUE_COLS = OverdueItem._fields
+OVERDUE_COLS = ("membership_type", "overdue_items", "max_days_late", "accrued_fee")
+BILL_REPORT_COLS = ("period", "membership_type", "bills", "subtotal", "discount_amt", "grand_total")
+ISSUE_REPORT_COLS = ("period", "issues", "returns", "late_fees")
+
+ERROR_STATUS = ((NotFound, 404), (AlreadyExists, 409), (OutOfStock, 409), (NotDone, 503), (ServiceError, 400))
+
+# -------------------- JSON --------------------
+
+def _default(o):
+    if isinstance(o, Decimal):
+        return str(o)
+    if isinstance(o, (datetime.date, datetime.datetime)):
+        return o.isoformat()
+    if dataclasses.is_dataclass(o):
+        return dataclasses.asdict(o)
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+
+def _json(payload):
+    return json.dumps(payload, default=_default, separators=(",", ":")).encode()
+
+
+def _rows(rows, cols):
+    return [dict(zip(cols, row)) for row in rows]
+
+
+@dataclasses.dataclass
+class Stream:
+    """A listing to send as one chunked JSON array: fetch(token) -> Page, MAX_PAGE_SIZE rows at a time."""
+    fetch: object
+    cols: tuple
+
+# -------------------- REQUEST HELPERS --------------------
+
+def _need(body, name):
+    if body.get(name) is None:
+        raise InvalidInput(f"Missing field: {name}")
+    return body[name]
+
+
+def _int(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise InvalidInput(f"{name} must be a whole number.")
+
+
+def _money(value, name):
+    try:
+        amount = money(value)
+    except (TypeError, ValueError, ArithmeticError):
+        amount = None
+    if amount is None or not amount.is_finite():
+        raise InvalidInput(f"{name} must be a number.")
+    return amount
+
+
+def _opt(body, name, convert):
+    value = body.get(name)
+    return None if value is None else convert(value, name)
+
+
+def _flag(q, name):
+    return q.get(name, "").lower() in ("1", "true", "yes")
+
+
+def _listing(fetch, q, cols, *args):
+    if _flag(q, "all"):
+        return Stream(lambda token: fetch(*args, token=token, limit=MAX_PAGE_SIZE), cols)
+    page = fetch(*args, token=q.get("token") or None, limit=_int(q.get("limit", DEFAULT_PAGE_SIZE), "limit"))
+    return {"rows": _rows(page.rows, cols), "next": page.next_token, "prev": page.prev_token}
+
+
+def _found(row, cols, what):
+    if not row:
+        raise NotFound(f"{what} not found.")
+    return dict(zip(cols, row))
+
+# -------------------- ENDPOINTS --------------------
+# Each takes (svc, query, body, *path params) and returns the JSON payload.
+
+def list_books(svc, q, body):
+    return _listing(svc.list_books, q, BOOK_COLS)
+
+
+def add_book(svc, q, body):
+    book_id = str(_need(body, "book_id")).strip()
+    svc.add_book(book_id, str(_need(body, "title")), str(_need(body, "author")), str(_need(body, "category")),
+                 _money(_need(body, "price"), "price"), _int(_need(body, "stock"), "stock"))
+    return _found(svc.get_book(book_id), BOOK_COLS, "Book")
+
+
+def search_books(svc, q, body):
+    result = svc.search_books(q.get("q", ""), q.get("field") or None,
+                              _int(q.get("page", 1), "page"), _int(q.get("page_size", 20), "page_size"))
+    return {"query": result.query, "total": result.total, "page": result.page, "pages": result.pages,
+            "truncated": result.truncated, "rows": _rows(result.rows, BOOK_COLS)}
+
+
+def get_book(svc, q, body, book_id):
+    return _found(svc.get_book(book_id), BOOK_COLS, "Book")
+
+
+def update_book(svc, q, body, book_id):
+    svc.update_book(book_id, body.get("title"), body.get("author"), body.get("category"),
+                    _opt(body, "price", _money), _opt(body, "stock", _int))
+    return _found(svc.get_book(book_id), BOOK_COLS, "Book")
+
+
+def delete_book(svc, q, body, book_id):
+    svc.delete_book(book_id)
+    return {"deleted": book_id}
+
+
+def list_staff(svc, q, body):
+    return _listing(svc.list_staff, q, STAFF_COLS)
+
+
+def add_staff(svc, q, body):
+    staff_id = svc.add_staff(str(_need(body, "name")), str(_need(body, "role")), str(body.get("phone") or ""))
+    return _found(svc.get_staff(staff_id), STAFF_COLS, "Staff")
+
+
+def get_staff(svc, q, body, staff_id):
+    return _found(svc.get_staff(_int(staff_id, "staff_id")), STAFF_COLS, "Staff")
+
+
+def update_staff(svc, q, body, staff_id):
+    staff_id = _int(staff_id, "staff_id")
+    svc.update_staff(staff_id, body.get("name"), body.get("role"), body.get("phone"))
+    return _found(svc.get_staff(staff_id), STAFF_COLS, "Staff")
+
+
+def delete_staff(svc, q, body, staff_id):
+    svc.delete_staff(_int(staff_id, "staff_id"))
+    return {"deleted": int(staff_id)}
+
+
+def list_members(svc, q, body):
+    return _listing(svc.list_members, q, MEMBER_COLS)
+
+
+def add_member(svc, q, body):
+    member_id = svc.add_member(str(_need(body, "name")), str(body.get("phone") or ""), body.get("email"),
+                               body.get("membership_type", "Regular"))
+    return _found(svc.get_member(member_id), MEMBER_COLS, "Member")
+
+
+def get_member(svc, q, body, member_id):
+    return _found(svc.get_member(_int(member_id, "member_id")), MEMBER_COLS, "Member")
+
+
+def update_member(svc, q, body, member_id):
+    member_id = _int(member_id, "member_id")
+    svc.update_member(member_id, body.get("name"), body.get("phone"), body.get("email"), body.get("membership_type"))
+    return _found(svc.get_member(member_id), MEMBER_COLS, "Member")
+
+
+def delete_member(svc, q, body, member_id):
+    svc.delete_member(_int(member_id, "member_id"))
+    return {"deleted": int(member_id)}
+
+
+def member_overdue(svc, q, body, member_id):
+    return {"rows": _rows(svc.member_overdue(_int(member_id, "member_id")), MEMBER_OVERDUE_COLS)}
+
+
+def issue_book(svc, q, body):
+    return svc.issue(_int(_need(body, "member_id"), "member_id"), str(_need(body, "book_id")),
+                     _int(body.get("days", DEFAULT_ISSUE_DAYS), "days"))
+
+
+def return_book(svc, q, body, issue_id):
+    return svc.return_issue(_int(issue_id, "issue_id"))
+
+
+def _outcomes(results):
+    """Per-item results of a batch: the receipt, or {"error", "status"} for the ones that failed."""
+    return {"results": [{"error": str(r), "status": _error_status(r)} if isinstance(r, ServiceError) else r
+                        for r in results]}
+
+
+def issue_many(svc, q, body):
+    loans = _need(body, "loans")
+    if not isinstance(loans, list):
+        raise InvalidInput("loans must be a list of [member_id, book_id].")
+    try:
+        loans = [(_int(m, "member_id"), str(b)) for m, b in
+                 ((i["member_id"], i["book_id"]) if isinstance(i, dict) else i for i in loans)]
+    except (KeyError, TypeError, ValueError):
+        raise InvalidInput("loans must be a list of [member_id, book_id].")
+    return _outcomes(svc.issue_many(loans, _int(body.get("days", DEFAULT_ISSUE_DAYS), "days")))
+
+
+def return_many(svc, q, body):
+    issue_ids = _need(body, "issue_ids")
+    if not isinstance(issue_ids, list):
+        raise InvalidInput("issue_ids must be a list.")
+    return _outcomes(svc.return_many([_int(i, "issue_id") for i in issue_ids]))
+
+
+def active_issues(svc, q, body):
+    return _listing(svc.active_issues, q, ACTIVE_ISSUE_COLS)
+
+
+def issues_by_month(svc, q, body, ym):
+    return _listing(svc.issues_by_month, q, MONTH_ISSUE_COLS, ym, q.get("by", "issue"))
+
+
+def overdue(svc, q, body):
+    return {"rows": _rows(svc.overdue_summary(), OVERDUE_COLS)}
+
+
+def create_bill(svc, q, body):
+    items = _need(body, "items")
+    if not isinstance(items, list):
+        raise InvalidInput("items must be a list of [book_id, qty].")
+    try:
+        items = [(str(b), _int(n, "qty")) for b, n in
+                 ((i["book_id"], i["qty"]) if isinstance(i, dict) else i for i in items)]
+    except (KeyError, TypeError, ValueError):
+        raise InvalidInput("items must be a list of [book_id, qty].")
+    return svc.create_bill(_opt(body, "member_id", _int), items, _money(body.get("discount_pct", 0), "discount_pct"))
+
+
+def list_bills(svc, q, body):
+    return _listing(svc.list_bills, q, BILL_COLS)
+
+
+def bills_by_month(svc, q, body, ym):
+    return _listing(svc.bills_by_month, q, MONTH_BILL_COLS, ym)
+
+
+def bill_items(svc, q, body, bill_id):
+    return {"rows": _rows(svc.bill_items(_int(bill_id, "bill_id")), BILL_ITEM_COLS)}
+
+
+def bill_report(svc, q, body, ym):
+    return {"rows": _rows(svc.bill_summary(ym, _flag(q, "daily")), BILL_REPORT_COLS)}
+
+
+def issue_report(svc, q, body, ym):
+    return {"rows": _rows(svc.issue_summary(ym, _flag(q, "daily")), ISSUE_REPORT_COLS)}
+
+
+_ID = r"([^/]+)"
+ROUTES = [
+    # (method, path, endpoint, status on success); first match wins
+    ("GET", r"/books", list_books, 200),
+    ("POST", r"/books", add_book, 201),
+    ("GET", r"/books/search", search_books, 200),
+    ("GET", rf"/books/{_ID}", get_book, 200),
+    ("PUT", rf"/books/{_ID}", update_book, 200),
+    ("DELETE", rf"/books/{_ID}", delete_book, 200),
+    ("GET", r"/staff", list_staff, 200),
+    ("POST", r"/staff", add_staff, 201),
+    ("GET", rf"/staff/{_ID}", get_staff, 200),
+    ("PUT", rf"/staff/{_ID}", update_staff, 200),
+    ("DELETE", rf"/staff/{_ID}", delete_staff, 200),
+    ("GET", r"/members", list_members, 200),
+    ("POST", r"/members", add_member, 201),
+    ("GET", rf"/members/{_ID}/overdue", member_overdue, 200),
+    ("GET", rf"/members/{_ID}", get_member, 200),
+    ("PUT", rf"/members/{_ID}", update_member, 200),
+    ("DELETE", rf"/members/{_ID}", delete_member, 200),
+    ("GET", r"/issues", active_issues, 200),
+    ("POST", r"/issues", issue_book, 201),
+    ("POST", r"/issues/batch", issue_many, 200),
+    ("POST", r"/issues/returns", return_many, 200),
+    ("POST", rf"/issues/{_ID}/return", return_book, 200),
+    ("GET", rf"/issues/month/{_ID}", issues_by_month, 200),
+    ("GET", r"/overdue", overdue, 200),
+    ("GET", r"/bills", list_bills, 200),
+    ("POST", r"/bills", create_bill, 201),
+    ("GET", rf"/bills/month/{_ID}", bills_by_month, 200),
+    ("GET", rf"/bills/{_ID}/items", bill_items, 200),
+    ("GET", rf"/reports/bills/{_ID}", bill_report, 200),
+    ("GET", rf"/reports/issues/{_ID}", issue_report, 200),
+]
+ROUTES = [(method, re.compile(path), endpoint, status) for method, path, endpoint, status in ROUTES]
+
+# -------------------- SERVER --------------------
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"       # keep-alive unless the client says otherwise
+    server_version = "LMS/1.0"
+    timeout = KEEPALIVE_TIMEOUT
+    disable_nagle_algorithm = True      # headers and body go out as separate writes; don't wait for the ACK
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def log_message(self, format, *args):
+        if self.server.access_log:
+            super().log_message(format, *args)
+
+    def _read_body(self):
+        """The request body as parsed JSON ({} if none); always consumed so the connection can be reused."""
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True    # no telling where the body ends
+            raise _HTTPError(400, "Bad Content-Length.")
+        if length > MAX_BODY:
+            self.close_connection = True
+            raise _HTTPError(413, f"Request body over {MAX_BODY} bytes.")
+        raw = self.rfile.read(length) if length else b""
+        if not raw:
+            return {}
+        try:
+            body = json.loads(raw)
+        except ValueError:
+            raise InvalidInput("Request body is not valid JSON.")
+        if not isinstance(body, dict):
+            raise InvalidInput("Request body must be a JSON object.")
+        return body
+
+    def _route(self, method, path):
+        allowed = False
+        for m, pattern, endpoint, status in ROUTES:
+            match = pattern.fullmatch(path)
+            if match:
+                if m == method:
+                    return endpoint, status, [unquote(g) for g in match.groups()]
+                allowed = True
+        if allowed:
+            raise _HTTPError(405, "Method not allowed.")
+        raise _HTTPError(404, "No such endpoint.")
+
+    def _dispatch(self, method):
+        url = urlsplit(self.path)
+        if method == "GET" and url.path == "/metrics":
+            return self._send_metrics(parse_qs(url.query).get("format", [""])[-1])
+        try:
+            body = self._read_body()
+            endpoint, status, params = self._route(method, url.path.rstrip("/") or "/")
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            result = endpoint(self.server.svc, query, body, *params)
+        except _HTTPError as e:
+            return self._send(e.status, {"error": str(e)})
+        except ServiceError as e:
+            return self._send(_error_status(e), {"error": str(e)})
+        except ValueError as e:         # a malformed page token and the like
+            return self._send(400, {"error": str(e)})
+        except PoolTimeout:
+            return self._send(503, {"error": "Server busy, please retry."})
+        except Exception:
+            traceback.print_exc()
+            return self._send(500, {"error": "Internal error."})
+        if isinstance(result, Stream):
+            return self._stream(result)
+        self._send(status, result)
+
+    def _gzip_ok(self):
+        return "gzip" in (self.headers.get("Accept-Encoding") or "")
+
+    def _send_metrics(self, fmt):
+        snap = all_metrics(self.server.metrics_dir)
+        if fmt == "json":
+            return self._send(200, snap)
+        self._send_bytes(200, prometheus_text(snap).encode(), "text/plain; version=0.0.4; charset=utf-8")
+
+    def _send(self, status, payload):
+        self._send_bytes(status, _json(payload), "application/json")
+
+    def _send_bytes(self, status, data, content_type):
+        gz = len(data) >= GZIP_MIN_BYTES and self._gzip_ok()
+        if gz:
+            z = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)     # wbits 31: gzip container
+            data = z.compress(data) + z.flush()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        if gz:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, stream):
+        # the first page is read before the headers go out, so a bad token still gets a clean 400
+        try:
+            page = stream.fetch(None)
+        except ServiceError as e:
+            return self._send(_error_status(e), {"error": str(e)})
+        gz = self._gzip_ok()
+        z = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) if gz else None
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        if gz:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+
+        def chunk(data, last=False):
+            if z:
+                data = z.compress(data) + (z.flush() if last else b"")
+            if data:
+                self.wfile.write(b"%X\r\n%s\r\n" % (len(data), data))
+
+        sep = b"["
+        try:
+            while True:
+                if page.rows:
+                    chunk(sep + b",".join(_json(dict(zip(stream.cols, row))) for row in page.rows))
+                    sep = b","
+                if not page.next_token:
+                    break
+                page = stream.fetch(page.next_token)
+        except Exception:
+            # the status line is gone; all we can do is cut the response short
+            traceback.print_exc()
+            self.close_connection = True
+            return
+        chunk(b"[]" if sep == b"[" else b"]", last=True)
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def _error_status(exc):
+    return next(code for cls, code in ERROR_STATUS if isinstance(exc, cls))
+
+
+class _HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class LibraryHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer on an already-listening socket (shared by the workers)."""
+    daemon_threads = True
+
+    def __init__(self, sock, svc, access_log=False, metrics_dir=None):
+        super().__init__(sock.getsockname()[:2], RequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.svc = svc
+        self.access_log = access_log
+        self.metrics_dir = metrics_dir
+
+
+def publish_metrics(metrics_dir):
+    """Write this process's metrics snapshot to metrics_dir/<pid>.json."""
+    path = os.path.join(metrics_dir, f"{os.getpid()}.json")
+    METRICS.dump_json(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def all_metrics(metrics_dir=None):
+    """This process's metrics, or with metrics_dir every worker's summed (publishing ours first)."""
+    if metrics_dir is None:
+        return METRICS.snapshot()
+    publish_metrics(metrics_dir)
+    snaps = []
+    for path in glob.glob(os.path.join(metrics_dir, "*.json")):
+        try:
+            with open(path, encoding="utf-8") as f:
+                snaps.append(json.load(f))
+        except (OSError, ValueError):
+            pass    # a worker's file mid-replace; it's in the next scrape
+    return merge_snapshots(snaps)
+
+
+def _publish_loop(metrics_dir, every):
+    while True:
+        time.sleep(every)
+        try:
+            publish_metrics(metrics_dir)
+        except OSError:
+            traceback.print_exc()
+
+
+def _refresh_search(svc, every):
+    while True:
+        time.sleep(every)
+        try:
+            svc.refresh_search_index()
+        except Exception:
+            traceback.print_exc()
+
+
+def run_worker(sock, pool_size=HTTP_POOL_SIZE, access_log=False, metrics_dir=None):
+    """Serve requests on sock in this process until interrupted."""
+    METRICS.reset()     # a forked worker starts with a copy of the parent's start-up counts
+    pool = ConnectionPool(make_backend(), size=pool_size)
+    svc = LibraryService(pool)
+    server = LibraryHTTPServer(sock, svc, access_log, metrics_dir)
+    threading.Thread(target=_refresh_search, args=(svc, SEARCH_REFRESH), daemon=True).start()
+    if metrics_dir:
+        threading.Thread(target=_publish_loop, args=(metrics_dir, METRICS_PUBLISH), daemon=True).start()
+    try:
+        server.serve_forever()
+    finally:
+        pool.close()
+
+
+def serve(host=HOST, port=PORT, workers=None, pool_size=HTTP_POOL_SIZE, access_log=False):
+    """
+    Listen on host:port and serve with `workers` processes (default: one
+    per core; always one where os.fork is unavailable or with a stock ledger).
+    """
+    workers = workers or os.cpu_count() or 1
+    if not hasattr(os, "fork") or STOCK_LEDGER_DIR:
+        workers = 1
+    sock = socket.create_server((host, port), backlog=1024)
+    print(f"Serving on http://{host}:{sock.getsockname()[1]} with {workers} worker(s)", flush=True)
+    if workers == 1:
+        try:
+            run_worker(sock, pool_size, access_log)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    # workers publish metrics snapshots here so any of them can answer /metrics for all
+    metrics_dir = tempfile.mkdtemp(prefix="lms-metrics-")
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(sock, pool_size, access_log, metrics_dir)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children.append(pid)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except (KeyboardInterrupt, SystemExit):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    finally:
+        sock.close()
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+# -------------------- CLI --------------------
+
+def main(argv=None):
+    from lms_db import get_pool
+    from lms_migrations import migrate
+
+    ap = argparse.ArgumentParser(description="Serve the library operations as an HTTP/JSON API.")
+    ap.add_argument("--host", default=HOST, help=f"interface to listen on (default: {HOST})")
+    ap.add_argument("--port", type=int, default=PORT, help=f"port (default: {PORT})")
+    ap.add_argument("--workers", type=int, help="worker processes (default: one per core)")
+    ap.add_argument("--pool", type=int, default=HTTP_POOL_SIZE, help=f"connections per worker (default: {HTTP_POOL_SIZE})")
+    ap.add_argument("--access-log", action="store_true", help="log every request to stderr")
+    args = ap.parse_args(argv)
+
+    # schema first, and no connection may be open when the workers fork
+    pool = get_pool()
+    migrate(pool)
+    pool.close()
+    serve(args.host, args.port, args.workers, args.pool, args.access_log)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+"""
+Bulk catalogue import for the books table
+-----------------------------------------
+Streams a supplier feed (CSV, JSON array or JSON lines) and upserts it in
+batches: one executemany per batch, one transaction per batch. Rows that
+fail validation (or that the database refuses) go to a side file with the
+reason, and the import carries on.
+
+Usage:
+    python lms_import.py catalogue.csv [--batch-size 5000] [--update-stock]
+
+Expected fields: book_id, title, author, price, and optionally category, stock.
+
+"""
+
+import csv
+import sys
+import json
+import time
+import argparse
+from decimal import Decimal, InvalidOperation
+from dataclasses import dataclass
+
+from lms_money import money
+
+BOOK_COLS = ("book_id", "title", "author", "category", "price", "stock")
+MAX_LEN = {"book_id": 20, "title": 200, "author": 100, "category": 100}
+MAX_PRICE = Decimal("99999999.99")    # DECIMAL(10,2)
+DEFAULT_BATCH_SIZE = 5000
+
+
+@dataclass
+class ImportStats:
+    read: int = 0
+    loaded: int = 0
+    rejected: int = 0
+    batches: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rows_per_sec(self):
+        return self.read / self.seconds if self.seconds else 0.0
+
+# -------------------- READERS --------------------
+
+def iter_csv(f):
+    yield from csv.DictReader(f)
+
+
+def iter_json_lines(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_json_array(f, chunk_size=1 << 16):
+    """Yield the objects of a top-level JSON array without loading the whole file."""
+    decoder = json.JSONDecoder()
+    buf = f.read(chunk_size).lstrip()
+    if not buf.startswith("["):
+        raise ValueError("Expected a JSON array")
+    buf = buf[1:]
+    eof = False
+    while True:
+        buf = buf.lstrip().lstrip(",").lstrip()
+        if buf.startswith("]"):
+            return
+        try:
+            obj, end = decoder.raw_decode(buf)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            more = f.read(chunk_size)
+            eof = not more
+            buf += more
+            continue
+        yield obj
+        buf = buf[end:]
+        if len(buf) < chunk_size and not eof:
+            more = f.read(chunk_size)
+            eof = not more
+            buf += more
+
+
+def detect_format(path):
+    lower = path.lower()
+    if lower.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    if lower.endswith(".json"):
+        return "json"
+    return "csv"
+
+
+READERS = {"csv": iter_csv, "json": iter_json_array, "jsonl": iter_json_lines}
+
+# -------------------- VALIDATION --------------------
+
+def to_book_row(rec):
+    """Feed record -> tuple in BOOK_COLS order. Raises ValueError with the reject reason."""
+    if not isinstance(rec, dict):
+        raise ValueError("record is not an object")
+    vals = {}
+    for col in ("book_id", "title", "author", "category"):
+        v = rec.get(col)
+        v = "" if v is None else str(v).strip()
+        if not v and col != "category":
+            raise ValueError(f"missing {col}")
+        if len(v) > MAX_LEN[col]:
+            raise ValueError(f"{col} longer than {MAX_LEN[col]}")
+        vals[col] = v
+    try:
+        price = money(str(rec.get("price", "")).strip())     # rounded half up, like every other way in
+    except (InvalidOperation, ValueError):
+        raise ValueError("bad price")
+    if not price.is_finite():       # NaN gets through quantize() and can't be compared
+        raise ValueError("bad price")
+    if not (0 <= price <= MAX_PRICE):
+        raise ValueError("price out of range")
+    stock_raw = rec.get("stock")
+    try:
+        stock = int(stock_raw) if stock_raw not in (None, "") else 0
+    except (TypeError, ValueError):
+        raise ValueError("bad stock")
+    if stock < 0:
+        raise ValueError("stock must be >= 0")
+    return (vals["book_id"], vals["title"], vals["author"], vals["category"], price, stock)
+
+# -------------------- LOADER --------------------
+
+class _Rejects:
+    """Side file for rejected rows, opened on first use."""
+
+    def __init__(self, path):
+        self.path = path
+        self._f = None
+        self._writer = None
+
+    def add(self, recno, reason, rec):
+        if self.path is None:
+            return
+        if self._f is None:
+            self._f = open(self.path, "w", newline="", encoding="utf-8")
+            self._writer = csv.writer(self._f)
+            self._writer.writerow(["record", "reason", "data"])
+        self._writer.writerow([recno, reason, json.dumps(rec, default=str)])
+
+    def close(self):
+        if self._f:
+            self._f.close()
+
+
+def _load_batch(con, sql, batch, rejects):
+    """
+    executemany in one transaction; if the batch fails, retry row by row to
+    isolate bad rows. Returns the rows that made it in.
+    """
+    cur = con.cursor()
+    rows = [row for _, row, _ in batch]
+    try:
+        cur.executemany(sql, rows)
+        con.commit()
+        return rows
+    except Exception:
+        con.rollback()
+        loaded = []
+        for recno, row, rec in batch:
+            try:
+                cur.execute(sql, row)
+                loaded.append(row)
+            except Exception as e:
+                rejects.add(recno, f"database: {e}", rec)
+        con.commit()
+        return loaded
+    finally:
+        cur.close()
+
+
+def import_books(pool, path, fmt=None, batch_size=DEFAULT_BATCH_SIZE, rejects_path=None,
+                 update_stock=False, progress=None, on_batch=None):
+    """
+    Upsert books from a feed file. Existing books get their title, author,
+    category and price (and stock when update_stock) overwritten.
+    progress(stats) is called after each batch and on_batch(rows) with the
+    rows it committed (BOOK_COLS order). Returns ImportStats.
+    """
+    fmt = fmt or detect_format(path)
+    if fmt not in READERS:
+        raise ValueError(f"Unknown format: {fmt}")
+    if rejects_path is None:
+        rejects_path = path + ".rejects.csv"
+    update_cols = ["title", "author", "category", "price"] + (["stock"] if update_stock else [])
+    sql = pool.backend.upsert_sql("books", BOOK_COLS, ("book_id",), update_cols)
+
+    stats = ImportStats()
+    rejects = _Rejects(rejects_path)
+    started = time.perf_counter()
+    batch = []
+
+    def flush():
+        loaded = _load_batch(con, sql, batch, rejects)
+        stats.loaded += len(loaded)
+        stats.rejected += len(batch) - len(loaded)
+        if on_batch:
+            on_batch(loaded)
+        stats.batches += 1
+        stats.seconds = time.perf_counter() - started
+        if progress:
+            progress(stats)
+        batch.clear()
+
+    try:
+        with open(path, newline="", encoding="utf-8") as f, pool.connection() as con:
+            for recno, rec in enumerate(READERS[fmt](f), start=1):
+                stats.read += 1
+                try:
+                    row = to_book_row(rec)
+                except ValueError as e:
+                    stats.rejected += 1
+                    rejects.add(recno, str(e), rec)
+                    continue
+                batch.append((recno, row, rec))
+                if len(batch) >= batch_size:
+                    flush()
+            if batch:
+                flush()
+    finally:
+        rejects.close()
+    stats.seconds = time.perf_counter() - started
+    return stats
+
+
+def print_progress(stats):
+    print(f"  {stats.read:>10} rows read | {stats.loaded:>10} loaded | {stats.rejected:>6} rejected | {stats.rows_per_sec:,.0f} rows/sec")
+
+# -------------------- CLI --------------------
+
+def main(argv=None):
+    from lms_db import get_pool
+    from lms_migrations import migrate
+
+    ap = argparse.ArgumentParser(description="Bulk import books from a CSV/JSON feed.")
+    ap.add_argument("path")
+    ap.add_argument("--format", choices=sorted(READERS), help="default: from the file extension")
+    ap.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    ap.add_argument("--rejects", help="side file for rejected rows (default: <path>.rejects.csv)")
+    ap.add_argument("--update-stock", action="store_true", help="overwrite stock of existing books too")
+    args = ap.parse_args(argv)
+
+    pool = get_pool()
+    migrate(pool)
+    stats = import_books(pool, args.path, args.format, args.batch_size, args.rejects,
+                         args.update_stock, progress=print_progress)
+    print(f"Done: {stats.loaded} loaded, {stats.rejected} rejected in {stats.seconds:.2f}s ({stats.rows_per_sec:,.0f} rows/sec)")
+    if stats.rejected:
+        print(f"Rejected rows written to {args.rejects or args.path + '.rejects.csv'}")
+    pool.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
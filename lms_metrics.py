@@ -0,0 +1,432 @@
+"""
+Query timing and operation metrics
+----------------------------------
+Every cursor the pool hands out is wrapped so each execute() is timed
+into a latency histogram keyed by its normalized SQL (whitespace
+collapsed, IN lists and multi-row VALUES folded, so one statement shape
+is one key), along with rows returned or changed and errors.
+
+Service methods are operations: while one runs, the statements it
+executes count as its round trips, so a regression that adds a query to
+issue() shows up as issue's round trips going from 5 to 6.
+
+Statements slower than SLOW_QUERY_MS are logged to the "lms.slow" logger
+(silent until the application gives it a handler) and kept in a short
+recent list.
+
+    from lms_metrics import METRICS
+    print(METRICS.prometheus())         # Prometheus text exposition
+    METRICS.dump_json("metrics.json")   # or a JSON snapshot
+
+Set LMS_METRICS=0 to turn the cursor wrapping off.
+
+"""
+
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+import functools
+import threading
+import contextvars
+from collections import deque
+
+METRICS_ENABLED = os.environ.get("LMS_METRICS", "1") != "0"
+SLOW_QUERY_MS = float(os.environ.get("LMS_SLOW_QUERY_MS", "200"))
+SLOW_LOG_SIZE = 100         # recent slow statements kept for the JSON dump
+# histogram bucket upper bounds, seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+slow_log = logging.getLogger("lms.slow")
+slow_log.addHandler(logging.NullHandler())     # where slow queries go is the application's logging config
+
+_SPACE = re.compile(r"\s+")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*%s(?:\s*,\s*%s)+\s*\)")
+_VALUES_ROWS = re.compile(r"(VALUES \(\.\.\.\))(?:\s*,\s*\(\.\.\.\))+|(VALUES \([^()]*\))(?:\s*,\s*\([^()]*\))+", re.IGNORECASE)
+_CASE_WHENS = re.compile(r"(WHEN %s THEN %s)(?: WHEN %s THEN %s)+")
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_sql(sql):
+    """One key per statement shape: "WHERE id IN (%s,%s,%s)" and "... IN (%s)" both -> "IN (...)"."""
+    sql = _SPACE.sub(" ", sql).strip()
+    sql = _CASE_WHENS.sub(r"\1 ...", sql)
+    sql = _PLACEHOLDER_LIST.sub("(...)", sql)
+    sql = _VALUES_ROWS.sub(lambda m: (m.group(1) or m.group(2)) + ", ...", sql)
+    return sql
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)     # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation (None above the last bound)."""
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "buckets": list(self.counts),
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99)}
+
+    def add(self, d):
+        self.counts = [a + b for a, b in zip(self.counts, d["buckets"])]
+        self.count += d["count"]
+        self.sum += d["sum"]
+
+
+class _Statement:
+    __slots__ = ("latency", "rows", "errors")
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.rows = 0
+        self.errors = 0
+
+
+class _Operation:
+    __slots__ = ("latency", "round_trips", "errors")
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.round_trips = 0
+        self.errors = 0
+
+
+class Metrics:
+    def __init__(self, slow_ms=SLOW_QUERY_MS):
+        self.slow_ms = slow_ms
+        self.statements = {}        # normalized sql -> _Statement
+        self.operations = {}        # name -> _Operation
+        self.slow = deque(maxlen=SLOW_LOG_SIZE)
+        self.slow_total = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    # ---- recording ----
+
+    def statement(self, sql, seconds, rows=0, failed=False):
+        key = normalize_sql(sql)
+        with self._lock:
+            st = self.statements.get(key)
+            if st is None:
+                st = self.statements[key] = _Statement()
+            st.latency.observe(seconds)
+            st.rows += max(rows, 0)
+            st.errors += failed
+            slow = seconds * 1000 >= self.slow_ms
+            if slow:
+                self.slow_total += 1
+                self.slow.append({"at": time.time(), "ms": round(seconds * 1000, 2), "sql": key})
+        op = _current_op.get()
+        if op is not None:
+            op[1] += 1
+        if slow:
+            slow_log.warning("slow query %.1f ms: %s", seconds * 1000, key)
+
+    def rows(self, sql, n):
+        key = normalize_sql(sql)
+        with self._lock:
+            st = self.statements.get(key)
+            if st is not None:
+                st.rows += n
+
+    def operation(self, name, seconds, round_trips, failed=False):
+        with self._lock:
+            op = self.operations.get(name)
+            if op is None:
+                op = self.operations[name] = _Operation()
+            op.latency.observe(seconds)
+            op.round_trips += round_trips
+            op.errors += failed
+
+    def reset(self):
+        with self._lock:
+            self.statements.clear()
+            self.operations.clear()
+            self.slow.clear()
+            self.slow_total = 0
+            self.started = time.time()
+
+    # ---- export ----
+
+    def snapshot(self):
+        """Everything as plain JSON-able data."""
+        with self._lock:
+            return {
+                "started": self.started,
+                "buckets": list(BUCKETS),
+                "statements": {
+                    sql: dict(st.latency.to_dict(), rows=st.rows, errors=st.errors)
+                    for sql, st in self.statements.items()
+                },
+                "operations": {
+                    name: dict(op.latency.to_dict(), round_trips=op.round_trips, errors=op.errors,
+                               round_trips_per_call=op.round_trips / op.latency.count if op.latency.count else 0.0)
+                    for name, op in self.operations.items()
+                },
+                "slow_queries": self.slow_total,
+                "slow": list(self.slow),
+            }
+
+    def dump_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=1)
+
+    def prometheus(self):
+        return prometheus_text(self.snapshot())
+
+
+def merge_snapshots(snapshots):
+    """One snapshot summing several (e.g. one per worker process)."""
+    statements, operations = {}, {}
+    slow, slow_total, started = [], 0, None
+    for snap in snapshots:
+        started = snap["started"] if started is None else min(started, snap["started"])
+        slow_total += snap["slow_queries"]
+        slow.extend(snap["slow"])
+        for table, merged, extra in ((snap["statements"], statements, ("rows", "errors")),
+                                     (snap["operations"], operations, ("round_trips", "errors"))):
+            for key, d in table.items():
+                h, totals = merged.setdefault(key, (Histogram(), dict.fromkeys(extra, 0)))
+                h.add(d)
+                for k in extra:
+                    totals[k] += d[k]
+    out = {
+        "started": started or time.time(),
+        "buckets": list(BUCKETS),
+        "statements": {k: dict(h.to_dict(), **t) for k, (h, t) in statements.items()},
+        "operations": {k: dict(h.to_dict(), **t, round_trips_per_call=t["round_trips"] / h.count if h.count else 0.0)
+                       for k, (h, t) in operations.items()},
+        "slow_queries": slow_total,
+        "slow": sorted(slow, key=lambda s: s["at"])[-SLOW_LOG_SIZE:],
+    }
+    return out
+
+
+def _label(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _histogram_lines(name, label, d):
+    lines, seen = [], 0
+    for bound, n in zip(BUCKETS + (float("inf"),), d["buckets"]):
+        seen += n
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append(f'{name}_bucket{{{label},le="{le}"}} {seen}')
+    lines.append(f"{name}_sum{{{label}}} {d['sum']!r}")
+    lines.append(f"{name}_count{{{label}}} {d['count']}")
+    return lines
+
+
+def prometheus_text(snap):
+    """Prometheus text exposition (version 0.0.4) of a snapshot."""
+    out = [
+        "# HELP lms_sql_seconds Statement execute latency by normalized SQL.",
+        "# TYPE lms_sql_seconds histogram",
+    ]
+    for sql, d in sorted(snap["statements"].items()):
+        out.extend(_histogram_lines("lms_sql_seconds", f'stmt="{_label(sql)}"', d))
+    out += ["# HELP lms_sql_rows_total Rows fetched or changed by normalized SQL.", "# TYPE lms_sql_rows_total counter"]
+    out += [f'lms_sql_rows_total{{stmt="{_label(sql)}"}} {d["rows"]}' for sql, d in sorted(snap["statements"].items())]
+    out += ["# HELP lms_sql_errors_total Statements that raised.", "# TYPE lms_sql_errors_total counter"]
+    out += [f'lms_sql_errors_total{{stmt="{_label(sql)}"}} {d["errors"]}' for sql, d in sorted(snap["statements"].items())]
+    out += ["# HELP lms_op_seconds Service operation latency.", "# TYPE lms_op_seconds histogram"]
+    for name, d in sorted(snap["operations"].items()):
+        out.extend(_histogram_lines("lms_op_seconds", f'op="{_label(name)}"', d))
+    out += ["# HELP lms_op_round_trips_total Statements executed on behalf of each operation.",
+            "# TYPE lms_op_round_trips_total counter"]
+    out += [f'lms_op_round_trips_total{{op="{_label(n)}"}} {d["round_trips"]}' for n, d in sorted(snap["operations"].items())]
+    out += ["# HELP lms_op_errors_total Operations that raised.", "# TYPE lms_op_errors_total counter"]
+    out += [f'lms_op_errors_total{{op="{_label(n)}"}} {d["errors"]}' for n, d in sorted(snap["operations"].items())]
+    out += ["# HELP lms_slow_queries_total Statements over the slow-query threshold.",
+            "# TYPE lms_slow_queries_total counter", f"lms_slow_queries_total {snap['slow_queries']}"]
+    return "\n".join(out) + "\n"
+
+
+METRICS = Metrics()
+
+# -------------------- CURSORS --------------------
+
+class InstrumentedCursor:
+    """Wraps a DB-API cursor: times execute(), counts rows fetched."""
+
+    def __init__(self, raw, metrics=None):
+        self.raw = raw
+        self._metrics = metrics or METRICS
+        self._sql = None
+
+    def _timed(self, run, sql):
+        self._sql = sql
+        started = time.perf_counter()
+        try:
+            run()
+        except Exception:
+            self._metrics.statement(sql, time.perf_counter() - started, failed=True)
+            raise
+        elapsed = time.perf_counter() - started
+        # SELECTs report rows as they are fetched; writes report what they changed
+        self._metrics.statement(sql, elapsed, self.raw.rowcount if self.raw.rowcount and self.raw.description is None else 0)
+
+    def execute(self, sql, params=()):
+        self._timed(lambda: self.raw.execute(sql, params), sql)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._timed(lambda: self.raw.executemany(sql, seq_of_params), sql)
+        return self
+
+    def _fetched(self, n):
+        if n and self._sql is not None:
+            self._metrics.rows(self._sql, n)
+
+    def fetchone(self):
+        row = self.raw.fetchone()
+        self._fetched(row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self.raw.fetchmany(size) if size else self.raw.fetchmany()
+        self._fetched(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.raw.fetchall()
+        self._fetched(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self.raw:
+            self._fetched(1)
+            yield row
+
+    def close(self):
+        self.raw.close()
+
+    @property
+    def rowcount(self):
+        return self.raw.rowcount
+
+    @property
+    def lastrowid(self):
+        return self.raw.lastrowid
+
+    @property
+    def description(self):
+        return self.raw.description
+
+
+class AsyncInstrumentedCursor:
+    """InstrumentedCursor for the awaitable cursors of lms_async."""
+
+    def __init__(self, raw, metrics=None):
+        self.raw = raw
+        self._metrics = metrics or METRICS
+        self._sql = None
+
+    async def execute(self, sql, params=()):
+        self._sql = sql
+        started = time.perf_counter()
+        try:
+            await self.raw.execute(sql, params)
+        except Exception:
+            self._metrics.statement(sql, time.perf_counter() - started, failed=True)
+            raise
+        self._metrics.statement(sql, time.perf_counter() - started, self.raw.rowcount if self.raw.rowcount > 0 else 0)
+        return self
+
+    async def fetchone(self):
+        row = await self.raw.fetchone()
+        if row is not None and self._sql is not None:
+            self._metrics.rows(self._sql, 1)
+        return row
+
+    async def fetchall(self):
+        rows = await self.raw.fetchall()
+        if rows and self._sql is not None:
+            self._metrics.rows(self._sql, len(rows))
+        return rows
+
+    async def close(self):
+        await self.raw.close()
+
+    @property
+    def rowcount(self):
+        return self.raw.rowcount
+
+    @property
+    def lastrowid(self):
+        return self.raw.lastrowid
+
+# -------------------- OPERATIONS --------------------
+
+_current_op = contextvars.ContextVar("lms_operation", default=None)     # [name, round trips] of the outermost call
+
+
+def _wrap(name, fn, metrics):
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_op(*args, **kwargs):
+            if _current_op.get() is not None:
+                return await fn(*args, **kwargs)
+            op = [name, 0]
+            token = _current_op.set(op)
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = await fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                _current_op.reset(token)
+                metrics.operation(name, time.perf_counter() - started, op[1], failed)
+        return async_op
+
+    @functools.wraps(fn)
+    def op_call(*args, **kwargs):
+        if _current_op.get() is not None:
+            return fn(*args, **kwargs)     # nested: counted in the caller's operation
+        op = [name, 0]
+        token = _current_op.set(op)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = fn(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            _current_op.reset(token)
+            metrics.operation(name, time.perf_counter() - started, op[1], failed)
+    return op_call
+
+
+def operations(cls, metrics=None):
+    """
+    Class decorator: every public method becomes an operation named after
+    it. Calls made from inside another operation count toward that one.
+    """
+    metrics = metrics or METRICS
+    for name, fn in list(vars(cls).items()):
+        if not name.startswith("_") and callable(fn) and not isinstance(fn, (staticmethod, classmethod, type)):
+            setattr(cls, name, _wrap(name, fn, metrics))
+    return cls
@@ -0,0 +1,300 @@
+"""
+Versioned schema migrations
+---------------------------
+MIGRATIONS is an ordered list of (version, description, statements). The
+schema_migrations table records what has been applied, so migrate() only
+runs what is new. Never edit a migration that has shipped; add a new one.
+
+A statement is either SQL (run on every backend), a (backend_name, SQL)
+pair for backend-specific work, e.g. the foreign-key indexes that InnoDB
+creates by itself but SQLite does not, or a callable(cur, backend) for
+data backfills that run in the migration's transaction.
+
+check_query_plans() EXPLAINs the hot queries and reports any that fall back
+to a full table scan.
+
+Usage:
+    python lms_migrations.py            # apply pending migrations
+    python lms_migrations.py --status   # list applied / pending
+    python lms_migrations.py --check    # fail if a hot query does a full scan
+
+"""
+
+import re
+import sys
+import datetime
+import argparse
+
+from lms_overdue import OVERDUE_SNAPSHOT_TABLE
+from lms_rollups import ROLLUP_TABLES, rebuild_rollups
+from lms_stock import STOCK_LEDGER_TABLE
+
+BASE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS books (
+        book_id VARCHAR(20) PRIMARY KEY,
+        title   VARCHAR(200) NOT NULL,
+        author  VARCHAR(100) NOT NULL,
+        category VARCHAR(100),
+        price   DECIMAL(10,2) NOT NULL,
+        stock   INT NOT NULL DEFAULT 0
+    ) ENGINE=InnoDB;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS staff (
+        staff_id INT AUTO_INCREMENT PRIMARY KEY,
+        name     VARCHAR(100) NOT NULL,
+        role     VARCHAR(100),
+        phone    VARCHAR(20)
+    ) ENGINE=InnoDB;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS members (
+        member_id INT AUTO_INCREMENT PRIMARY KEY,
+        name      VARCHAR(100) NOT NULL,
+        phone     VARCHAR(20),
+        email     VARCHAR(100),
+        membership_type VARCHAR(20) NOT NULL DEFAULT 'Regular' -- Regular or VIP
+    ) ENGINE=InnoDB;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS issues (
+        issue_id INT AUTO_INCREMENT PRIMARY KEY,
+        member_id INT NOT NULL,
+        book_id   VARCHAR(20) NOT NULL,
+        issue_date DATE NOT NULL,
+        due_date   DATE NOT NULL,
+        return_date DATE,
+        late_fee DECIMAL(8,2) DEFAULT 0.0,
+        CONSTRAINT fk_issue_member FOREIGN KEY (member_id) REFERENCES members(member_id),
+        CONSTRAINT fk_issue_book   FOREIGN KEY (book_id) REFERENCES books(book_id)
+    ) ENGINE=InnoDB;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS bills (
+        bill_id        INT AUTO_INCREMENT PRIMARY KEY,
+        member_id      INT,
+        bill_date      DATETIME NOT NULL,
+        subtotal       DECIMAL(10,2) NOT NULL,
+        discount_pct   DECIMAL(5,2)  NOT NULL DEFAULT 0.0,
+        discount_amt   DECIMAL(10,2) NOT NULL,
+        grand_total    DECIMAL(10,2) NOT NULL,
+        CONSTRAINT fk_bill_member FOREIGN KEY (member_id) REFERENCES members(member_id)
+    ) ENGINE=InnoDB;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS bill_items (
+        item_id   INT AUTO_INCREMENT PRIMARY KEY,
+        bill_id   INT NOT NULL,
+        book_id   VARCHAR(20) NOT NULL,
+        qty       INT NOT NULL,
+        unit_price DECIMAL(10,2) NOT NULL,
+        line_total DECIMAL(10,2) NOT NULL,
+        CONSTRAINT fk_bill_fk FOREIGN KEY (bill_id) REFERENCES bills(bill_id) ON DELETE CASCADE,
+        CONSTRAINT fk_bill_book FOREIGN KEY (book_id) REFERENCES books(book_id)
+    ) ENGINE=InnoDB;
+    """,
+]
+
+MIGRATIONS = [
+    (1, "base schema", BASE_SCHEMA),
+    (2, "indexes for hot query paths", [
+        "CREATE INDEX idx_issues_open ON issues (return_date, issue_date)",
+        "CREATE INDEX idx_issues_issue_date ON issues (issue_date)",
+        "CREATE INDEX idx_bills_bill_date ON bills (bill_date)",
+        "CREATE INDEX idx_books_category ON books (category)",
+        ("sqlite", "CREATE INDEX idx_issues_member ON issues (member_id)"),
+        ("sqlite", "CREATE INDEX idx_issues_book ON issues (book_id)"),
+        ("sqlite", "CREATE INDEX idx_bills_member ON bills (member_id)"),
+        ("sqlite", "CREATE INDEX idx_bill_items_bill ON bill_items (bill_id)"),
+        ("sqlite", "CREATE INDEX idx_bill_items_book ON bill_items (book_id)"),
+    ]),
+    (3, "index for the title-ordered books listing", [
+        "CREATE INDEX idx_books_title ON books (title, book_id)",
+    ]),
+    (4, "daily / monthly reporting rollups", ROLLUP_TABLES + [rebuild_rollups]),
+    (5, "nightly overdue snapshots", [
+        OVERDUE_SNAPSHOT_TABLE,
+        # covers the overdue scans: open issues in member order, due date read from the index
+        "CREATE INDEX idx_issues_overdue ON issues (return_date, member_id, due_date)",
+    ]),
+    (6, "stock ledger journal marker", [STOCK_LEDGER_TABLE]),
+]
+
+VERSION_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version     INT PRIMARY KEY,
+        description VARCHAR(200) NOT NULL,
+        applied_at  DATETIME NOT NULL
+    ) ENGINE=InnoDB;
+"""
+
+
+class FullScanError(Exception):
+    """A hot query's plan reads a whole table."""
+
+# -------------------- MIGRATE --------------------
+
+def applied_versions(pool):
+    with pool.connection() as con:
+        cur = con.cursor()
+        cur.execute(pool.backend.ddl(VERSION_TABLE))
+        con.commit()
+        cur.execute("SELECT version FROM schema_migrations")
+        versions = {r[0] for r in cur.fetchall()}
+        cur.close()
+    return versions
+
+
+def pending_migrations(pool):
+    done = applied_versions(pool)
+    return [m for m in MIGRATIONS if m[0] not in done]
+
+
+def migrate(pool, progress=None):
+    """Create the database if needed and apply pending migrations in order. Returns versions applied."""
+    pool.backend.create_database()
+    applied = []
+    for version, description, statements in pending_migrations(pool):
+        with pool.connection() as con:
+            cur = con.cursor()
+            for stmt in statements:
+                if callable(stmt):
+                    stmt(cur, pool.backend)
+                    continue
+                if isinstance(stmt, tuple):
+                    backend_name, stmt = stmt
+                    if backend_name != pool.backend.name:
+                        continue
+                cur.execute(pool.backend.ddl(stmt))
+            cur.execute(
+                "INSERT INTO schema_migrations (version, description, applied_at) VALUES (%s,%s,%s)",
+                (version, description, datetime.datetime.now())
+            )
+            con.commit()
+            cur.close()
+        applied.append(version)
+        if progress:
+            progress(version, description)
+    return applied
+
+# -------------------- PLAN CHECK --------------------
+
+def hot_queries():
+    """
+    name -> (sql, sample params, limited) for every query that must stay
+    index-driven. limited marks LIMITed keyset pages, where a scan in index
+    order is fine because it stops after one page.
+    """
+    from lms_paging import encode_token
+    from lms_rollups import BILL_REPORT_SQL, ISSUE_REPORT_SQL
+    from lms_service import (ACTIVE_ISSUES, BILL_ITEMS_SQL, BILLS_BY_MONTH, BILLS_LISTING, BOOK_SQL,
+                             BOOKS_LISTING, ISSUES_BY_MONTH, MEMBER_OVERDUE_SQL, MEMBER_SQL,
+                             MEMBERS_LISTING, STAFF_LISTING, month_range)
+    start, end = month_range("2025-08")
+    queries = {
+        "bill_items": (BILL_ITEMS_SQL, (1,), False),
+        "book_by_id": (BOOK_SQL, ("B1",), False),
+        "member_by_id": (MEMBER_SQL, (1,), False),
+        "books_by_category": ("SELECT book_id, title FROM books WHERE category=%s", ("Fiction",), False),
+        "member_overdue": (MEMBER_OVERDUE_SQL, (1, start), False),
+        "bill_report": (BILL_REPORT_SQL, ("day", start, end), False),
+        "issue_report": (ISSUE_REPORT_SQL, ("day", start, end), False),
+    }
+    listings = {
+        "books": (BOOKS_LISTING, (), ["M", "B1"]),
+        "staff": (STAFF_LISTING, (), [10]),
+        "members": (MEMBERS_LISTING, (), [10]),
+        "active_issues": (ACTIVE_ISSUES, (), [start, 10]),
+        "bills": (BILLS_LISTING, (), [10]),
+        "bills_by_month": (BILLS_BY_MONTH, (start, end), [datetime.datetime.combine(start, datetime.time()), 10]),
+    }
+    for by, keyset in ISSUES_BY_MONTH.items():
+        listings[f"issues_by_month[{by}]"] = (keyset, (start, end) * (keyset.where.count("%s") // 2), [start, 10])
+    for name, (keyset, params, sample_key) in listings.items():
+        sql, first_params, _ = keyset.query(params)
+        queries[name] = (sql, first_params, True)
+        sql, seek_params, _ = keyset.query(params, encode_token("n", sample_key))
+        queries[name + ":seek"] = (sql, seek_params, True)
+    return queries
+
+
+_SQLITE_SCAN = re.compile(r"^SCAN (\w+)")   # any SCAN reads every row, even via an index
+
+
+def _full_scans(cur, backend_name, sql, params, limited=False):
+    """Tables the plan reads in full (no usable index)."""
+    if backend_name == "sqlite":
+        cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+        plan = [row[-1] for row in cur.fetchall()]
+        # a LIMITed scan that already yields rows in ORDER BY order stops early
+        if limited and not any("TEMP B-TREE FOR ORDER BY" in line for line in plan):
+            return []
+        scans = []
+        for line in plan:
+            m = _SQLITE_SCAN.match(line)
+            if m and m.group(1) != "CONSTANT":
+                scans.append(line)
+        return scans
+    cur.execute("EXPLAIN " + sql, params)
+    cols = [d[0] for d in cur.description]
+    scans = []
+    for row in cur.fetchall():
+        r = dict(zip(cols, row))
+        # type ALL with usable keys is the optimizer preferring a scan on a tiny table
+        if r.get("type") == "ALL" and not r.get("possible_keys"):
+            scans.append(f"{r.get('table')}: full scan")
+    return scans
+
+
+def check_query_plans(pool):
+    """Returns {query name: [offending plan lines]} for hot queries that full-scan."""
+    bad = {}
+    with pool.connection() as con:
+        cur = con.cursor()
+        for name, (sql, params, limited) in hot_queries().items():
+            scans = _full_scans(cur, pool.backend.name, sql, params, limited)
+            if scans:
+                bad[name] = scans
+        cur.close()
+    return bad
+
+
+def assert_no_full_scans(pool):
+    bad = check_query_plans(pool)
+    if bad:
+        lines = [f"{name}: {'; '.join(scans)}" for name, scans in sorted(bad.items())]
+        raise FullScanError("Hot queries doing full table scans:\n  " + "\n  ".join(lines))
+
+# -------------------- CLI --------------------
+
+def main(argv=None):
+    from lms_db import get_pool
+
+    ap = argparse.ArgumentParser(description="Apply schema migrations / check query plans.")
+    ap.add_argument("--status", action="store_true", help="list applied and pending migrations")
+    ap.add_argument("--check", action="store_true", help="EXPLAIN hot queries, exit 1 on a full scan")
+    args = ap.parse_args(argv)
+
+    pool = get_pool()
+    try:
+        if args.status:
+            done = applied_versions(pool)
+            for version, description, _ in MIGRATIONS:
+                print(f"{version:>4}  {'applied' if version in done else 'pending':<8} {description}")
+            return 0
+        migrate(pool, progress=lambda v, d: print(f"Applied migration {v}: {d}"))
+        if args.check:
+            try:
+                assert_no_full_scans(pool)
+            except FullScanError as e:
+                print(e)
+                return 1
+            print("All hot queries use indexes.")
+        return 0
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""
+Money
+-----
+Amounts are Decimals with two places (rupees and paise), the same values
+the DECIMAL(…,2) columns hold, from the books row to the bill, fee and
+rollup rows written back. Nothing goes through float, so a bill's
+subtotal is always exactly the sum of its bill_items.line_total.
+
+Past money() on the way in, only one step rounds: taking a percentage
+(a discount) rounds half up to the paisa. Multiplying by a quantity and
+adding never need to.
+
+    price = stored(row[4])                  # the column's Decimal; a float / str / int goes through money()
+    subtotal = total([price * 3, ...])
+    discount = percent_of(subtotal, money(12.5))
+
+Synthetic data keeps prices as whole paise: from_paise(1999) == Decimal("19.99").
+
+"""
+
+from decimal import ROUND_HALF_UP, Decimal
+
+CENT = Decimal("0.01")
+ZERO = Decimal("0.00")
+HUNDRED = Decimal("100.00")
+
+
+def money(amount):
+    """amount (Decimal, int, str or float) as a two-place Decimal, rounded half up; None -> 0.00."""
+    if amount is None:
+        return ZERO
+    if not isinstance(amount, Decimal):
+        # repr(float) is the shortest string that reads back as the same float, i.e. the price as typed
+        amount = Decimal(repr(amount) if isinstance(amount, float) else str(amount))
+    return amount.quantize(CENT, ROUND_HALF_UP)
+
+
+def stored(amount):
+    """
+    A value read back from a DECIMAL(…,2) column. A Decimal already has its
+    two places, so it is used as it is; anything else goes through money().
+    """
+    return amount if type(amount) is Decimal else money(amount)
+
+
+def from_paise(paise):
+    """Whole paise (int) as a two-place Decimal."""
+    return Decimal(paise).scaleb(-2)
+
+
+def total(amounts):
+    """Exact sum of money amounts; 0.00 for none."""
+    return sum(amounts, ZERO)
+
+
+def percent_of(amount, pct):
+    """pct percent of amount, rounded half up to the paisa."""
+    return (amount * pct).scaleb(-2).quantize(CENT, ROUND_HALF_UP)
@@ -0,0 +1,210 @@
+"""
+Overdue engine
+--------------
+Accrued late fees on books that are still out, computed in the database
+with one set-based statement per chunk of members rather than row by row
+in Python.
+
+Fee rules are per membership type (FEE_RULES): a daily rate, optional
+grace days before fees start, and an optional cap per issue. The same
+rules price a late return, so the fee a member is quoted is the fee they
+pay.
+
+The nightly snapshot writes one row per member with overdue books into
+overdue_snapshots (items, worst lateness, accrued fee). Schedule it:
+
+    python lms_overdue.py                      # snapshot as of today
+    python lms_overdue.py --date 2025-08-31    # or a given day
+    python lms_overdue.py --summary            # live totals, no snapshot
+
+"""
+
+import sys
+import time
+import datetime
+import argparse
+from decimal import Decimal
+from dataclasses import dataclass
+
+from lms_money import ZERO, money
+
+LATE_FEE_PER_DAY = Decimal("5.00")      # Rs. per day late
+SNAPSHOT_CHUNK = 20000      # members per snapshot statement / transaction
+
+
+@dataclass(frozen=True)
+class FeeRule:
+    per_day: Decimal
+    grace_days: int = 0         # days after the due date that are free
+    max_fee: Decimal = None     # cap per issue; None = no cap
+
+    def fee(self, days_late):
+        days = days_late - self.grace_days
+        if days <= 0:
+            return ZERO
+        fee = days * money(self.per_day)
+        return fee if self.max_fee is None else min(fee, money(self.max_fee))
+
+
+FEE_RULES = {
+    "Regular": FeeRule(LATE_FEE_PER_DAY),
+    "VIP": FeeRule(LATE_FEE_PER_DAY),
+}
+DEFAULT_FEE_RULE = FeeRule(LATE_FEE_PER_DAY)     # membership types without a rule of their own
+
+OVERDUE_SNAPSHOT_TABLE = """
+    CREATE TABLE IF NOT EXISTS overdue_snapshots (
+        snapshot_date   DATE        NOT NULL,
+        member_id       INT         NOT NULL,
+        membership_type VARCHAR(20) NOT NULL,
+        overdue_items   INT         NOT NULL,
+        max_days_late   INT         NOT NULL,
+        accrued_fee     DECIMAL(12,2) NOT NULL,
+        PRIMARY KEY (snapshot_date, member_id)
+    ) ENGINE=InnoDB;
+"""
+
+
+@dataclass
+class SnapshotStats:
+    snapshot_date: datetime.date
+    members: int = 0
+    items: int = 0
+    accrued_fee: Decimal = ZERO
+    chunks: int = 0
+    seconds: float = 0.0
+
+
+def fee_for(membership_type, days_late):
+    """Late fee for one issue returned days_late days after its due date."""
+    return FEE_RULES.get(membership_type, DEFAULT_FEE_RULE).fee(days_late)
+
+# -------------------- SQL --------------------
+
+def _rule_sql(rule, days):
+    over = f"({days} - {int(rule.grace_days)})"
+    fee = f"{over} * {money(rule.per_day)}"
+    if rule.max_fee is not None:
+        cap = money(rule.max_fee)
+        fee = f"CASE WHEN {fee} > {cap} THEN {cap} ELSE {fee} END"
+    return f"CASE WHEN {over} <= 0 THEN 0 ELSE {fee} END"
+
+
+def fee_sql(type_col, days):
+    """
+    SQL expression for the accrued fee of one row, from its membership type
+    column and days-late expression. -> (sql, params). Rates are numbers
+    from FEE_RULES, so they are inlined; the type names are parameters.
+    """
+    whens, params = [], []
+    for mtype, rule in FEE_RULES.items():
+        whens.append(f"WHEN %s THEN {_rule_sql(rule, days)}")
+        params.append(mtype)
+    return f"CASE {type_col} {' '.join(whens)} ELSE {_rule_sql(DEFAULT_FEE_RULE, days)} END", params
+
+
+def _overdue_rows_sql(backend, member_range):
+    """Derived table of open, overdue issues with their days late as of the first parameter."""
+    days = backend.days_between_sql("%s", "i.due_date")
+    where = "AND i.member_id > %s AND i.member_id <= %s" if member_range else ""
+    return f"""
+        SELECT i.member_id, m.membership_type, {days} AS days
+        FROM issues i
+        JOIN members m ON m.member_id = i.member_id
+        WHERE i.return_date IS NULL AND i.due_date < %s {where}
+    """
+
+# -------------------- LIVE --------------------
+
+def overdue_summary(pool, as_of=None):
+    """
+    Live liability by membership type as of a date (default today):
+    [(membership_type, overdue_items, max_days_late, accrued_fee)].
+    """
+    as_of = as_of or datetime.date.today()
+    fee, fee_params = fee_sql("o.membership_type", "o.days")
+    sql = f"""
+        SELECT o.membership_type, COUNT(*), MAX(o.days), SUM({fee})
+        FROM ({_overdue_rows_sql(pool.backend, False)}) o
+        GROUP BY o.membership_type
+        ORDER BY o.membership_type
+    """
+    with pool.connection() as con:
+        cur = con.cursor()
+        cur.execute(sql, fee_params + [as_of, as_of])
+        rows = cur.fetchall()
+        cur.close()
+    return [(mtype, n, int(worst), money(total)) for mtype, n, worst, total in rows]
+
+# -------------------- SNAPSHOT --------------------
+
+def snapshot(pool, as_of=None, chunk=SNAPSHOT_CHUNK, progress=None):
+    """
+    Write the overdue snapshot for as_of (default today), replacing any
+    earlier one for that date. Members are processed in id ranges of
+    `chunk`, one INSERT ... SELECT and one short transaction each.
+    Returns SnapshotStats.
+    """
+    as_of = as_of or datetime.date.today()
+    stats = SnapshotStats(as_of)
+    started = time.perf_counter()
+    fee, fee_params = fee_sql("o.membership_type", "o.days")
+    insert = f"""
+        INSERT INTO overdue_snapshots
+            (snapshot_date, member_id, membership_type, overdue_items, max_days_late, accrued_fee)
+        SELECT %s, o.member_id, o.membership_type, COUNT(*), MAX(o.days), SUM({fee})
+        FROM ({_overdue_rows_sql(pool.backend, True)}) o
+        GROUP BY o.member_id, o.membership_type
+    """
+
+    def clear(cur):
+        cur.execute("DELETE FROM overdue_snapshots WHERE snapshot_date=%s", (as_of,))
+        cur.execute("SELECT MAX(member_id) FROM members")
+        return cur.fetchone()[0] or 0
+
+    last_member = pool.run_in_transaction(clear)
+    for lo in range(0, last_member, chunk):
+        pool.run_in_transaction(
+            lambda cur: cur.execute(insert, [as_of] + fee_params + [as_of, as_of, lo, lo + chunk]))
+        stats.chunks += 1
+        if progress:
+            stats.seconds = time.perf_counter() - started
+            progress(stats)
+
+    with pool.connection() as con:
+        cur = con.cursor()
+        cur.execute("SELECT COUNT(*), SUM(overdue_items), SUM(accrued_fee) FROM overdue_snapshots WHERE snapshot_date=%s", (as_of,))
+        members, items, total = cur.fetchone()
+        cur.close()
+    stats.members, stats.items, stats.accrued_fee = members, int(items or 0), money(total)
+    stats.seconds = time.perf_counter() - started
+    return stats
+
+# -------------------- CLI --------------------
+
+def main(argv=None):
+    from lms_db import get_pool
+    from lms_migrations import migrate
+
+    ap = argparse.ArgumentParser(description="Overdue liability: nightly snapshot or live summary.")
+    ap.add_argument("--date", type=datetime.date.fromisoformat, help="as-of date YYYY-MM-DD (default: today)")
+    ap.add_argument("--summary", action="store_true", help="print live totals by membership type, no snapshot")
+    args = ap.parse_args(argv)
+
+    pool = get_pool()
+    try:
+        migrate(pool)
+        if args.summary:
+            for mtype, items, worst, total in overdue_summary(pool, args.date):
+                print(f"{mtype:<8} | {items:>9} overdue | worst {worst:>4} days | Rs.{total:,.2f}")
+            return 0
+        stats = snapshot(pool, args.date)
+        print(f"Snapshot {stats.snapshot_date}: {stats.members} members, {stats.items} overdue items, "
+              f"Rs.{stats.accrued_fee:,.2f} accrued ({stats.seconds:.2f}s)")
+        return 0
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""
+Keyset (seek) pagination
+------------------------
+A Keyset describes a listing: its SELECT, an optional fixed filter and the
+ORDER BY keys (which must end in something unique, e.g. the primary key).
+Pages are fetched with "WHERE key > last seen key ... LIMIT n" instead of
+OFFSET, so page 10,000 costs the same as page 1.
+
+Page tokens are opaque strings holding the boundary key and a direction;
+hand one back to get the next or previous page. With record= (a type from
+lms_records.py) each page's rows are built as that instead of plain tuples.
+
+    BOOKS = Keyset("SELECT book_id, title FROM books", [("title", 1), ("book_id", 0)])
+    page = fetch_page(con, BOOKS, limit=20)
+    page = fetch_page(con, BOOKS, token=page.next_token, limit=20)
+
+"""
+
+import json
+import base64
+import datetime
+from dataclasses import dataclass, field
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 500
+
+
+@dataclass
+class Page:
+    rows: list = field(default_factory=list)
+    next_token: str = None
+    prev_token: str = None
+
+
+class Keyset:
+    """
+    keys: [(sql_expr, row_index[, descending])] in ORDER BY order. row_index
+    is where that key's value sits in each selected row. record: a
+    namedtuple type to build each row as, or None for the plain tuples.
+    """
+
+    def __init__(self, select, keys, where="", record=None):
+        self.select = select.strip()
+        self.keys = [(k[0], k[1], k[2] if len(k) > 2 else False) for k in keys]
+        self.where = where.strip()
+        self.record = record
+
+    def _seek(self, values, backwards):
+        """WHERE fragment for rows strictly after (or before) `values` in listing order."""
+        ops = []
+        for _, _, desc in self.keys:
+            ops.append("<" if desc != backwards else ">")
+        ors, params = [], []
+        for i, (expr, _, _) in enumerate(self.keys):
+            parts = [f"{e} = %s" for e, _, _ in self.keys[:i]] + [f"{expr} {ops[i]} %s"]
+            ors.append("(" + " AND ".join(parts) + ")")
+            params.extend(values[:i + 1])
+        # a plain range on the leading key lets the database use an index for the seek
+        first = self.keys[0][0]
+        sql = f"{first} {ops[0]}= %s AND ({' OR '.join(ors)})"
+        return sql, [values[0]] + params
+
+    def query(self, params=(), token=None, limit=DEFAULT_PAGE_SIZE):
+        """(sql, params, backwards) for one page; fetches limit + 1 rows to see if there is more."""
+        conds = [f"({self.where})"] if self.where else []
+        params = list(params)
+        backwards = False
+        if token:
+            direction, values = decode_token(token, len(self.keys))
+            backwards = direction == "p"
+            seek_sql, seek_params = self._seek(values, backwards)
+            conds.append(seek_sql)
+            params.extend(seek_params)
+        order = ", ".join(
+            f"{expr} {'DESC' if desc != backwards else 'ASC'}" for expr, _, desc in self.keys
+        )
+        where = f" WHERE {' AND '.join(conds)}" if conds else ""
+        return f"{self.select}{where} ORDER BY {order} LIMIT {int(limit) + 1}", tuple(params), backwards
+
+    def token_for(self, row, direction):
+        return encode_token(direction, [row[i] for _, i, _ in self.keys])
+
+
+def page_size(limit):
+    """Requested page size clamped to 1..MAX_PAGE_SIZE."""
+    return max(1, min(int(limit), MAX_PAGE_SIZE))
+
+
+def page_from_rows(keyset, rows, token=None, limit=DEFAULT_PAGE_SIZE, backwards=False):
+    """Page from the (up to limit + 1) rows fetched for keyset.query(..., token, limit)."""
+    more = len(rows) > limit
+    rows = rows[:limit] if keyset.record is None else list(map(keyset.record._make, rows[:limit]))
+    if backwards:
+        rows.reverse()
+    page = Page(rows)
+    if rows:
+        # going forward there is an earlier page iff we came from one; going back, iff we got limit + 1
+        has_prev = more if backwards else bool(token)
+        has_next = True if backwards else more
+        if has_next:
+            page.next_token = keyset.token_for(rows[-1], "n")
+        if has_prev:
+            page.prev_token = keyset.token_for(rows[0], "p")
+    return page
+
+
+def fetch_page(con, keyset, params=(), token=None, limit=DEFAULT_PAGE_SIZE):
+    limit = page_size(limit)
+    sql, params, backwards = keyset.query(params, token, limit)
+    cur = con.cursor()
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+    cur.close()
+    return page_from_rows(keyset, rows, token, limit, backwards)
+
+# -------------------- TOKENS --------------------
+
+def _enc(v):
+    if isinstance(v, datetime.datetime):
+        return {"T": v.isoformat(" ")}
+    if isinstance(v, datetime.date):
+        return {"D": v.isoformat()}
+    return v
+
+
+def _dec(v):
+    if isinstance(v, dict):
+        if "T" in v:
+            return datetime.datetime.fromisoformat(v["T"])
+        if "D" in v:
+            return datetime.date.fromisoformat(v["D"])
+        raise ValueError("bad key value")
+    return v
+
+
+def encode_token(direction, values):
+    raw = json.dumps([direction, [_enc(v) for v in values]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_token(token, n_keys):
+    """-> (direction 'n'|'p', key values). Raises ValueError on a malformed token."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        direction, values = json.loads(raw)
+        values = [_dec(v) for v in values]
+    except Exception:
+        raise ValueError("Invalid page token.")
+    if direction not in ("n", "p") or len(values) != n_keys:
+        raise ValueError("Invalid page token.")
+    return direction, values
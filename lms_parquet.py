@@ -0,0 +1,326 @@
+"""
+Columnar (Parquet) export and analytics snapshots
+-------------------------------------------------
+Typed, compressed alternative to the CSV exports: DECIMAL columns stay
+decimal128, DATE / DATETIME / TIME stay dates and timestamps, ids are
+integers. Rows are streamed from an unbuffered cursor and written as
+record batches of BATCH_ROWS, so memory stays flat. Needs pyarrow
+(pip install pyarrow); nothing else in the system does.
+
+    python lms_parquet.py export issues issues.parquet
+    python lms_parquet.py snapshot /data/lms          # nightly: only what's new
+    python lms_parquet.py snapshot /data/lms --full   # rewrite everything
+
+A snapshot directory holds one dataset per name (SNAPSHOT), each a folder
+of part files that pyarrow / pandas / DuckDB read as one table, plus
+_snapshot.json recording the last key written per dataset. An incremental
+run appends a part with only the rows whose key is above that. Bills and
+bill_items never change once written, but their ids are not handed out in
+commit order (MySQL assigns auto-increment ids at INSERT), so a bill that
+commits after a run has already read past its id would be skipped for
+good. Rows are never deleted from these tables, so each incremental run
+checks the dataset's row total against COUNT(*) taken before it read, and
+rewrites the dataset when a row is missing: everything committed before a
+run started is in the snapshot after it. books, members and staff change
+in place and are rewritten in full every time. issues are appended by
+issue_id: a book returned after its issue went into a snapshot keeps its
+empty return_date there until the next --full run.
+
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+from decimal import Decimal
+from dataclasses import dataclass
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:     # optional: only the Parquet export needs it
+    pa = pq = None
+
+from lms_export import (BILLS_DETAILED_COLS, BILLS_DETAILED_SQL, ISSUES_DETAILED_COLS, ISSUES_DETAILED_SQL,
+                        TABLE_KEYS, ExportStats, peak_rss_kb, stream_rows)
+
+BATCH_ROWS = 65536          # rows per record batch / row group
+COMPRESSION = "zstd"
+MANIFEST = "_snapshot.json"
+
+# column types: str, int, float, date, datetime, time, or dec(precision,scale) as declared in lms_migrations
+TABLE_COLUMNS = {
+    "books": [("book_id", "str"), ("title", "str"), ("author", "str"), ("category", "str"),
+              ("price", "dec(10,2)"), ("stock", "int")],
+    "staff": [("staff_id", "int"), ("name", "str"), ("role", "str"), ("phone", "str")],
+    "members": [("member_id", "int"), ("name", "str"), ("phone", "str"), ("email", "str"),
+                ("membership_type", "str")],
+    "issues": [("issue_id", "int"), ("member_id", "int"), ("book_id", "str"), ("issue_date", "date"),
+               ("due_date", "date"), ("return_date", "date"), ("late_fee", "dec(8,2)")],
+    "bills": [("bill_id", "int"), ("member_id", "int"), ("bill_date", "datetime"), ("subtotal", "dec(10,2)"),
+              ("discount_pct", "dec(5,2)"), ("discount_amt", "dec(10,2)"), ("grand_total", "dec(10,2)")],
+    "bill_items": [("item_id", "int"), ("bill_id", "int"), ("book_id", "str"), ("qty", "int"),
+                   ("unit_price", "dec(10,2)"), ("line_total", "dec(10,2)")],
+}
+ISSUES_DETAILED_TYPES = ["int", "int", "str", "str", "str", "str", "date", "date", "date", "dec(8,2)"]
+BILLS_DETAILED_TYPES = ["int", "date", "time", "str", "str", "dec(10,2)", "dec(5,2)", "dec(10,2)", "dec(10,2)"]
+
+
+@dataclass(frozen=True)
+class Source:
+    """A table or detailed join to export. The key is always the first column."""
+    sql: str                # with a {where} slot, ordered by the key
+    key_ref: str            # the key column as the query names it
+    columns: list           # [(name, type)]
+    table: str              # one row per row of this table, for counting them
+
+
+def _table_source(table):
+    cols = TABLE_COLUMNS[table]
+    key = TABLE_KEYS[table]
+    return Source(f"SELECT {', '.join(c for c, _ in cols)} FROM {table} {{where}} ORDER BY {key}", key, cols, table)
+
+
+SOURCES = {table: _table_source(table) for table in TABLE_COLUMNS}
+SOURCES["issues_detailed"] = Source(ISSUES_DETAILED_SQL, "i.issue_id",
+                                    list(zip(ISSUES_DETAILED_COLS, ISSUES_DETAILED_TYPES)), "issues")
+SOURCES["bills_detailed"] = Source(BILLS_DETAILED_SQL, "b.bill_id",
+                                   list(zip(BILLS_DETAILED_COLS, BILLS_DETAILED_TYPES)), "bills")
+
+SNAPSHOT = ("books", "members", "issues", "bills", "bill_items", "issues_detailed", "bills_detailed")
+REFRESHED = {"books", "members", "staff"}   # rows change in place: rewritten on every snapshot
+
+
+def _require():
+    if pa is None:
+        raise RuntimeError("pyarrow is not installed. Run: pip install pyarrow")
+
+# -------------------- TYPES --------------------
+
+def _arrow_type(kind):
+    if kind.startswith("dec("):
+        precision, scale = kind[4:-1].split(",")
+        return pa.decimal128(int(precision), int(scale))
+    return {"str": pa.string(), "int": pa.int32(), "float": pa.float64(), "date": pa.date32(),
+            "datetime": pa.timestamp("s"), "time": pa.time32("s")}[kind]
+
+
+def arrow_schema(columns):
+    """Arrow schema for [(name, type)] columns as in TABLE_COLUMNS."""
+    _require()
+    return pa.schema([(col, _arrow_type(kind)) for col, kind in columns])
+
+
+def schema_for(name):
+    """The Arrow schema a dataset is written with."""
+    return arrow_schema(SOURCES[name].columns)
+
+
+def _to_decimal(scale):
+    quantum = Decimal(1).scaleb(-scale)
+
+    def convert(v):
+        if v is None or isinstance(v, Decimal):
+            return v if v is None else v.quantize(quantum)
+        return Decimal(repr(v)).quantize(quantum)     # SQLite hands DECIMAL back as float / int
+    return convert
+
+
+def _to_date(v):
+    if isinstance(v, str):
+        return datetime.date.fromisoformat(v[:10])
+    return v.date() if isinstance(v, datetime.datetime) else v
+
+
+def _to_datetime(v):
+    return datetime.datetime.fromisoformat(v) if isinstance(v, str) else v
+
+
+def _to_time(v):
+    if isinstance(v, str):
+        return datetime.time.fromisoformat(v)
+    if isinstance(v, datetime.timedelta):             # MySQL returns TIME as a timedelta
+        return (datetime.datetime.min + v).time()
+    return v
+
+
+def _converter(kind):
+    """Per-value conversion to what pyarrow takes for the type, or None if values go in as they are."""
+    if kind.startswith("dec("):
+        return _to_decimal(int(kind[4:-1].split(",")[1]))
+    return {"float": float, "date": _to_date, "datetime": _to_datetime, "time": _to_time}.get(kind)
+
+
+def converters(columns):
+    """The per-column converters record_batch() takes, for [(name, type)] columns."""
+    return [_converter(kind) for _, kind in columns]
+
+
+def record_batch(schema, column_converters, rows):
+    """One RecordBatch from a chunk of row tuples; column_converters is converters() for the schema's columns."""
+    arrays = []
+    for values, convert, f in zip(zip(*rows), column_converters, schema):
+        if convert is not None:
+            values = [None if v is None else convert(v) for v in values]
+        arrays.append(pa.array(values, type=f.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+# -------------------- EXPORT --------------------
+
+def export_parquet(pool, name, filename, after=None, batch_size=BATCH_ROWS, compression=COMPRESSION,
+                   progress=None):
+    """
+    Write dataset `name` (a SOURCES key), or just its rows with a key above
+    `after`, to one Parquet file. The file appears only once complete and
+    only if there were rows. Returns ExportStats (last_key = the highest
+    key written).
+    """
+    _require()
+    if name not in SOURCES:
+        raise ValueError(f"Invalid name for export: {name}")
+    source = SOURCES[name]
+    schema = schema_for(name)
+    convert = converters(source.columns)
+    where, params = ("", ()) if after is None else (f"WHERE {source.key_ref} > %s", (after,))
+    stats = ExportStats(filename)
+    started = time.perf_counter()
+    tmp = filename + ".tmp"
+    writer = None
+    try:
+        with pool.connection() as con:
+            for _, chunk in stream_rows(con, source.sql.format(where=where), params, batch_size):
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp, schema, compression=compression)
+                writer.write_batch(record_batch(schema, convert, chunk))
+                stats.rows += len(chunk)
+                stats.last_key = chunk[-1][0]
+                if progress:
+                    stats.seconds = time.perf_counter() - started
+                    progress(stats)
+        if writer is not None:
+            writer.close()
+            writer = None
+            os.replace(tmp, filename)
+    finally:
+        if writer is not None:
+            writer.close()
+            os.remove(tmp)
+    stats.seconds = time.perf_counter() - started
+    stats.peak_rss_kb = peak_rss_kb()
+    return stats
+
+# -------------------- SNAPSHOT --------------------
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(path + ".tmp", path)
+
+
+def _row_count(pool, name):
+    with pool.connection() as con:
+        cur = con.cursor()
+        cur.execute(f"SELECT COUNT(*) FROM {SOURCES[name].table}")
+        n = cur.fetchone()[0]
+        cur.close()
+        return n
+
+
+def snapshot(pool, directory, names=SNAPSHOT, full=False, progress=None):
+    """
+    Bring the snapshot in `directory` up to date: append a part with the new
+    rows of each dataset, or rewrite it (full=True, a dataset seen for the
+    first time, one of REFRESHED, or one that turns out to be missing a
+    row below its last key). The manifest is updated after each
+    dataset, so an interrupted run leaves every dataset consistent.
+    Returns {name: ExportStats for the part written this run}.
+    """
+    _require()
+    unknown = [n for n in names if n not in SOURCES]
+    if unknown:
+        raise ValueError(f"Invalid name for export: {', '.join(unknown)}")
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory)
+    written = {}
+    for name in names:
+        entry = manifest.get(name) or {"parts": [], "rows": 0, "last_key": None, "next_part": 1}
+        rewrite = full or name in REFRESHED or not entry["parts"]
+        folder = os.path.join(directory, name)
+        os.makedirs(folder, exist_ok=True)
+        part = f"part-{entry['next_part']:06d}.parquet"
+        expected = None if rewrite else _row_count(pool, name)
+        stats = export_parquet(pool, name, os.path.join(folder, part), None if rewrite else entry["last_key"],
+                               progress=progress)
+        if expected is not None and entry["rows"] + stats.rows < expected:
+            # a row below last_key committed after an earlier run read past its id: start over
+            if stats.rows:
+                os.remove(os.path.join(folder, part))
+            rewrite = True
+            stats = export_parquet(pool, name, os.path.join(folder, part), progress=progress)
+
+        stale = entry["parts"] if rewrite else []
+        if rewrite:
+            entry.update(parts=[], rows=0, last_key=None)
+        if stats.rows:
+            entry["parts"].append(part)
+            entry["rows"] += stats.rows
+            entry["last_key"] = stats.last_key
+            entry["next_part"] += 1
+        entry["updated"] = datetime.datetime.now().isoformat(timespec="seconds")
+        manifest[name] = entry
+        _write_manifest(directory, manifest)
+        for old in stale:
+            path = os.path.join(folder, old)
+            if os.path.exists(path):
+                os.remove(path)
+        written[name] = stats
+    return written
+
+# -------------------- CLI --------------------
+
+def main(argv=None):
+    from lms_db import get_pool
+
+    ap = argparse.ArgumentParser(description="Parquet exports and incremental analytics snapshots.")
+    sub = ap.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("export", help="one table or detailed export to a Parquet file")
+    p.add_argument("name", choices=sorted(SOURCES))
+    p.add_argument("filename")
+    p.add_argument("--after", help="only rows with a key above this")
+    p = sub.add_parser("snapshot", help="append new rows to (or create) a snapshot directory")
+    p.add_argument("directory")
+    p.add_argument("--full", action="store_true", help="rewrite every dataset")
+    p.add_argument("--names", default=",".join(SNAPSHOT), help="comma-separated datasets (default: all)")
+    args = ap.parse_args(argv)
+
+    pool = get_pool()
+    try:
+        if args.command == "export":
+            after = int(args.after) if args.after and args.after.isdigit() else args.after
+            results = {args.name: export_parquet(pool, args.name, args.filename, after)}
+        else:
+            results = snapshot(pool, args.directory, [n.strip() for n in args.names.split(",")], args.full)
+        for name, stats in results.items():
+            print(f"{name:>16}: {stats.rows:>10,} rows in {stats.seconds:6.2f}s  "
+                  f"(last key {stats.last_key}, peak RSS {stats.peak_rss_kb // 1024} MB)")
+        return 0
+    except (ValueError, RuntimeError) as e:
+        print(e)
+        return 1
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,46 @@
+"""
+Row records
+-----------
+Named, tuple-backed records for the rows the services hand out: book, staff
+and member lookups, the paged listings, bill items and overdue items.
+
+Each is a collections.namedtuple, so a record is the cursor's tuple with
+field names on top: no per-row __dict__ (about a third of the memory of a
+dict per row), built straight from a fetched row with Book._make(row), and
+row[5] / unpacking keep working wherever the code still indexes.
+
+    book = Book._make(cur.fetchone())
+    book.title, book.stock
+    rows = records(BillItem, cur.fetchall())
+    book._replace(stock=0)
+
+Field names are the JSON keys lms_http.py sends.
+
+"""
+
+from collections import namedtuple
+
+Book = namedtuple("Book", "book_id title author category price stock")
+Staff = namedtuple("Staff", "staff_id name role phone")
+Member = namedtuple("Member", "member_id name phone email membership_type")
+
+# circulation listings (lms_service.ACTIVE_ISSUES, ISSUES_BY_MONTH)
+OpenIssue = namedtuple("OpenIssue", "issue_id member_name member_id title book_id issue_date due_date")
+Issue = namedtuple("Issue", OpenIssue._fields + ("return_date", "late_fee", "activity_date"))
+OverdueItem = namedtuple("OverdueItem", "issue_id book_id title due_date days_late fee")
+
+# billing listings (lms_service.BILLS_LISTING, BILLS_BY_MONTH, BILL_ITEMS_SQL)
+Bill = namedtuple("Bill", "bill_id member_id bill_date subtotal discount_amt grand_total")
+MonthBill = namedtuple("MonthBill", "bill_id bill_date customer membership_type subtotal discount_pct "
+                                    "discount_amt grand_total")
+BillItem = namedtuple("BillItem", "item_id book_id title qty unit_price line_total")
+
+
+def record(cls, row):
+    """cls for one fetched row, or None for no row."""
+    return None if row is None else cls._make(row)
+
+
+def records(cls, rows):
+    """A list of cls, one per fetched row."""
+    return list(map(cls._make, rows))
@@ -0,0 +1,265 @@
+"""
+Reporting rollups
+-----------------
+Per-day and per-month aggregates of billing and circulation, kept up to
+date inside the same transaction as the bill / issue / return they count,
+so month-end reports read a few dozen rollup rows instead of scanning and
+joining the raw tables.
+
+    bill_rollups   (grain, period, membership_type) -> bills, subtotal, discount_amt, grand_total
+    issue_rollups  (grain, period)                  -> issues, returns, late_fees
+
+grain is 'day' (period = that date) or 'month' (period = the 1st). Guest
+bills count under membership type 'Guest'. A bill counts under the
+member's type when it was made; a rebuild uses the member's current type.
+
+Rebuild (backfill) from history, e.g. after loading old data by hand:
+    python lms_rollups.py              # everything
+    python lms_rollups.py 2025-08      # one month
+
+Rebuild while the desks are quiet: bills committed during a rebuild of
+the same month can be counted twice or not at all.
+
+"""
+
+import sys
+import datetime
+import argparse
+
+from lms_db import multirow_insert_sql, prepare
+from lms_money import ZERO, money
+
+GRAINS = ("day", "month")
+GUEST = "Guest"
+
+BILL_KEYS = ("grain", "period", "membership_type")
+BILL_SUMS = ("bills", "subtotal", "discount_amt", "grand_total")
+ISSUE_KEYS = ("grain", "period")
+ISSUE_SUMS = ("issues", "returns", "late_fees")
+
+ROLLUP_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS bill_rollups (
+        grain           VARCHAR(5)  NOT NULL,
+        period          DATE        NOT NULL,
+        membership_type VARCHAR(20) NOT NULL,
+        bills           INT NOT NULL DEFAULT 0,
+        subtotal        DECIMAL(14,2) NOT NULL DEFAULT 0,
+        discount_amt    DECIMAL(14,2) NOT NULL DEFAULT 0,
+        grand_total     DECIMAL(14,2) NOT NULL DEFAULT 0,
+        PRIMARY KEY (grain, period, membership_type)
+    ) ENGINE=InnoDB;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS issue_rollups (
+        grain     VARCHAR(5) NOT NULL,
+        period    DATE       NOT NULL,
+        issues    INT NOT NULL DEFAULT 0,
+        returns   INT NOT NULL DEFAULT 0,
+        late_fees DECIMAL(14,2) NOT NULL DEFAULT 0,
+        PRIMARY KEY (grain, period)
+    ) ENGINE=InnoDB;
+    """,
+]
+
+BILL_REPORT_SQL = """
+    SELECT period, membership_type, bills, subtotal, discount_amt, grand_total
+    FROM bill_rollups
+    WHERE grain = %s AND period >= %s AND period < %s
+    ORDER BY period, membership_type
+"""
+
+ISSUE_REPORT_SQL = """
+    SELECT period, issues, returns, late_fees
+    FROM issue_rollups
+    WHERE grain = %s AND period >= %s AND period < %s
+    ORDER BY period
+"""
+
+
+def _periods(day):
+    return (("day", day), ("month", day.replace(day=1)))
+
+
+def _as_date(v):
+    """DATE() comes back as a string from SQLite."""
+    if isinstance(v, datetime.datetime):
+        return v.date()
+    if isinstance(v, str):
+        return datetime.date.fromisoformat(v[:10])
+    return v
+
+# -------------------- INCREMENTAL --------------------
+# The *_updates functions give the statements as [(sql, params)] so the
+# async service can run exactly the same ones; record_* run them on the
+# cursor of the transaction that makes the change. The statements are
+# registered with prepare(), so each pooled connection prepares them once.
+
+def bill_updates(backend, bill_date, membership_type, subtotal, discount_amt, grand_total):
+    sql = prepare(backend.accumulate_sql("bill_rollups", BILL_KEYS + BILL_SUMS, BILL_KEYS, BILL_SUMS))
+    day = _as_date(bill_date)
+    return [(sql, (grain, period, membership_type, 1, subtotal, discount_amt, grand_total))
+            for grain, period in _periods(day)]
+
+
+def issue_updates(backend, issue_date, issues=1):
+    sql = prepare(backend.accumulate_sql("issue_rollups", ISSUE_KEYS + ISSUE_SUMS, ISSUE_KEYS, ISSUE_SUMS))
+    return [(sql, (grain, period, issues, 0, 0)) for grain, period in _periods(issue_date)]
+
+
+def return_updates(backend, return_date, late_fee, returns=1):
+    """late_fee is the total over the returns counted."""
+    sql = prepare(backend.accumulate_sql("issue_rollups", ISSUE_KEYS + ISSUE_SUMS, ISSUE_KEYS, ISSUE_SUMS))
+    return [(sql, (grain, period, 0, returns, late_fee)) for grain, period in _periods(return_date)]
+
+
+def _run(cur, statements):
+    for sql, params in statements:
+        cur.execute(sql, params)
+
+
+def record_bill(cur, backend, bill_date, membership_type, subtotal, discount_amt, grand_total):
+    _run(cur, bill_updates(backend, bill_date, membership_type, subtotal, discount_amt, grand_total))
+
+
+def record_issue(cur, backend, issue_date, issues=1):
+    _run(cur, issue_updates(backend, issue_date, issues))
+
+
+def record_return(cur, backend, return_date, late_fee, returns=1):
+    _run(cur, return_updates(backend, return_date, late_fee, returns))
+
+# -------------------- REPORTS --------------------
+
+def bill_report(con, start, end, grain="month"):
+    """(period, membership_type, bills, subtotal, discount_amt, grand_total) rows for [start, end)."""
+    cur = con.cursor()
+    cur.execute(BILL_REPORT_SQL, (grain, start, end))
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+
+def issue_report(con, start, end, grain="month"):
+    """(period, issues, returns, late_fees) rows for [start, end)."""
+    cur = con.cursor()
+    cur.execute(ISSUE_REPORT_SQL, (grain, start, end))
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+# -------------------- REBUILD --------------------
+
+def _range(column, start, end):
+    if start is None:
+        return "", ()
+    return f"WHERE {column} >= %s AND {column} < %s", (start, end)
+
+
+def _add(totals, key, values):
+    acc = totals.get(key)
+    totals[key] = list(values) if acc is None else [a + v for a, v in zip(acc, values)]
+
+
+class RollupTotals:
+    """
+    Rollup rows added up in memory (day and month grains at once), for
+    write_rollups(). Amounts are added as exact Decimals whatever they come
+    in as (SQLite's SUM and the event log hand back floats).
+    """
+
+    def __init__(self):
+        self.bills = {}         # (grain, period, membership_type) -> [bills, subtotal, discount_amt, grand_total]
+        self.issues = {}        # (grain, period) -> [issues, returns, late_fees]
+
+    def add_bills(self, day, membership_type, bills, subtotal, discount_amt, grand_total):
+        sums = (bills, money(subtotal), money(discount_amt), money(grand_total))
+        for grain, period in _periods(_as_date(day)):
+            _add(self.bills, (grain, period, membership_type), sums)
+
+    def add_issues(self, day, issues):
+        for grain, period in _periods(_as_date(day)):
+            _add(self.issues, (grain, period), (issues, 0, ZERO))
+
+    def add_returns(self, day, returns, late_fees):
+        sums = (0, returns, money(late_fees))
+        for grain, period in _periods(_as_date(day)):
+            _add(self.issues, (grain, period), sums)
+
+
+def write_rollups(cur, totals, start=None, end=None):
+    """Replace the rollup rows for [start, end) (None = all) with RollupTotals. Returns rows written."""
+    written = 0
+    for table, keys, sums, rows in (("bill_rollups", BILL_KEYS, BILL_SUMS, totals.bills),
+                                    ("issue_rollups", ISSUE_KEYS, ISSUE_SUMS, totals.issues)):
+        where, params = _range("period", start, end)
+        cur.execute(f"DELETE FROM {table} {where}", params)
+        rows = [key + tuple(values) for key, values in sorted(rows.items())]
+        for i in range(0, len(rows), 500):
+            chunk = rows[i:i + 500]
+            cur.execute(multirow_insert_sql(table, keys + sums, len(chunk)), [v for row in chunk for v in row])
+        written += len(rows)
+    return written
+
+
+def rebuild_rollups(cur, backend, start=None, end=None):
+    """
+    Recompute the rollups for [start, end) (month-aligned; None = all
+    history) from bills and issues on the given cursor. The caller owns
+    the transaction. Returns the number of rollup rows written.
+    """
+    totals = RollupTotals()
+    where, params = _range("b.bill_date", start, end)
+    cur.execute(f"""
+        SELECT DATE(b.bill_date), COALESCE(m.membership_type, '{GUEST}'),
+               COUNT(*), SUM(b.subtotal), SUM(b.discount_amt), SUM(b.grand_total)
+        FROM bills b
+        LEFT JOIN members m ON m.member_id = b.member_id
+        {where}
+        GROUP BY DATE(b.bill_date), COALESCE(m.membership_type, '{GUEST}')
+    """, params)
+    for day, mtype, *sums in cur.fetchall():
+        totals.add_bills(day, mtype, *sums)
+
+    where, params = _range("issue_date", start, end)
+    cur.execute(f"SELECT issue_date, COUNT(*) FROM issues {where} GROUP BY issue_date", params)
+    for day, n in cur.fetchall():
+        totals.add_issues(day, n)
+    where, params = _range("return_date", start, end)
+    where = where or "WHERE return_date IS NOT NULL"
+    cur.execute(f"SELECT return_date, COUNT(*), SUM(late_fee) FROM issues {where} GROUP BY return_date", params)
+    for day, n, fees in cur.fetchall():
+        totals.add_returns(day, n, fees or 0)
+    return write_rollups(cur, totals, start, end)
+
+
+def rebuild(pool, ym=None):
+    """Rebuild every rollup, or just month ym ('YYYY-MM'), in one transaction. Returns rows written."""
+    start = end = None
+    if ym:
+        from lms_service import month_range
+        start, end = month_range(ym)
+    return pool.run_in_transaction(lambda cur: rebuild_rollups(cur, pool.backend, start, end))
+
+# -------------------- CLI --------------------
+
+def main(argv=None):
+    from lms_db import get_pool
+    from lms_migrations import migrate
+
+    ap = argparse.ArgumentParser(description="Rebuild the reporting rollups from bills and issues.")
+    ap.add_argument("month", nargs="?", help="YYYY-MM to rebuild just that month (default: all history)")
+    args = ap.parse_args(argv)
+
+    pool = get_pool()
+    try:
+        migrate(pool)
+        written = rebuild(pool, args.month)
+        print(f"Rebuilt {written} rollup rows{' for ' + args.month if args.month else ''}.")
+        return 0
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,268 @@
+"""
+In-process catalogue search
+---------------------------
+An inverted index over books.title / author / category. Text is split into
+case-folded word tokens; each (field, token) maps to an array of document
+numbers in insertion order. Queries are multi-term (every term must match
+somewhere), the last term also matches as a prefix ("tolk" -> "tolkien"),
+and hits are ranked by field weight x term rarity. A prefix that matches
+more than PREFIX_LIMIT words is searched as its PREFIX_LIMIT most common
+ones (plus the word itself), and the page says it was truncated.
+
+Writes are incremental: add() replaces a book, remove() tombstones it, and
+the index compacts itself once too many tombstones pile up.
+
+    idx = SearchIndex()
+    idx.build(pool)
+    page = idx.search("lord rings tolk", page=1, page_size=20)
+
+"""
+
+import re
+import math
+import heapq
+import bisect
+import threading
+from array import array
+from dataclasses import dataclass, field
+
+FIELDS = ("title", "author", "category")
+FIELD_WEIGHTS = {"title": 3.0, "author": 2.0, "category": 1.0}
+PREFIX_LIMIT = 64           # max vocabulary entries a prefix term expands to (the most common ones)
+PREFIX_WEIGHT = 0.7         # a prefix-only match counts for less than the whole word
+COMPACT_RATIO = 0.5         # rebuild when more than half the documents are tombstones
+
+_TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return _TOKEN.findall(text.casefold()) if text else []
+
+
+@dataclass
+class SearchHit:
+    book_id: str
+    title: str
+    author: str
+    category: str
+    score: float
+
+
+@dataclass
+class SearchPage:
+    query: str
+    total: int
+    page: int
+    page_size: int
+    hits: list = field(default_factory=list)
+    rows: list = field(default_factory=list)    # live books rows for the hits, filled in by LibraryService
+    truncated: bool = False     # the prefix term matched more than PREFIX_LIMIT words; the rarest were left out
+
+    @property
+    def pages(self):
+        return max(1, -(-self.total // self.page_size))
+
+
+class SearchIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        self._docs = []             # doc number -> (book_id, title, author, category) or None
+        self._doc_of = {}           # book_id -> doc number
+        self._postings = {f: {} for f in FIELDS}    # field -> token -> array of doc numbers
+        self._vocab = []            # sorted distinct tokens, for prefix lookup
+        self._dead = set()          # tombstoned doc numbers
+
+    def __len__(self):
+        return len(self._doc_of)
+
+    # ---- writes ----
+
+    def _add(self, book_id, title, author, category, new_tokens):
+        doc = len(self._docs)
+        record = (book_id, title or "", author or "", category or "")
+        self._docs.append(record)
+        self._doc_of[book_id] = doc
+        for f, text in zip(FIELDS, record[1:]):
+            postings = self._postings[f]
+            for tok in set(tokenize(text)):
+                arr = postings.get(tok)
+                if arr is None:
+                    arr = postings[tok] = array("l")
+                    new_tokens.add(tok)
+                arr.append(doc)
+
+    def add(self, book_id, title, author, category):
+        """Index a book, replacing any earlier version of it."""
+        with self._lock:
+            self._remove(book_id)
+            new_tokens = set()
+            self._add(book_id, title, author, category, new_tokens)
+            for tok in new_tokens:
+                i = bisect.bisect_left(self._vocab, tok)
+                if i == len(self._vocab) or self._vocab[i] != tok:
+                    self._vocab.insert(i, tok)
+            self._maybe_compact()
+
+    def add_many(self, rows):
+        """Bulk add (book_id, title, author, category) rows; much faster than add() in a loop."""
+        with self._lock:
+            new_tokens = set()
+            for book_id, title, author, category in rows:
+                self._remove(book_id)
+                self._add(book_id, title, author, category, new_tokens)
+            if new_tokens:
+                self._vocab = sorted(set(self._vocab).union(new_tokens))
+            self._maybe_compact()
+
+    def _remove(self, book_id):
+        doc = self._doc_of.pop(book_id, None)
+        if doc is not None:
+            self._docs[doc] = None
+            self._dead.add(doc)
+
+    def remove(self, book_id):
+        with self._lock:
+            self._remove(book_id)
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        if len(self._dead) > 1000 and len(self._dead) > COMPACT_RATIO * len(self._docs):
+            live = [d for d in self._docs if d is not None]
+            self._clear()
+            self.add_many(live)
+
+    def build(self, pool, chunk_size=10000):
+        """(Re)build from the books table, streaming it in chunks."""
+        from lms_export import stream_rows
+        with self._lock:
+            self._clear()
+            with pool.connection() as con:
+                for _, chunk in stream_rows(con, "SELECT book_id, title, author, category FROM books", (), chunk_size):
+                    self.add_many(chunk)
+
+    # ---- queries ----
+
+    def _expand(self, term, prefix, fields):
+        """
+        The vocabulary words a term matches, and whether some were left out:
+        a prefix term keeps the word itself and the PREFIX_LIMIT words with
+        the most documents in `fields`.
+        """
+        if not prefix:
+            return [term], False
+        i = bisect.bisect_left(self._vocab, term)
+        words = []
+        while i < len(self._vocab) and self._vocab[i].startswith(term):
+            words.append(self._vocab[i])
+            i += 1
+        if len(words) <= PREFIX_LIMIT:
+            return words, False
+        postings = [self._postings[f] for f in fields]
+        common = heapq.nlargest(PREFIX_LIMIT, words, key=lambda w: sum(len(p.get(w, ())) for p in postings))
+        if words[0] == term and term not in common:
+            common.append(term)
+        return common, True
+
+    def search(self, query, page=1, page_size=20, fields=None, prefix=True):
+        """
+        Ranked, paginated search. fields limits which fields are matched
+        (default: all). prefix=True lets the last term match as a prefix.
+        """
+        fields = tuple(fields or FIELDS)
+        terms = list(dict.fromkeys(tokenize(query)))
+        result = SearchPage(query, 0, page, page_size)
+        if not terms or page < 1:
+            return result
+
+        with self._lock:
+            n_docs = max(len(self._docs), 1)
+            # per term: [(field, token, postings)], its idf and the words a prefix term stands for
+            plans = []
+            for pos, term in enumerate(terms):
+                is_prefix = prefix and pos == len(terms) - 1
+                words, truncated = self._expand(term, is_prefix, fields)
+                result.truncated = result.truncated or truncated
+                lists = []
+                for f in fields:
+                    for tok in words:
+                        arr = self._postings[f].get(tok)
+                        if arr:
+                            lists.append((f, tok, arr))
+                if not lists:
+                    return result
+                df = max(len(arr) for _, _, arr in lists)
+                plans.append((term, set(words) if is_prefix else None, lists, math.log(1.0 + n_docs / df)))
+
+            plans.sort(key=lambda p: sum(len(arr) for _, _, arr in p[2]))
+            docs = self._docs
+            scores = None
+            for term, words, lists, idf in plans:
+                size = sum(len(arr) for _, _, arr in lists)
+                if scores is not None and len(scores) * 8 < size:
+                    scores = self._verify(scores, term, words, idf, fields)
+                else:
+                    scores = self._accumulate(scores, term, lists, idf)
+                if not scores:
+                    return result
+
+            result.total = len(scores)
+            top = heapq.nlargest(page * page_size, scores, key=scores.__getitem__)
+            for doc in top[(page - 1) * page_size:]:
+                book_id, title, author, category = docs[doc]
+                result.hits.append(SearchHit(book_id, title, author, category, round(scores[doc], 4)))
+        return result
+
+    def _accumulate(self, scores, term, lists, idf):
+        """
+        Score a term straight from its postings with set operations. With
+        scores from earlier terms, only documents already in there survive.
+        """
+        by_field = {}
+        for f, tok, arr in lists:
+            by_field.setdefault(f, []).append((tok, arr))
+        out = {}
+        for f, entries in by_field.items():
+            w = FIELD_WEIGHTS[f] * idf
+            exact = set()
+            partial = set()
+            for tok, arr in entries:
+                (exact if tok == term else partial).update(arr)
+            partial -= exact
+            for matched, weight in ((exact, w), (partial, w * PREFIX_WEIGHT)):
+                if not matched:
+                    continue
+                matched -= self._dead
+                if scores is not None:
+                    matched &= scores.keys()
+                again = matched & out.keys()
+                out.update(dict.fromkeys(matched - again, weight))
+                for doc in again:
+                    out[doc] += weight
+        if scores is not None:
+            for doc in out:
+                out[doc] += scores[doc]
+        return out
+
+    def _verify(self, scores, term, words, idf, fields):
+        """
+        Few candidates, common term: check each candidate's own text instead
+        of the postings. words is the prefix expansion (None for a whole
+        word), so both paths match the same words.
+        """
+        docs = self._docs
+        out = {}
+        for doc, score in scores.items():
+            record = docs[doc]
+            gained = 0.0
+            for f in fields:
+                text_tokens = tokenize(record[FIELDS.index(f) + 1])
+                if term in text_tokens:
+                    gained += FIELD_WEIGHTS[f] * idf
+                elif words and any(t in words for t in text_tokens):
+                    gained += FIELD_WEIGHTS[f] * idf * PREFIX_WEIGHT
+            if gained:
+                out[doc] = score + gained
+        return out
@@ -0,0 +1,1165 @@
+"""
+Service layer for the Library Management System
+-----------------------------------------------
+Every operation behind the terminal menus, without input()/print().
+Methods take plain arguments, return records (lms_records.py) or result
+objects and raise a ServiceError subclass (with a user-facing message) when
+a request can't be carried out. Each call checks a connection out of the
+pool, commits its own work and hands the connection back.
+
+    svc = LibraryService(get_pool())
+    receipt = svc.issue(member_id=1, book_id="B1", days=14)
+
+"""
+
+import datetime
+import threading
+from decimal import Decimal
+from functools import lru_cache
+from dataclasses import dataclass, field
+
+from lms_analytics import DEFAULT_TOP, Analytics
+from lms_cache import LRUCache
+from lms_db import ALLOWED_TABLES, multirow_insert_sql, prepare
+from lms_events import open_log, replay as replay_log
+from lms_export import export_bills_detailed, export_issues_detailed, export_table
+from lms_import import DEFAULT_BATCH_SIZE, import_books
+from lms_metrics import operations
+from lms_money import HUNDRED, ZERO, money, percent_of, stored, total
+from lms_overdue import fee_for, overdue_summary, snapshot as overdue_snapshot
+from lms_paging import DEFAULT_PAGE_SIZE, Keyset, fetch_page
+from lms_parquet import export_parquet, snapshot as parquet_snapshot
+from lms_records import Bill, BillItem, Book, Issue, Member, MonthBill, OpenIssue, OverdueItem, Staff, record, records
+from lms_rollups import GUEST, bill_report, issue_report, record_bill, record_issue, record_return
+from lms_search import FIELDS as SEARCH_FIELDS, SearchIndex
+from lms_stock import open_ledger
+
+DEFAULT_ISSUE_DAYS = 14
+BATCH_CHUNK = 500           # items per transaction in issue_many / return_many
+VIP_EXTRA_DISCOUNT = Decimal("10.00")   # VIP gets additional 10% off
+MEMBERSHIP_TYPES = ("Regular", "VIP")
+CACHE_SIZE = 10000          # book / member rows kept in memory, each
+CACHE_TTL = 60.0            # seconds; bounds staleness when another process writes
+
+
+class ServiceError(Exception):
+    """A request the library can't carry out; str(e) is shown to the user."""
+
+
+class NotFound(ServiceError):
+    pass
+
+
+class AlreadyExists(ServiceError):
+    pass
+
+
+class OutOfStock(ServiceError):
+    pass
+
+
+class InvalidInput(ServiceError):
+    pass
+
+
+class NotDone(ServiceError):
+    """A batch item that wasn't carried out because its chunk failed as a whole."""
+
+# -------------------- SQL --------------------
+# Hot queries live here so lms_migrations can EXPLAIN exactly what runs.
+# Date filters are half-open ranges on the bare column so they can use indexes.
+# Listings are Keysets: paged by seeking on their ORDER BY keys, never OFFSET.
+
+BOOKS_LISTING = Keyset(
+    "SELECT book_id, title, author, category, price, stock FROM books",
+    [("title", 1), ("book_id", 0)],
+    record=Book,
+)
+
+STAFF_LISTING = Keyset("SELECT staff_id, name, role, phone FROM staff", [("staff_id", 0)], record=Staff)
+
+MEMBERS_LISTING = Keyset(
+    "SELECT member_id, name, phone, email, membership_type FROM members",
+    [("member_id", 0)],
+    record=Member,
+)
+
+ACTIVE_ISSUES = Keyset(
+    """
+    SELECT i.issue_id, m.name, m.member_id, b.title, b.book_id, i.issue_date, i.due_date
+    FROM issues i
+    JOIN members m ON m.member_id = i.member_id
+    JOIN books b   ON b.book_id   = i.book_id
+    """,
+    [("i.issue_date", 5, True), ("i.issue_id", 0, True)],
+    where="i.return_date IS NULL",
+    record=OpenIssue,
+)
+
+ISSUES_BY_MONTH_SELECT = """
+    SELECT i.issue_id, m.name, m.member_id, b.title, b.book_id,
+           i.issue_date, i.due_date, i.return_date, i.late_fee,
+           COALESCE(i.return_date, i.issue_date) AS activity_date
+    FROM issues i
+    JOIN members m ON m.member_id = i.member_id
+    JOIN books b   ON b.book_id   = i.book_id
+"""
+
+ISSUE_MONTH_FILTERS = {
+    "issue": "i.issue_date >= %s AND i.issue_date < %s",
+    "return": "i.return_date >= %s AND i.return_date < %s",
+    "any": "((i.issue_date >= %s AND i.issue_date < %s) OR (i.return_date >= %s AND i.return_date < %s))",
+}
+
+ISSUES_BY_MONTH = {
+    by: Keyset(
+        ISSUES_BY_MONTH_SELECT,
+        [("COALESCE(i.return_date, i.issue_date)", 9, True), ("i.issue_id", 0, True)],
+        where=where,
+        record=Issue,
+    )
+    for by, where in ISSUE_MONTH_FILTERS.items()
+}
+
+BILLS_LISTING = Keyset(
+    "SELECT bill_id, member_id, bill_date, subtotal, discount_amt, grand_total FROM bills",
+    [("bill_id", 0, True)],
+    record=Bill,
+)
+
+BILLS_BY_MONTH = Keyset(
+    """
+    SELECT b.bill_id, b.bill_date, COALESCE(m.name,'Guest') AS customer, COALESCE(m.membership_type,'-') AS mtype,
+           b.subtotal, b.discount_pct, b.discount_amt, b.grand_total
+    FROM bills b
+    LEFT JOIN members m ON m.member_id = b.member_id
+    """,
+    [("b.bill_date", 1, True), ("b.bill_id", 0, True)],
+    where="b.bill_date >= %s AND b.bill_date < %s",
+    record=MonthBill,
+)
+
+# prepare(): fixed-text point lookups and single-row writes every desk runs, prepared once per pooled connection
+BOOK_SQL = prepare("SELECT book_id, title, author, category, price, stock FROM books WHERE book_id=%s")
+BOOKS_IN_SQL = "SELECT book_id, title, author, category, price, stock FROM books WHERE book_id IN ({marks})"
+MEMBER_SQL = prepare("SELECT member_id, name, phone, email, membership_type FROM members WHERE member_id=%s")
+
+MEMBER_OVERDUE_SQL = """
+    SELECT i.issue_id, i.book_id, b.title, i.due_date
+    FROM issues i
+    JOIN books b ON b.book_id = i.book_id
+    WHERE i.member_id = %s AND i.return_date IS NULL AND i.due_date < %s
+    ORDER BY i.due_date, i.issue_id
+"""
+
+BILL_ITEM_COLS = ("bill_id", "book_id", "qty", "unit_price", "line_total")
+
+BILL_ITEMS_SQL = """
+    SELECT bi.item_id, bi.book_id, b.title, bi.qty, bi.unit_price, bi.line_total
+    FROM bill_items bi
+    JOIN books b ON b.book_id = bi.book_id
+    WHERE bi.bill_id = %s
+    ORDER BY bi.item_id
+"""
+
+# Writes and the reads inside write transactions; lms_async runs the very same statements.
+BOOK_INSERT_SQL = prepare("INSERT INTO books (book_id, title, author, category, price, stock) VALUES (%s, %s, %s, %s, %s, %s)")
+BOOK_UPDATE_SQL = prepare("UPDATE books SET title=%s, author=%s, category=%s, price=%s, stock=%s WHERE book_id=%s")
+BOOK_DELETE_SQL = prepare("DELETE FROM books WHERE book_id=%s")
+MEMBER_INSERT_SQL = prepare("INSERT INTO members (name, phone, email, membership_type) VALUES (%s,%s,%s,%s)")
+MEMBER_UPDATE_SQL = prepare("UPDATE members SET name=%s, phone=%s, email=%s, membership_type=%s WHERE member_id=%s")
+MEMBER_DELETE_SQL = prepare("DELETE FROM members WHERE member_id=%s")
+STOCK_SQL = prepare("SELECT stock FROM books WHERE book_id=%s")
+# the stock check and the decrement are one statement, so two desks can't both take the last copy
+TAKE_COPY_SQL = prepare("UPDATE books SET stock = stock - 1 WHERE book_id=%s AND stock >= 1")
+RESTOCK_SQL = prepare("UPDATE books SET stock = stock + 1 WHERE book_id=%s")
+ISSUE_INSERT_SQL = prepare("INSERT INTO issues (member_id, book_id, issue_date, due_date) VALUES (%s,%s,%s,%s)")
+RETURN_LOOKUP_SQL = prepare("""
+    SELECT i.issue_id, i.member_id, m.name, i.book_id, b.title, i.issue_date, i.due_date, i.return_date,
+           m.membership_type
+    FROM issues i
+    JOIN members m ON m.member_id = i.member_id
+    JOIN books b   ON b.book_id   = i.book_id
+    WHERE i.issue_id=%s
+""")
+# only the first of two concurrent returns gets to close the issue and restock
+CLOSE_ISSUE_SQL = prepare("UPDATE issues SET return_date=%s, late_fee=%s WHERE issue_id=%s AND return_date IS NULL")
+BILL_INSERT_SQL = prepare("INSERT INTO bills (member_id, bill_date, subtotal, discount_pct, discount_amt, grand_total) VALUES (%s,%s,%s,%s,%s,%s)")
+BOOKS_STOCK_IN_SQL = "SELECT book_id, stock FROM books WHERE book_id IN ({marks})"
+# batch circulation: one lookup per chunk instead of one per item
+MEMBER_NAMES_IN_SQL = "SELECT member_id, name FROM members WHERE member_id IN ({marks})"
+BOOKS_ISSUE_IN_SQL = "SELECT book_id, title, stock FROM books WHERE book_id IN ({marks})"
+RETURNS_LOOKUP_SQL = RETURN_LOOKUP_SQL.replace("WHERE i.issue_id=%s", "WHERE i.issue_id IN ({marks})")
+
+# -------------------- RESULTS --------------------
+
+@dataclass
+class IssueReceipt:
+    issue_id: int
+    member_id: int
+    member_name: str
+    book_id: str
+    title: str
+    issue_date: datetime.date
+    due_date: datetime.date
+
+
+@dataclass
+class ReturnReceipt:
+    issue_id: int
+    member_id: int
+    member_name: str
+    book_id: str
+    title: str
+    return_date: datetime.date
+    late_fee: Decimal
+
+
+@dataclass
+class BillLine:
+    book_id: str
+    title: str
+    qty: int
+    unit_price: Decimal
+    line_total: Decimal
+
+
+@dataclass
+class BillReceipt:
+    bill_id: int
+    member_id: int
+    member_name: str
+    member_type: str
+    subtotal: Decimal
+    discount_pct: Decimal
+    discount_amt: Decimal
+    grand_total: Decimal
+    vip_extra: Decimal = ZERO
+    lines: list = field(default_factory=list)
+
+# -------------------- HELPERS --------------------
+
+def parse_year_month(ym_str: str):
+    """Parse 'YYYY-MM' -> (first_date, last_date). Raises ValueError if invalid."""
+    parts = ym_str.split("-")
+    if len(parts) != 2:
+        raise ValueError("Bad format")
+    year, month = parts
+    year = int(year)
+    month = int(month)
+    first = datetime.date(year, month, 1)
+    if month == 12:
+        last = datetime.date(year + 1, 1, 1) - datetime.timedelta(days=1)
+    else:
+        last = datetime.date(year, month + 1, 1) - datetime.timedelta(days=1)
+    return first, last
+
+
+def month_range(ym_str: str):
+    """Parse 'YYYY-MM' -> half-open (first_date, first_date_of_next_month)."""
+    first, last = parse_year_month(ym_str)
+    return first, last + datetime.timedelta(days=1)
+
+
+def _month(ym):
+    try:
+        return month_range(ym)
+    except Exception:
+        raise InvalidInput("Invalid format. Example: 2025-08")
+
+
+def _stock_of(cur, book_id):
+    """Current stock of a book, or None if there is no such book."""
+    cur.execute(STOCK_SQL, (book_id,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def bill_quantities(items):
+    """
+    Validate bill items [(book_id, qty), ...] -> {book_id: total qty}.
+    Raises InvalidInput for an empty bill or a quantity below 1.
+    """
+    if not items:
+        raise InvalidInput("No items added. Bill cancelled.")
+    wanted = {}
+    for book_id, qty in items:
+        if qty < 1:
+            raise InvalidInput("Quantity must be >= 1")
+        wanted[book_id] = wanted.get(book_id, 0) + qty
+    return wanted
+
+
+def valid_price(price):
+    """price as a two-place Decimal (lms_money.money); InvalidInput unless it's a number >= 0."""
+    try:
+        price = None if price is None else money(price)
+    except (TypeError, ValueError, ArithmeticError):
+        price = None
+    if price is None or not price.is_finite() or price < 0:
+        raise InvalidInput("Price must be a number >= 0.")
+    return price
+
+
+def valid_stock(stock):
+    """stock as an int; InvalidInput unless it's a whole number >= 0."""
+    try:
+        stock = int(stock)
+    except (TypeError, ValueError, OverflowError):
+        stock = -1
+    if stock < 0:
+        raise InvalidInput("Stock must be a whole number >= 0.")
+    return stock
+
+
+def valid_discount(discount_pct):
+    """discount_pct as a two-place Decimal; InvalidInput unless 0 <= discount_pct <= 100."""
+    try:
+        pct = money(discount_pct)
+    except (TypeError, ValueError, ArithmeticError):
+        pct = None
+    if pct is None or not pct.is_finite() or not ZERO <= pct <= HUNDRED:
+        raise InvalidInput("Discount must be between 0 and 100.")
+    return pct
+
+
+def take_stock_sql(wanted):
+    """
+    One conditional UPDATE taking {book_id: qty} off stock -> (sql, params).
+    It changes one row per book only if every book has enough, so a
+    rowcount below len(wanted) means the bill can't be filled.
+    """
+    ids = sorted(wanted)
+    marks = ",".join(["%s"] * len(ids))
+    case = "CASE book_id " + " ".join(["WHEN %s THEN %s"] * len(ids)) + " END"
+    case_params = [v for book_id in ids for v in (book_id, wanted[book_id])]
+    sql = f"UPDATE books SET stock = stock - {case} WHERE book_id IN ({marks}) AND stock >= {case}"
+    return sql, case_params + ids + case_params
+
+
+def short_stock(wanted, stock_rows):
+    """OutOfStock for the first book in (book_id, stock) rows that can't cover its quantity."""
+    for book_id, stock in sorted(stock_rows):
+        if stock < wanted[book_id]:
+            return OutOfStock(f"Not enough stock for {book_id}. Available: {stock}")
+    return OutOfStock("Stock changed while billing, please retry.")
+
+
+def _marks(n):
+    return ",".join(["%s"] * n)
+
+
+def restock_sql(counts):
+    """One UPDATE putting {book_id: copies} back on stock -> (sql, params)."""
+    ids = sorted(counts)
+    case = "CASE book_id " + " ".join(["WHEN %s THEN %s"] * len(ids)) + " END"
+    params = [v for book_id in ids for v in (book_id, counts[book_id])]
+    return f"UPDATE books SET stock = stock + {case} WHERE book_id IN ({_marks(len(ids))})", params + ids
+
+
+def close_issues_sql(return_date, fees):
+    """
+    One UPDATE closing the issues in {issue_id: late_fee} -> (sql, params).
+    Issues already returned are left alone, so a rowcount below len(fees)
+    means someone else returned one of them first.
+    """
+    ids = sorted(fees)
+    case = "CASE issue_id " + " ".join(["WHEN %s THEN %s"] * len(ids)) + " END"
+    sql = (f"UPDATE issues SET return_date = %s, late_fee = {case} "
+           f"WHERE issue_id IN ({_marks(len(ids))}) AND return_date IS NULL")
+    return sql, [return_date] + [v for issue_id in ids for v in (issue_id, fees[issue_id])] + ids
+
+
+@lru_cache(maxsize=256)
+def _discount_pct(discount_pct, vip_extra):
+    """discount_pct + vip_extra as an exact percentage, capped at 100. A till only ever sees a few."""
+    return min(money(discount_pct) + vip_extra, HUNDRED)
+
+
+def price_bill(member_id, member_name, member_type, items, books, discount_pct):
+    """
+    BillReceipt (bill_id still None) for items priced from the books rows.
+    VIP members get VIP_EXTRA_DISCOUNT on top of discount_pct (capped at 100%).
+    Amounts are exact Decimals (lms_money); only the discount is rounded.
+    """
+    lines = []
+    subtotal = ZERO
+    for book_id, qty in items:
+        _, title, _, _, price, _ = books[book_id]
+        unit_price = stored(price)
+        line_total = unit_price * qty
+        lines.append(BillLine(book_id, title, qty, unit_price, line_total))
+        subtotal += line_total
+
+    vip_extra = VIP_EXTRA_DISCOUNT if member_type == 'VIP' else ZERO
+    total_discount_pct = _discount_pct(discount_pct, vip_extra)
+    discount_amt = percent_of(subtotal, total_discount_pct)
+    grand_total = subtotal - discount_amt       # the discount is at most 100%, so never below zero
+    return BillReceipt(None, member_id, member_name, member_type, subtotal, total_discount_pct,
+                       discount_amt, grand_total, vip_extra, lines)
+
+
+def bill_parties(cur, member_id, book_ids):
+    """
+    (member_name, member_type, {book_id: Book}) for a bill, read on the
+    bill's own cursor; raises NotFound for a missing member or book. A
+    guest (member_id None) is 'Guest', priced as 'Regular'.
+    """
+    member_name, member_type = 'Guest', 'Regular'
+    if member_id is not None:
+        cur.execute(MEMBER_SQL, (member_id,))
+        member = cur.fetchone()
+        if not member:
+            raise NotFound("Member not found.")
+        member_name, member_type = member[1], member[4]
+    cur.execute(BOOKS_IN_SQL.format(marks=_marks(len(book_ids))), book_ids)
+    books = {book.book_id: book for book in records(Book, cur.fetchall())}
+    for book_id in book_ids:
+        if book_id not in books:
+            raise NotFound(f"Book not found: {book_id}")
+    return member_name, member_type, books
+
+
+def bill_lines_params(receipt):
+    """Flattened rows for multirow_insert_sql("bill_items", BILL_ITEM_COLS, len(receipt.lines))."""
+    return [v for line in receipt.lines
+            for v in (receipt.bill_id, line.book_id, line.qty, line.unit_price, line.line_total)]
+
+
+def _is_duplicate(exc):
+    msg = str(exc)
+    return "Duplicate" in msg or "1062" in msg or "UNIQUE constraint" in msg
+
+# -------------------- SERVICE --------------------
+
+@operations
+class LibraryService:
+    """Each public method is an lms_metrics operation: timed, with its statements counted as round trips."""
+
+    def __init__(self, pool, cache_size=CACHE_SIZE, cache_ttl=CACHE_TTL, analytics_dir=None, events=None,
+                 ledger=None):
+        self.pool = pool
+        self.events = open_log() if events is None else events     # lms_events.EventLog, or None / False: off
+        self.ledger = open_ledger(pool) if ledger is None else ledger     # lms_stock.StockLedger, or None / False
+        self._search_index = None
+        self._search_lock = threading.Lock()
+        self._analytics = None
+        self._analytics_lock = threading.Lock()
+        self._analytics_dir = analytics_dir
+        self.book_cache = LRUCache(cache_size, cache_ttl)
+        self.member_cache = LRUCache(cache_size, cache_ttl)
+
+    @property
+    def search_index(self):
+        """The catalogue SearchIndex, built from the books table on first use."""
+        if self._search_index is None:
+            with self._search_lock:
+                if self._search_index is None:
+                    idx = SearchIndex()
+                    idx.build(self.pool)
+                    self._search_index = idx
+        return self._search_index
+
+    @property
+    def analytics(self):
+        """The Analytics over this pool; its frames load on the first report."""
+        if self._analytics is None:
+            with self._analytics_lock:
+                if self._analytics is None:
+                    self._analytics = Analytics(self.pool, self._analytics_dir)
+        return self._analytics
+
+    def refresh_search_index(self):
+        """
+        Rebuild the search index from the books table and swap it in. For
+        long-running processes that share the database with other writers,
+        whose changes the incremental updates never see. An index that
+        hasn't been built yet is left alone: its first search builds it
+        from the table as it is then.
+        """
+        if self._search_index is None:
+            return
+        idx = SearchIndex()
+        idx.build(self.pool)
+        with self._search_lock:
+            self._search_index = idx
+
+    def _indexed(self, book_id, title, author, category):
+        if self._search_index is not None:
+            self._search_index.add(book_id, title, author, category)
+
+    def _unindexed(self, book_id):
+        if self._search_index is not None:
+            self._search_index.remove(book_id)
+
+    def _fetchone(self, sql, params=()):
+        with self.pool.connection() as con:
+            cur = con.cursor()
+            cur.execute(sql, params)
+            row = cur.fetchone()
+            cur.close()
+            return row
+
+    def _fetchall(self, sql, params=()):
+        with self.pool.connection() as con:
+            cur = con.cursor()
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+            cur.close()
+            return rows
+
+    def _page(self, keyset, params=(), token=None, limit=DEFAULT_PAGE_SIZE):
+        with self.pool.connection() as con:
+            try:
+                return fetch_page(con, keyset, params, token, limit)
+            except ValueError as e:
+                raise InvalidInput(str(e))
+
+    def cache_stats(self):
+        """Hit/miss/eviction counters for the book and member caches."""
+        return {"books": self.book_cache.stats(), "members": self.member_cache.stats()}
+
+    def _log(self, kind, *values):
+        """Append a committed change to the event log, if there is one."""
+        if self.events:
+            self.events.append(kind, values)
+
+    def replay_events(self, rollups=False):
+        """
+        Rebuild the search index and warm the book / member caches from the
+        event log instead of the database; rollups=True also rewrites the
+        rollup tables from it. Returns the lms_events.Replay.
+        """
+        if not self.events:
+            raise InvalidInput("No event log configured (set LMS_EVENT_LOG).")
+        self.events.flush()
+        targets = ("catalogue", "people") + (("rollups",) if rollups else ())
+        state = replay_log(self.events.directory, targets=targets)
+        idx = state.search_index()
+        with self._search_lock:
+            self._search_index = idx
+        state.prime(self)
+        if rollups:
+            state.write_rollups(self.pool)
+        return state
+
+    def _log_many(self, events):
+        """Append [(kind, values)] to the event log with one wait for the lot."""
+        if self.events:
+            self.events.append_many(list(events))
+
+    def _stock_change(self):
+        return self.ledger.change() if self.ledger else None
+
+    def _in_transaction(self, work, change):
+        """
+        run_in_transaction(work) for work that moves stock through `change`
+        (an lms_stock.StockChange, None without a ledger): confirmed if the
+        transaction commits, cancelled if it fails. A retry starts afresh.
+        """
+        if change is None:
+            return self.pool.run_in_transaction(work)
+
+        def attempt(cur):
+            change.cancel()
+            return work(cur)
+
+        try:
+            result = self.pool.run_in_transaction(attempt)
+        except BaseException:
+            change.cancel()
+            raise
+        change.confirm()
+        return result
+
+    def _stock_changed(self, *book_ids):
+        """Drop cached rows whose stock the database just changed; with a ledger it didn't."""
+        if not self.ledger:
+            self.book_cache.invalidate(*book_ids)
+
+    def _set_stock(self, book_ids, write):
+        """Run write(), which sets books.stock outright, with the ledger (if any) written first and reloaded after."""
+        if not self.ledger:
+            return write()
+        with self.ledger.exclusive():
+            try:
+                return write()
+            finally:
+                self.ledger.reload(book_ids)
+
+    def _with_stock(self, book):
+        """A Book with the ledger's stock for it, if the ledger has the book."""
+        stock = self.ledger.stock_of(book.book_id) if self.ledger and book else None
+        return book if stock is None else book._replace(stock=stock)
+
+    def _write(self, sql, params=()):
+        """Run one statement and commit. Returns (rowcount, lastrowid)."""
+        with self.pool.connection() as con:
+            cur = con.cursor()
+            cur.execute(sql, params)
+            result = cur.rowcount, cur.lastrowid
+            con.commit()
+            cur.close()
+            return result
+
+    # ---- books ----
+
+    def add_book(self, book_id, title, author, category, price, stock):
+        price, stock = valid_price(price), valid_stock(stock)
+        try:
+            self._write(BOOK_INSERT_SQL, (book_id, title, author, category, price, stock))
+        except Exception as e:
+            if _is_duplicate(e):
+                raise AlreadyExists("Book ID already exists.")
+            raise
+        self.book_cache.invalidate(book_id)
+        self._indexed(book_id, title, author, category)
+        self._log("book_added", book_id, title, author, category, price, stock)
+
+    def get_book(self, book_id):
+        return self._with_stock(self.book_cache.get_or_load(
+            book_id, lambda: record(Book, self._fetchone(BOOK_SQL, (book_id,)))))
+
+    def get_books(self, book_ids):
+        """book_id -> Book for the ids that exist: cached rows plus one IN query for the rest."""
+        found, missing = {}, []
+        for book_id in book_ids:
+            row = self.book_cache.get(book_id)
+            if row is None:
+                missing.append(book_id)
+            else:
+                found[book_id] = row
+        if missing:
+            generation = self.book_cache.generation()
+            marks = ",".join(["%s"] * len(missing))
+            for book in records(Book, self._fetchall(BOOKS_IN_SQL.format(marks=marks), missing)):
+                found[book.book_id] = book
+                self.book_cache.put(book.book_id, book, generation)
+        if self.ledger:
+            found = {book_id: self._with_stock(row) for book_id, row in found.items()}
+        return found
+
+    def update_book(self, book_id, title=None, author=None, category=None, price=None, stock=None):
+        """Update the given fields; None keeps the existing value."""
+        price = None if price is None else valid_price(price)
+        stock = None if stock is None else valid_stock(stock)
+
+        def write():
+            # not the cache: unchanged fields are written back (stock too, read after the ledger's flush)
+            row = self._fetchone(BOOK_SQL, (book_id,))
+            if not row:
+                raise NotFound("Book not found.")
+            values = [row[i] if v is None else v for i, v in enumerate((title, author, category, price, stock), 1)]
+            self._write(BOOK_UPDATE_SQL, (*values, book_id))
+            return values
+
+        title, author, category, price, stock = self._set_stock([book_id], write)
+        self.book_cache.invalidate(book_id)
+        self._indexed(book_id, title, author, category)
+        self._log("book_updated", book_id, title, author, category, price, stock)
+
+    def delete_book(self, book_id):
+        count, _ = self._set_stock([book_id], lambda: self._write(BOOK_DELETE_SQL, (book_id,)))
+        if not count:
+            raise NotFound("Book not found.")
+        self.book_cache.invalidate(book_id)
+        self._unindexed(book_id)
+        self._log("book_deleted", book_id)
+
+    def list_books(self, token=None, limit=DEFAULT_PAGE_SIZE):
+        """One Page of books by title; pass page.next_token / prev_token to move."""
+        return self._page(BOOKS_LISTING, (), token, limit)
+
+    def search_books(self, query, field=None, page=1, page_size=20):
+        """
+        Ranked keyword search over title/author/category (or just `field`).
+        Returns a SearchPage whose rows are the live Book records, best first.
+        """
+        if field is not None and field not in SEARCH_FIELDS:
+            raise InvalidInput("Invalid choice.")
+        result = self.search_index.search(query, page, page_size, fields=(field,) if field else None)
+        if result.hits:
+            ids = [h.book_id for h in result.hits]
+            found = self.get_books(ids)
+            result.rows = [found[i] for i in ids if i in found]
+        return result
+
+    def import_books(self, path, fmt=None, batch_size=DEFAULT_BATCH_SIZE, rejects_path=None,
+                     update_stock=False, progress=None):
+        """Bulk upsert from a CSV/JSON feed; see lms_import.import_books."""
+        def on_batch(rows):
+            self.book_cache.invalidate(*(r[0] for r in rows))
+            if update_stock and self.ledger:
+                self.ledger.reload([r[0] for r in rows])
+            if self._search_index is not None:
+                self._search_index.add_many(r[:4] for r in rows)
+            self._log("books_imported", rows, update_stock)
+
+        if not (update_stock and self.ledger):
+            return import_books(self.pool, path, fmt, batch_size, rejects_path, update_stock, progress, on_batch)
+        with self.ledger.exclusive():
+            return import_books(self.pool, path, fmt, batch_size, rejects_path, update_stock, progress, on_batch)
+
+    # ---- staff ----
+
+    def add_staff(self, name, role, phone):
+        _, staff_id = self._write("INSERT INTO staff (name, role, phone) VALUES (%s, %s, %s)", (name, role, phone))
+        self._log("staff_added", staff_id, name, role, phone)
+        return staff_id
+
+    def get_staff(self, staff_id):
+        return record(Staff, self._fetchone("SELECT staff_id, name, role, phone FROM staff WHERE staff_id=%s",
+                                            (staff_id,)))
+
+    def update_staff(self, staff_id, name=None, role=None, phone=None):
+        row = self.get_staff(staff_id)
+        if not row:
+            raise NotFound("Staff not found.")
+        name, role, phone = name or row[1], role or row[2], phone or row[3]
+        self._write("UPDATE staff SET name=%s, role=%s, phone=%s WHERE staff_id=%s", (name, role, phone, staff_id))
+        self._log("staff_updated", staff_id, name, role, phone)
+
+    def delete_staff(self, staff_id):
+        count, _ = self._write("DELETE FROM staff WHERE staff_id=%s", (staff_id,))
+        if not count:
+            raise NotFound("Staff not found.")
+        self._log("staff_deleted", staff_id)
+
+    def list_staff(self, token=None, limit=DEFAULT_PAGE_SIZE):
+        return self._page(STAFF_LISTING, (), token, limit)
+
+    # ---- members ----
+
+    def add_member(self, name, phone, email, membership_type='Regular'):
+        if membership_type not in MEMBERSHIP_TYPES:
+            membership_type = 'Regular'
+        _, member_id = self._write(MEMBER_INSERT_SQL, (name, phone, email, membership_type))
+        self._log("member_added", member_id, name, phone, email, membership_type)
+        return member_id
+
+    def get_member(self, member_id):
+        return self.member_cache.get_or_load(
+            member_id, lambda: record(Member, self._fetchone(MEMBER_SQL, (member_id,))))
+
+    def update_member(self, member_id, name=None, phone=None, email=None, membership_type=None):
+        row = self._fetchone(MEMBER_SQL, (member_id,))
+        if not row:
+            raise NotFound("Member not found.")
+        if membership_type not in MEMBERSHIP_TYPES:
+            membership_type = row[4]
+        name, phone, email = name or row[1], phone or row[2], email or row[3]
+        self._write(MEMBER_UPDATE_SQL, (name, phone, email, membership_type, member_id))
+        self.member_cache.invalidate(member_id)
+        self._log("member_updated", member_id, name, phone, email, membership_type)
+
+    def delete_member(self, member_id):
+        count, _ = self._write(MEMBER_DELETE_SQL, (member_id,))
+        if not count:
+            raise NotFound("Member not found.")
+        self.member_cache.invalidate(member_id)
+        self._log("member_deleted", member_id)
+
+    def list_members(self, token=None, limit=DEFAULT_PAGE_SIZE):
+        return self._page(MEMBERS_LISTING, (), token, limit)
+
+    # ---- circulation ----
+
+    def issue(self, member_id, book_id, days=DEFAULT_ISSUE_DAYS):
+        if days < 1:
+            raise InvalidInput("Days must be >= 1")
+
+        # names come from the caches; the stock itself is only ever trusted from the UPDATE below
+        member = self.get_member(member_id)
+        if not member:
+            raise NotFound("Member not found.")
+        book = self.get_book(book_id)
+        if not book:
+            raise NotFound("Book not found.")
+
+        change = self._stock_change()
+
+        def work(cur):
+            if change:
+                short = change.take({book_id: 1}, cur)
+                if short is not None:
+                    raise NotFound("Book not found.") if short[1] is None else OutOfStock("Book out of stock.")
+            else:
+                cur.execute(TAKE_COPY_SQL, (book_id,))
+                if cur.rowcount != 1:
+                    if _stock_of(cur, book_id) is None:
+                        raise NotFound("Book not found.")
+                    raise OutOfStock("Book out of stock.")
+
+            issue_date = datetime.date.today()
+            due_date = issue_date + datetime.timedelta(days=days)
+            cur.execute(ISSUE_INSERT_SQL, (member_id, book_id, issue_date, due_date))
+            issue_id = cur.lastrowid
+            record_issue(cur, self.pool.backend, issue_date)
+            if change:
+                change.prepare(f"issue:{issue_id}")
+            return IssueReceipt(issue_id, member_id, member[1], book_id, book[1], issue_date, due_date)
+
+        try:
+            receipt = self._in_transaction(work, change)
+        finally:
+            self._stock_changed(book_id)
+        self._log("book_issued", receipt.issue_id, member_id, book_id, receipt.issue_date, receipt.due_date)
+        return receipt
+
+    def return_issue(self, issue_id):
+        change = self._stock_change()
+
+        def work(cur):
+            cur.execute(RETURN_LOOKUP_SQL, (issue_id,))
+            row = cur.fetchone()
+            if not row:
+                raise NotFound("Issue record not found.")
+            if row[7] is not None:
+                raise InvalidInput("This book was already returned.")
+
+            _, member_id, member_name, book_id, title, _, due_date, _, membership_type = row
+            return_date = datetime.date.today()
+            late_fee = fee_for(membership_type, (return_date - due_date).days)
+
+            cur.execute(CLOSE_ISSUE_SQL, (return_date, late_fee, issue_id))
+            if cur.rowcount != 1:
+                raise InvalidInput("This book was already returned.")
+            if change:
+                change.give({book_id: 1}, cur)
+            else:
+                cur.execute(RESTOCK_SQL, (book_id,))
+            record_return(cur, self.pool.backend, return_date, late_fee)
+            if change:
+                change.prepare(f"return:{issue_id}")
+            return ReturnReceipt(issue_id, member_id, member_name, book_id, title, return_date, late_fee)
+
+        receipt = self._in_transaction(work, change)
+        self._stock_changed(receipt.book_id)
+        self._log("book_returned", issue_id, receipt.book_id, receipt.return_date, receipt.late_fee)
+        return receipt
+
+    # ---- batch circulation ----
+
+    def _chunks(self, items, chunk_size, work):
+        """
+        Yield work(cur, chunk, change)'s per-item results, one transaction
+        per chunk of items; change is as for _in_transaction. A chunk that
+        fails as a whole yields its error for each of its items, so the
+        receipts of the chunks already committed aren't lost. After a
+        ServiceError (a race with another desk) the next chunks still run;
+        after anything else (database down, pool timeout) they are not
+        tried and yield NotDone too.
+        """
+        if chunk_size < 1:
+            raise InvalidInput("Chunk size must be >= 1")
+        stopped = None
+        for start in range(0, len(items), chunk_size):
+            chunk = items[start:start + chunk_size]
+            if stopped is not None:
+                yield [stopped] * len(chunk)
+                continue
+            change = self._stock_change()
+            try:
+                done = self._in_transaction(lambda cur: work(cur, chunk, change), change)
+            except ServiceError as e:
+                done = [e] * len(chunk)
+            except Exception as e:
+                done = [NotDone(f"Not done: {e!r}")] * len(chunk)
+                stopped = NotDone("Not tried after an earlier chunk failed.")
+            yield done
+
+    def issue_many(self, loans, days=DEFAULT_ISSUE_DAYS, chunk_size=BATCH_CHUNK):
+        """
+        Issue many books at once (a class at semester start): loans is
+        [(member_id, book_id), ...]. Returns one result per loan, in order:
+        its IssueReceipt, or the NotFound / OutOfStock it failed with, which
+        doesn't stop the others (NotDone if its chunk failed, see _chunks).
+        Each chunk_size loans take one transaction: one query for their
+        members, one for their books, one UPDATE for all the stock and one
+        rollup update.
+        """
+        if days < 1:
+            raise InvalidInput("Days must be >= 1")
+        loans = list(loans)
+        issue_date = datetime.date.today()
+        due_date = issue_date + datetime.timedelta(days=days)
+
+        def work(cur, chunk, change):
+            member_ids = sorted({member_id for member_id, _ in chunk})
+            book_ids = sorted({book_id for _, book_id in chunk})
+            cur.execute(MEMBER_NAMES_IN_SQL.format(marks=_marks(len(member_ids))), member_ids)
+            members = dict(cur.fetchall())
+            lock = "" if change else self.pool.backend.lock_rows      # the ledger guards stock itself
+            cur.execute(BOOKS_ISSUE_IN_SQL.format(marks=_marks(len(book_ids))) + lock, book_ids)
+            books = {book_id: (title, stock) for book_id, title, stock in cur.fetchall()}
+
+            def in_stock(book_id):
+                if change:
+                    return change.take({book_id: 1}, cur) is None
+                return books[book_id][1] - taken.get(book_id, 0) >= 1
+
+            results, taken = [], {}
+            for member_id, book_id in chunk:
+                if member_id not in members:
+                    results.append(NotFound("Member not found."))
+                elif book_id not in books:
+                    results.append(NotFound("Book not found."))
+                elif not in_stock(book_id):
+                    results.append(OutOfStock("Book out of stock."))
+                else:
+                    taken[book_id] = taken.get(book_id, 0) + 1
+                    results.append(None)
+            if not taken:
+                return results
+            if not change:
+                cur.execute(*take_stock_sql(taken))
+                if cur.rowcount != len(taken):      # can't happen with the rows locked; don't trust it blindly
+                    raise OutOfStock("Stock changed while issuing, please retry.")
+            # one INSERT per loan: a multi-row INSERT doesn't reliably tell every new issue_id
+            for i, (member_id, book_id) in enumerate(chunk):
+                if results[i] is None:
+                    cur.execute(ISSUE_INSERT_SQL, (member_id, book_id, issue_date, due_date))
+                    results[i] = IssueReceipt(cur.lastrowid, member_id, members[member_id], book_id,
+                                              books[book_id][0], issue_date, due_date)
+            if change:      # any of the chunk's issue ids tells whether it committed
+                change.prepare(f"issue:{cur.lastrowid}")
+            record_issue(cur, self.pool.backend, issue_date, sum(taken.values()))
+            return results
+
+        results = []
+        for done in self._chunks(loans, chunk_size, work):
+            receipts = [r for r in done if isinstance(r, IssueReceipt)]
+            self._stock_changed(*{r.book_id for r in receipts})
+            self._log_many(("book_issued", (r.issue_id, r.member_id, r.book_id, r.issue_date, r.due_date))
+                           for r in receipts)
+            results.extend(done)
+        return results
+
+    def return_many(self, issue_ids, chunk_size=BATCH_CHUNK):
+        """
+        Return many issues at once (a drop box): one result per issue id, in
+        order: its ReturnReceipt, or the NotFound / InvalidInput it failed
+        with (NotDone if its chunk failed, see _chunks). Each chunk_size
+        returns take one transaction: one lookup, one UPDATE closing them
+        all, one restocking every book and one rollup update.
+        """
+        try:
+            issue_ids = [int(i) for i in issue_ids]
+        except (TypeError, ValueError):
+            raise InvalidInput("Issue ids must be whole numbers.")
+        return_date = datetime.date.today()
+
+        def work(cur, chunk, change):
+            ids = sorted(set(chunk))
+            cur.execute(RETURNS_LOOKUP_SQL.format(marks=_marks(len(ids))) + self.pool.backend.lock_rows, ids)
+            found = {row[0]: row for row in cur.fetchall()}
+
+            results, fees, restock = [], {}, {}
+            for issue_id in chunk:
+                row = found.get(issue_id)
+                if row is None:
+                    results.append(NotFound("Issue record not found."))
+                    continue
+                if row[7] is not None or issue_id in fees:
+                    results.append(InvalidInput("This book was already returned."))
+                    continue
+                _, member_id, member_name, book_id, title, _, due_date, _, membership_type = row
+                fees[issue_id] = fee_for(membership_type, (return_date - due_date).days)
+                restock[book_id] = restock.get(book_id, 0) + 1
+                results.append(ReturnReceipt(issue_id, member_id, member_name, book_id, title, return_date,
+                                             fees[issue_id]))
+            if not fees:
+                return results
+            cur.execute(*close_issues_sql(return_date, fees))
+            if cur.rowcount != len(fees):
+                raise InvalidInput("An issue in the batch was returned meanwhile, please retry.")
+            if change:
+                change.give(restock, cur)
+                change.prepare(f"return:{min(fees)}")
+            else:
+                cur.execute(*restock_sql(restock))
+            record_return(cur, self.pool.backend, return_date, total(fees.values()), len(fees))
+            return results
+
+        results = []
+        for done in self._chunks(issue_ids, chunk_size, work):
+            receipts = [r for r in done if isinstance(r, ReturnReceipt)]
+            self._stock_changed(*{r.book_id for r in receipts})
+            self._log_many(("book_returned", (r.issue_id, r.book_id, r.return_date, r.late_fee)) for r in receipts)
+            results.extend(done)
+        return results
+
+    def active_issues(self, token=None, limit=DEFAULT_PAGE_SIZE):
+        """Open issues, newest first."""
+        return self._page(ACTIVE_ISSUES, (), token, limit)
+
+    def issues_by_month(self, ym, by='issue', token=None, limit=DEFAULT_PAGE_SIZE):
+        """by: 'issue', 'return' or 'any' (either date falls in the month)."""
+        start, end = _month(ym)
+        keyset = ISSUES_BY_MONTH.get(by, ISSUES_BY_MONTH['any'])
+        params = (start, end) * (keyset.where.count("%s") // 2)
+        return self._page(keyset, params, token, limit)
+
+    # ---- billing ----
+
+    def create_bill(self, member_id, items, discount_pct=0.0):
+        """
+        items: [(book_id, qty), ...]. member_id None bills a guest.
+        VIP members get VIP_EXTRA_DISCOUNT on top of discount_pct (capped at 100%).
+        The round trips don't grow with the order: the books are read with
+        one IN query, stock is taken with one UPDATE and the lines go in with
+        one multi-row INSERT. Prices and the membership type are read inside
+        the bill's transaction, never from the caches, which another process
+        (an HTTP worker) may not have seen change.
+        """
+        wanted = bill_quantities(items)
+        discount_pct = valid_discount(discount_pct)
+        ids = sorted(wanted)
+        bill_date = None
+        change = self._stock_change()
+
+        def work(cur):
+            nonlocal bill_date
+            member_name, member_type, books = bill_parties(cur, member_id, ids)
+            if change:
+                short = change.take(wanted, cur)
+                if short is not None:
+                    raise NotFound(f"Book not found: {short[0]}") if short[1] is None else short_stock(wanted, [short])
+            else:
+                # one conditional decrement for every book; if another desk got there first, fewer rows match
+                cur.execute(*take_stock_sql(wanted))
+                if cur.rowcount != len(ids):
+                    cur.execute(BOOKS_STOCK_IN_SQL.format(marks=",".join(["%s"] * len(ids))), ids)
+                    raise short_stock(wanted, cur.fetchall())
+
+            receipt = price_bill(member_id, member_name, member_type, items, books, discount_pct)
+            bill_date = datetime.datetime.now()
+            cur.execute(BILL_INSERT_SQL, (member_id, bill_date, receipt.subtotal, receipt.discount_pct,
+                                          receipt.discount_amt, receipt.grand_total))
+            receipt.bill_id = cur.lastrowid
+            if change:
+                change.prepare(f"bill:{receipt.bill_id}")
+            record_bill(cur, self.pool.backend, bill_date, GUEST if member_id is None else member_type,
+                        receipt.subtotal, receipt.discount_amt, receipt.grand_total)
+            cur.execute(multirow_insert_sql("bill_items", BILL_ITEM_COLS, len(receipt.lines)), bill_lines_params(receipt))
+            return receipt
+
+        try:
+            receipt = self._in_transaction(work, change)
+        finally:
+            self._stock_changed(*ids)
+        self._log("bill_created", receipt.bill_id, member_id, GUEST if member_id is None else receipt.member_type, bill_date,
+                  receipt.subtotal, receipt.discount_pct, receipt.discount_amt, receipt.grand_total,
+                  [(line.book_id, line.qty, line.unit_price, line.line_total) for line in receipt.lines])
+        return receipt
+
+    def list_bills(self, token=None, limit=DEFAULT_PAGE_SIZE):
+        """Bills, most recent first."""
+        return self._page(BILLS_LISTING, (), token, limit)
+
+    def bills_by_month(self, ym, token=None, limit=DEFAULT_PAGE_SIZE):
+        start, end = _month(ym)
+        return self._page(BILLS_BY_MONTH, (start, end), token, limit)
+
+    def bill_items(self, bill_id):
+        return records(BillItem, self._fetchall(BILL_ITEMS_SQL, (bill_id,)))
+
+    # ---- overdue ----
+
+    def member_overdue(self, member_id, as_of=None):
+        """
+        A member's books past their due date with the fee accrued so far:
+        [OverdueItem(issue_id, book_id, title, due_date, days_late, fee)].
+        """
+        member = self.get_member(member_id)
+        if not member:
+            raise NotFound("Member not found.")
+        as_of = as_of or datetime.date.today()
+        rows = self._fetchall(MEMBER_OVERDUE_SQL, (member_id, as_of))
+        return [OverdueItem(issue_id, book_id, title, due, (as_of - due).days,
+                            fee_for(member.membership_type, (as_of - due).days))
+                for issue_id, book_id, title, due in rows]
+
+    def overdue_summary(self, as_of=None):
+        """Live [(membership_type, overdue_items, max_days_late, accrued_fee)]; see lms_overdue."""
+        return overdue_summary(self.pool, as_of)
+
+    def snapshot_overdue(self, as_of=None):
+        """Write the nightly overdue snapshot; returns SnapshotStats."""
+        return overdue_snapshot(self.pool, as_of)
+
+    # ---- reports (from the rollups) ----
+
+    def bill_summary(self, ym, daily=False):
+        """
+        Billing totals for a month by membership type:
+        (period, membership_type, bills, subtotal, discount_amt, grand_total)
+        rows, one per type, or one per day and type with daily=True.
+        """
+        start, end = _month(ym)
+        with self.pool.connection() as con:
+            return bill_report(con, start, end, "day" if daily else "month")
+
+    def issue_summary(self, ym, daily=False):
+        """Circulation totals for a month: (period, issues, returns, late_fees) rows."""
+        start, end = _month(ym)
+        with self.pool.connection() as con:
+            return issue_report(con, start, end, "day" if daily else "month")
+
+    # ---- CSV export ----
+
+    def export_table_csv(self, table_name, filename, after=None, compress=None):
+        """Stream a raw table to CSV (gzip if filename ends .gz). Returns ExportStats."""
+        if table_name not in ALLOWED_TABLES:
+            raise InvalidInput("Invalid table name for export.")
+        return export_table(self.pool, table_name, filename, after, compress=compress)
+
+    def export_issues_csv(self, filename, after=None, compress=None, workers=1, by="key", sharded=False):
+        """workers > 1 exports partitions in parallel processes; see lms_export."""
+        try:
+            return export_issues_detailed(self.pool, filename, after, workers, by, sharded, compress=compress)
+        except ValueError as e:
+            raise InvalidInput(str(e))
+
+    def export_bills_csv(self, filename, after=None, compress=None, workers=1, by="key", sharded=False):
+        try:
+            return export_bills_detailed(self.pool, filename, after, workers, by, sharded, compress=compress)
+        except ValueError as e:
+            raise InvalidInput(str(e))
+
+    # ---- Parquet export (needs pyarrow) ----
+
+    def export_parquet(self, name, filename, after=None):
+        """A table, 'issues_detailed' or 'bills_detailed' as one typed Parquet file. Returns ExportStats."""
+        try:
+            return export_parquet(self.pool, name, filename, after)
+        except ValueError as e:
+            raise InvalidInput(str(e))
+
+    def snapshot_parquet(self, directory, full=False):
+        """Append the new rows to the analytics snapshot in directory (see lms_parquet)."""
+        try:
+            return parquet_snapshot(self.pool, directory, full=full)
+        except ValueError as e:
+            raise InvalidInput(str(e))
+
+    # ---- analytics (needs pyarrow) ----
+
+    def top_books(self, by="issues", n=DEFAULT_TOP, start=None, end=None):
+        """The n most issued (by="issues") or best selling (by="revenue") books over [start, end)."""
+        try:
+            return self.analytics.top_books(by, n, start, end)
+        except ValueError as e:
+            raise InvalidInput(str(e))
+
+    def category_sales(self, start=None, end=None):
+        return self.analytics.category_sales(start, end)
+
+    def member_activity(self, start=None, end=None):
+        return self.analytics.member_activity(start, end)
+
+    def stock_turnover(self, start=None, end=None, by="category", n=DEFAULT_TOP):
+        try:
+            return self.analytics.stock_turnover(start, end, by, n)
+        except ValueError as e:
+            raise InvalidInput(str(e))
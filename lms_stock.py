@@ -0,0 +1,581 @@
+"""
+In-memory stock ledger
+----------------------
+books.stock is the hottest field in the system: every issue, return and
+bill moves it with its own UPDATE, and on a popular title the desks queue
+on that one row lock. With a ledger the owning process keeps the counts
+itself and the database catches up behind it:
+
+    LMS_STOCK_LEDGER=/var/lib/lms/stock python LMS01.py
+    python lms_stock.py status
+    python lms_stock.py recover        # apply a crashed process's journal now
+
+Counts live in compact arrays, one slot per book, loaded from books the
+first time the book is touched. A transaction moves stock through a
+StockChange: take() checks and reserves copies under one lock, so two
+desks can't both get the last copy, and give() notes copies coming back.
+Once it commits the change is confirmed (the copies returned go on the
+shelf and the whole change is pending for books); if it fails, cancelled.
+A flusher thread writes the pending changes to books every FLUSH_INTERVAL
+seconds, one CASE UPDATE per FLUSH_CHUNK books, so a hot title costs the
+database one write per interval, not one per loan.
+
+Crash recovery. As its transaction's last statement before the commit, a
+change is journaled under a key the database can answer for, such as
+"issue:<issue_id>" (did that issue row commit?) - see COMMITTED_SQL. A
+cancelled change gets a line withdrawing it. Each flush starts the next
+journal file, stock-<n>.journal, carrying over the changes still in
+flight, and records n in stock_ledger in the same transaction as its
+UPDATE, so the files above the recorded n hold everything books hasn't
+seen. Opening the ledger applies those whose key committed, once, and
+removes every file. Journal lines are written before the commit; they
+survive a killed process, and a power cut too with LMS_STOCK_FSYNC=1.
+
+The ledger must be the only writer of books.stock. One process owns a
+directory (flock); lms_http runs a single worker when one is configured.
+LibraryService sends issues, returns, bills and its own stock edits
+(update_book, delete_book, imports with update_stock) through it, and
+overlays its counts on get_book / get_books. Stock read straight from the
+table lags by up to FLUSH_INTERVAL. AsyncLibraryService refuses to start
+while LMS_STOCK_LEDGER is set; other processes must not write stock, or
+issues, while a ledger owns it.
+
+"""
+
+import os
+import sys
+import time
+import fcntl
+import atexit
+import argparse
+import datetime
+import threading
+from array import array
+from contextlib import contextmanager
+
+from lms_db import ConnectionPool
+
+STOCK_LEDGER_DIR = os.environ.get("LMS_STOCK_LEDGER", "")     # empty: stock is written straight to books
+FSYNC = os.environ.get("LMS_STOCK_FSYNC", "0") == "1"
+FLUSH_INTERVAL = 0.5        # seconds between writes to books
+FLUSH_CHUNK = 500           # books per UPDATE, keys per recovery lookup
+LOCK_FILE = "stock.lock"
+LEDGER_ID = 1               # the stock_ledger row
+LEDGER_POOL_SIZE = 2        # connections of open_ledger()'s own pool
+
+STOCK_LEDGER_TABLE = """
+    CREATE TABLE IF NOT EXISTS stock_ledger (
+        ledger_id  INT PRIMARY KEY,
+        applied    BIGINT NOT NULL,         -- the last journal file written to books
+        updated_at DATETIME NOT NULL
+    ) ENGINE=InnoDB;
+"""
+
+APPLIED_SQL = "SELECT applied FROM stock_ledger WHERE ledger_id=%s"
+BOOKS_STOCK_SQL = "SELECT book_id, stock FROM books WHERE book_id IN ({marks})"
+# journal key kind -> the ids among {marks} whose transaction committed
+COMMITTED_SQL = {
+    "issue": "SELECT issue_id FROM issues WHERE issue_id IN ({marks})",
+    "return": "SELECT issue_id FROM issues WHERE issue_id IN ({marks}) AND return_date IS NOT NULL",
+    "bill": "SELECT bill_id FROM bills WHERE bill_id IN ({marks})",
+}
+
+
+def adjust_stock_sql(deltas):
+    """One UPDATE adding {book_id: signed change} to stock -> (sql, params)."""
+    ids = sorted(deltas)
+    case = "CASE book_id " + " ".join(["WHEN %s THEN %s"] * len(ids)) + " END"
+    params = [v for book_id in ids for v in (book_id, deltas[book_id])]
+    return f"UPDATE books SET stock = stock + {case} WHERE book_id IN ({','.join(['%s'] * len(ids))})", params + ids
+
+
+def write_deltas(cur, backend, deltas, applied):
+    """Add {book_id: change} to books and record journal file `applied` as written, in cur's transaction."""
+    changed = sorted(book_id for book_id, delta in deltas.items() if delta)
+    for start in range(0, len(changed), FLUSH_CHUNK):
+        cur.execute(*adjust_stock_sql({book_id: deltas[book_id] for book_id in changed[start:start + FLUSH_CHUNK]}))
+    cur.execute(backend.upsert_sql("stock_ledger", ("ledger_id", "applied", "updated_at"), ("ledger_id",),
+                                   ("applied", "updated_at")),
+                (LEDGER_ID, applied, datetime.datetime.now()))
+    return len(changed)
+
+
+def _in_chunks(cur, sql, ids):
+    rows = []
+    for start in range(0, len(ids), FLUSH_CHUNK):
+        chunk = ids[start:start + FLUSH_CHUNK]
+        cur.execute(sql.format(marks=",".join(["%s"] * len(chunk))), chunk)
+        rows.extend(cur.fetchall())
+    return rows
+
+
+def _stock_rows(cur, book_ids):
+    return _in_chunks(cur, BOOKS_STOCK_SQL, sorted(book_ids))
+
+# -------------------- JOURNAL --------------------
+# One line per book in a change, "<key>\t<book_id>\t<signed copies>", or
+# "<key>\t-" withdrawing the key's change (its transaction rolled back).
+
+def journal_name(number):
+    return f"stock-{number:012d}.journal"
+
+
+def journals(directory):
+    """[(number, path)] of the journal files in directory, oldest first."""
+    found = []
+    for name in os.listdir(directory) if os.path.isdir(directory) else ():
+        if name.startswith("stock-") and name.endswith(".journal"):
+            found.append((int(name[6:-8]), os.path.join(directory, name)))
+    return sorted(found)
+
+
+def change_lines(key, deltas):
+    return "".join(f"{key}\t{book_id}\t{delta}\n" for book_id, delta in deltas.items() if delta)
+
+
+def read_journal(path, changes=None):
+    """
+    Read one journal file into {key: {book_id: change}}, after the files
+    before it. A withdrawn key is dropped; a key seen again (carried over,
+    or an id the database gave out again) starts over. A torn last line is
+    ignored.
+    """
+    changes = {} if changes is None else changes
+    started = set()
+    with open(path, "rb") as f:
+        lines = f.read().split(b"\n")
+    for line in lines[:-1]:
+        key, rest = line.decode("utf-8").split("\t", 1)
+        if rest == "-":
+            changes.pop(key, None)
+            started.discard(key)
+            continue
+        if key not in started:
+            changes[key] = {}
+            started.add(key)
+        book_id, delta = rest.rsplit("\t", 1)
+        changes[key][book_id] = int(delta)
+    return changes
+
+
+def committed(cur, keys):
+    """The journal keys whose transactions committed, asked of the database in IN batches per kind."""
+    by_kind = {}
+    for key in keys:
+        kind, _, ident = key.partition(":")
+        if kind not in COMMITTED_SQL:
+            raise ValueError(f"Unknown stock journal key: {key}")
+        by_kind.setdefault(kind, []).append(int(ident))
+    found = set()
+    for kind, ids in by_kind.items():
+        found.update(f"{kind}:{row[0]}" for row in _in_chunks(cur, COMMITTED_SQL[kind], sorted(ids)))
+    return found
+
+
+def applied_journal(pool):
+    """The last journal file the database has seen (0: none)."""
+    with pool.connection() as con:
+        cur = con.cursor()
+        cur.execute(APPLIED_SQL, (LEDGER_ID,))
+        row = cur.fetchone()
+        cur.close()
+    return row[0] if row else 0
+
+
+def recover(pool, directory):
+    """
+    Write the changes in the journal files above stock_ledger.applied whose
+    transactions committed to books, in one transaction, and remove all the
+    files. Only for a directory nobody holds open. Returns (files applied,
+    books changed, last file number).
+    """
+    found = journals(directory)
+
+    def work(cur):
+        cur.execute(APPLIED_SQL, (LEDGER_ID,))
+        row = cur.fetchone()
+        applied = row[0] if row else 0
+        todo = [(number, path) for number, path in found if number > applied]
+        if not todo:
+            return 0, 0, max([applied] + [number for number, _ in found])
+        changes = {}
+        for _, path in todo:
+            read_journal(path, changes)
+        deltas = {}
+        for key in committed(cur, changes):
+            for book_id, delta in changes[key].items():
+                deltas[book_id] = deltas.get(book_id, 0) + delta
+        return len(todo), write_deltas(cur, pool.backend, deltas, todo[-1][0]), todo[-1][0]
+
+    result = pool.run_in_transaction(work)
+    for _, path in found:
+        os.remove(path)
+    return result
+
+# -------------------- CHANGES --------------------
+
+class StockChange:
+    """
+    The stock one transaction moves. Inside it: take() / give(), then
+    prepare(key) as the last step. After the commit confirm(), or cancel()
+    if it failed; either leaves the change empty for a retry.
+    """
+    __slots__ = ("ledger", "deltas", "key")
+
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self.deltas = {}        # book_id -> copies, negative for taken
+        self.key = None
+
+    def take(self, wanted, cur=None):
+        """
+        Reserve {book_id: copies}, all or nothing. Returns None if they are
+        held, else (book_id, copies on the shelf) for the first book that
+        can't cover its share, with None for a book that doesn't exist.
+        """
+        short = self.ledger._take(wanted, cur)
+        if short is None:
+            for book_id, copies in wanted.items():
+                self.deltas[book_id] = self.deltas.get(book_id, 0) - copies
+        return short
+
+    def give(self, counts, cur=None):
+        """Put {book_id: copies} back on the shelf when the transaction commits."""
+        self.ledger._load([book_id for book_id in counts if book_id not in self.ledger._slots], cur)
+        for book_id, copies in counts.items():
+            self.deltas[book_id] = self.deltas.get(book_id, 0) + copies
+
+    def prepare(self, key):
+        """Journal the change under key, e.g. "issue:<issue_id>", just before the commit."""
+        if self.deltas:
+            self.key = key
+            self.ledger._prepare(key, self.deltas)
+
+    def confirm(self):
+        if self.deltas:
+            if self.key is None:
+                raise RuntimeError("A stock change must be prepared before its transaction commits.")
+            self.ledger._confirm(self.key, self.deltas)
+        self.deltas, self.key = {}, None
+
+    def cancel(self):
+        if self.deltas:
+            self.ledger._cancel(self.key, self.deltas)
+        self.deltas, self.key = {}, None
+
+# -------------------- LEDGER --------------------
+
+class StockLedger:
+    """
+    Authoritative stock counts for the books this process has touched.
+    All methods are safe from any thread; one flusher thread per process
+    writes the pending changes to books.
+    """
+
+    def __init__(self, pool, directory, interval=FLUSH_INTERVAL, fsync=FSYNC):
+        os.makedirs(directory, exist_ok=True)
+        self.pool = pool
+        self.directory = directory
+        self.interval = interval
+        self.fsync = fsync
+        self._lock_fd = os.open(os.path.join(directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self._lock_fd)
+            raise RuntimeError(f"The stock ledger in {directory} is in use by another process.")
+        try:
+            self.recovered = recover(pool, directory)
+        except BaseException:
+            os.close(self._lock_fd)
+            raise
+        self._slots = {}            # book_id -> index into the arrays
+        self._ids = []              # index -> book_id
+        self._stock = array("q")    # copies on the shelf: what take() may hand out
+        self._held = array("q")     # taken by transactions not yet confirmed or cancelled
+        self._pending = array("q")  # confirmed changes not yet written to books
+        self._dirty = set()         # slots with a pending change
+        self._prepared = {}         # key -> deltas journaled for transactions still in flight
+        self._lock = threading.Lock()
+        self._flush_lock = threading.RLock()
+        self._number = self.recovered[2] + 1
+        self._fd = self._open_journal()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        self.flushes = self.books_written = self.errors = 0
+        self.last_error = None
+
+    def change(self):
+        """A StockChange for one transaction."""
+        return StockChange(self)
+
+    # ---- counts ----
+
+    def _load(self, book_ids, cur=None):
+        """Give the books that exist a slot, from books.stock (read through cur if given)."""
+        if not book_ids:
+            return
+        if cur is not None:
+            rows = _stock_rows(cur, book_ids)
+        else:
+            with self.pool.connection() as con:
+                c = con.cursor()
+                rows = _stock_rows(c, book_ids)
+                c.close()
+        with self._lock:
+            for book_id, stock in rows:
+                if book_id not in self._slots:      # no pending change can exist for an unloaded book
+                    self._slots[book_id] = len(self._ids)
+                    self._ids.append(book_id)
+                    self._stock.append(stock)
+                    self._held.append(0)
+                    self._pending.append(0)
+
+    def stock_of(self, book_id):
+        """Copies on the shelf, or None if the ledger hasn't loaded the book."""
+        slot = self._slots.get(book_id)
+        return None if slot is None else self._stock[slot]
+
+    def _take(self, wanted, cur):
+        self._load([book_id for book_id in wanted if book_id not in self._slots], cur)
+        with self._lock:
+            slots = []
+            for book_id in sorted(wanted):
+                slot = self._slots.get(book_id)
+                if slot is None:
+                    return book_id, None
+                if self._stock[slot] < wanted[book_id]:
+                    return book_id, self._stock[slot]
+                slots.append((slot, wanted[book_id]))
+            for slot, copies in slots:
+                self._stock[slot] -= copies
+                self._held[slot] += copies
+        return None
+
+    def _prepare(self, key, deltas):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The stock ledger is closed.")
+            self._prepared[key] = dict(deltas)
+            self._write(change_lines(key, deltas), self.fsync)
+
+    def _confirm(self, key, deltas):
+        if self._pid != os.getpid():        # first change, or in a forked child: the thread didn't come along
+            self._start()
+        with self._lock:
+            self._prepared.pop(key, None)
+            for book_id, delta in deltas.items():
+                slot = self._slots.get(book_id)
+                if slot is None or not delta:       # deleted meanwhile
+                    continue
+                if delta < 0:
+                    self._held[slot] += delta
+                else:
+                    self._stock[slot] += delta
+                self._pending[slot] += delta
+                self._dirty.add(slot)
+
+    def _cancel(self, key, deltas):
+        with self._lock:
+            for book_id, delta in deltas.items():
+                slot = self._slots.get(book_id)
+                if slot is not None and delta < 0:
+                    self._stock[slot] -= delta
+                    self._held[slot] += delta
+            if key is not None and self._prepared.pop(key, None) is not None:
+                self._write(f"{key}\t-\n", False)
+
+    def _write(self, text, sync):
+        """Append to the journal; the caller holds _lock, so a flush can't switch files under it."""
+        data = text.encode("utf-8")
+        while data:
+            data = data[os.write(self._fd, data):]
+        if sync:
+            os.fsync(self._fd)
+
+    @contextmanager
+    def exclusive(self):
+        """
+        Write the pending changes and hold off further flushes while the
+        caller sets books.stock outright (update, delete, import); call
+        reload() with the books it changed before leaving.
+        """
+        with self._flush_lock:
+            self._flush()
+            yield self
+
+    def reload(self, book_ids):
+        """Re-read books from books.stock after it was set outright; deleted ones leave the ledger."""
+        with self._flush_lock:          # no flush between reading the table and the pending changes
+            loaded = [book_id for book_id in book_ids if book_id in self._slots]
+            if not loaded:
+                return
+            with self.pool.connection() as con:
+                cur = con.cursor()
+                rows = dict(_stock_rows(cur, loaded))
+                cur.close()
+            with self._lock:
+                for book_id in loaded:
+                    slot = self._slots.get(book_id)
+                    if slot is None:
+                        continue
+                    if book_id in rows:
+                        self._stock[slot] = rows[book_id] + self._pending[slot] - self._held[slot]
+                    else:
+                        del self._slots[book_id]
+                        self._dirty.discard(slot)
+                        self._pending[slot] = self._held[slot] = self._stock[slot] = 0
+
+    # ---- flushing ----
+
+    def _open_journal(self):
+        return os.open(os.path.join(self.directory, journal_name(self._number)),
+                       os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name="lms-stock", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                pass                # kept in last_error; the changes stay pending for the next try
+
+    def flush(self):
+        """Write the pending changes to books now. Returns how many books changed."""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            if not self._dirty:
+                return 0
+            deltas = {self._ids[slot]: self._pending[slot] for slot in self._dirty}
+            for slot in self._dirty:
+                self._pending[slot] = 0
+            self._dirty.clear()
+            number = self._number
+            os.close(self._fd)
+            self._number += 1
+            self._fd = self._open_journal()
+            # changes still in flight must outlive the file they were journaled in
+            self._write("".join(change_lines(key, d) for key, d in self._prepared.items()), self.fsync)
+        try:
+            written = self.pool.run_in_transaction(lambda cur: write_deltas(cur, self.pool.backend, deltas, number))
+        except Exception as e:
+            with self._lock:        # pending again; their journal file stays until a later flush covers it
+                for book_id, delta in deltas.items():
+                    slot = self._slots.get(book_id)
+                    if slot is not None:
+                        self._pending[slot] += delta
+                        self._dirty.add(slot)
+            self.errors += 1
+            self.last_error = repr(e)
+            raise
+        for n, path in journals(self.directory):
+            if n <= number:
+                os.remove(path)
+        self.flushes += 1
+        self.books_written += written
+        return written
+
+    def close(self):
+        """Stop the flusher, write what is pending and let go of the directory."""
+        with self._lock:
+            if self._closed:
+                return
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                self._closed = True
+                os.close(self._fd)
+                if not self._dirty and not self._prepared:  # everything is in books: the last file can go
+                    os.remove(os.path.join(self.directory, journal_name(self._number)))
+            os.close(self._lock_fd)
+
+    def stats(self):
+        with self._lock:
+            return {"directory": self.directory, "books": len(self._slots), "pending": len(self._dirty),
+                    "held": sum(self._held), "in_flight": len(self._prepared), "journal": self._number,
+                    "flushes": self.flushes, "books_written": self.books_written, "errors": self.errors,
+                    "last_error": self.last_error}
+
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def open_ledger(pool, directory=None):
+    """
+    The process-wide StockLedger for directory (default LMS_STOCK_LEDGER),
+    or None if there is none configured. It flushes through a small pool
+    of its own on pool's backend, so it outlives the callers' pools, and
+    is closed (flushed) at exit.
+    """
+    directory = directory or STOCK_LEDGER_DIR
+    if not directory:
+        return None
+    with _ledgers_lock:
+        ledger = _ledgers.get(directory)
+        if ledger is None:
+            ledger = _ledgers[directory] = StockLedger(ConnectionPool(pool.backend, size=LEDGER_POOL_SIZE), directory)
+            atexit.register(ledger.close)
+        return ledger
+
+# -------------------- CLI --------------------
+
+def main(argv=None):
+    from lms_db import get_pool
+
+    ap = argparse.ArgumentParser(description="The in-memory stock ledger's journal.")
+    ap.add_argument("command", choices=("status", "recover"))
+    ap.add_argument("--dir", default=STOCK_LEDGER_DIR, help="ledger directory (default: LMS_STOCK_LEDGER)")
+    args = ap.parse_args(argv)
+    if not args.dir:
+        print("No ledger directory: set LMS_STOCK_LEDGER or pass --dir.")
+        return 1
+
+    pool = get_pool()
+    try:
+        if args.command == "status":
+            applied = applied_journal(pool)
+            found = journals(args.dir)
+            waiting = [path for number, path in found if number > applied]
+            changes = {}
+            for path in waiting:
+                read_journal(path, changes)
+            print(f"last journal written to books: {applied}")
+            print(f"journal files not yet written: {len(waiting)} ({len(changes)} changes)")
+            return 0
+        lock_fd = os.open(os.path.join(args.dir, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print(f"The stock ledger in {args.dir} is in use by another process.")
+            return 1
+        try:
+            started = time.perf_counter()
+            files, books, _ = recover(pool, args.dir)
+        finally:
+            os.close(lock_fd)
+        print(f"applied {files} journal file(s), {books} book(s) changed, in {time.perf_counter() - started:.2f}s")
+        return 0
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,346 @@
+"""
+Benchmark suite
+---------------
+Repeatable numbers to compare one commit against another. A seeded
+synthetic library (lms_synth) is generated once per spec into an SQLite
+file under --data-dir, and every workload starts from that same file, so
+two runs with the same spec differ only in the code under test.
+
+    python lms_suite.py --scale 100k --out before.json
+    python lms_suite.py --scale 100k --out after.json --compare before.json
+
+Always the embedded SQLite backend (whatever LMS_BACKEND says): no server
+and no network needed.
+
+search       catalogue searches of one or two words drawn from the title
+             vocabulary; building the index on first use is reported apart
+circulation  issues and returns, books and members picked with the
+             library's skew (OutOfStock is counted as rejected, not error)
+bills        create_bill with 1-3 lines, guests and members
+reports      monthly billing / circulation summaries and first pages of
+             the by-month listings, for every month of the history
+exports      every table and the two detailed exports to CSV, one op each
+
+Each workload runs in a fresh process (peak_rss_kb is that process's
+peak) and the writing ones on a scratch copy of the database. The JSON
+written by --out holds, per workload: ops, seconds, ops_per_sec,
+p50_ms / p95_ms / p99_ms / max_ms, peak_rss_kb, errors, rejected and a
+few workload-specific figures, plus the commit, spec and environment.
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import platform
+import datetime
+import tempfile
+import statistics
+import subprocess
+import multiprocessing
+from collections import deque
+from dataclasses import asdict
+from concurrent.futures import ProcessPoolExecutor
+
+from lms_db import ALLOWED_TABLES, ConnectionPool, SQLiteBackend
+from lms_export import ExportStats, peak_rss_kb
+from lms_migrations import migrate
+from lms_service import LibraryService, OutOfStock
+from lms_synth import (DEFAULT_SEED, DEFAULT_SKEW, MONTHS, WORDS, Spec, Zipf, book_id, generate,
+                       parse_count)
+
+RESULTS_VERSION = 1
+DEFAULT_OPS = 2000
+DATA_DIR = os.path.join(tempfile.gettempdir(), "lms-suite")
+HELD = 50                   # circulation: copies a desk holds before it starts returning the oldest
+# (metric, True if higher is better) shown by --compare
+COMPARED = (("ops_per_sec", True), ("p50_ms", False), ("p99_ms", False), ("peak_rss_kb", False))
+
+
+def library_file(spec, data_dir, regenerate=False, progress=None):
+    """Path of the generated database for spec, generating it first if needed -> (path, seconds spent)."""
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f"library-{spec.tag}.sqlite3")
+    if os.path.exists(path) and not regenerate:
+        return path, 0.0
+    tmp = path + ".tmp"
+    for p in (tmp, tmp + "-wal", tmp + "-shm", path):
+        if os.path.exists(p):
+            os.remove(p)
+    started = time.perf_counter()
+    pool = ConnectionPool(SQLiteBackend(tmp), size=1)
+    try:
+        migrate(pool)
+        generate(pool, spec, progress)
+    finally:
+        pool.close()    # the last connection out checkpoints the WAL into the file
+    os.replace(tmp, path)
+    return path, time.perf_counter() - started
+
+
+def _scratch_copy(path):
+    fd, copy = tempfile.mkstemp(prefix="lms-suite-", suffix=".sqlite3", dir=os.path.dirname(path))
+    os.close(fd)
+    shutil.copyfile(path, copy)
+    return copy
+
+
+def _remove_db(path):
+    for p in (path, path + "-wal", path + "-shm"):
+        if os.path.exists(p):
+            os.remove(p)
+
+# -------------------- WORKLOADS --------------------
+# Each takes (svc, spec, rng, ops, work_dir) and returns the calls to time as
+# [(fn, *args)]; a call raising OutOfStock counts as rejected, anything else
+# as an error. work_dir is a scratch directory removed afterwards.
+
+def search_ops(svc, spec, rng, ops, work_dir):
+    words = Zipf(len(WORDS), 1.0)
+    queries = [" ".join(WORDS[words.rank(rng)] for _ in range(rng.randint(1, 2))) for _ in range(ops)]
+    return [(svc.search_books, q) for q in queries]
+
+
+def circulation_ops(svc, spec, rng, ops, work_dir):
+    books = Zipf(spec.books, spec.skew)
+    members = Zipf(spec.members, spec.skew)
+    held = deque()
+
+    def step():
+        # half returns (oldest copy first) once the desk holds anything, all returns once it holds HELD
+        if held and (len(held) >= HELD or rng.random() < 0.5):
+            return svc.return_issue(held.popleft())
+        receipt = svc.issue(members.pick(rng) + 1, book_id(books.pick(rng)))
+        held.append(receipt.issue_id)
+        return receipt
+
+    return [(step,)] * ops
+
+
+def bills_ops(svc, spec, rng, ops, work_dir):
+    books = Zipf(spec.books, spec.skew)
+    members = Zipf(spec.members, spec.skew)
+    calls = []
+    for _ in range(ops):
+        member_id = None if rng.random() < 0.3 else members.pick(rng) + 1
+        items = {book_id(books.pick(rng)): 1 for _ in range(rng.randint(1, 3))}
+        calls.append((svc.create_bill, member_id, list(items.items())))
+    return calls
+
+
+def reports_ops(svc, spec, rng, ops, work_dir):
+    kinds = (
+        lambda ym: svc.bill_summary(ym),
+        lambda ym: svc.bill_summary(ym, daily=True),
+        lambda ym: svc.issue_summary(ym, daily=True),
+        lambda ym: svc.bills_by_month(ym),
+        lambda ym: svc.issues_by_month(ym, by="any"),
+    )
+    months = spec.year_months()
+    return [(kinds[n % len(kinds)], months[n // len(kinds) % len(months)]) for n in range(ops)]
+
+
+def exports_ops(svc, spec, rng, ops, work_dir):
+    calls = [(svc.export_table_csv, table, os.path.join(work_dir, f"{table}.csv")) for table in sorted(ALLOWED_TABLES)]
+    calls.append((svc.export_issues_csv, os.path.join(work_dir, "issues_detailed.csv")))
+    calls.append((svc.export_bills_csv, os.path.join(work_dir, "bills_detailed.csv")))
+    return calls
+
+# name -> (plan, writes to the database)
+WORKLOADS = {
+    "search": (search_ops, False),
+    "circulation": (circulation_ops, True),
+    "bills": (bills_ops, True),
+    "reports": (reports_ops, False),
+    "exports": (exports_ops, False),
+}
+
+
+def _summary(latencies, seconds):
+    ms = sorted(t * 1000 for t in latencies)
+    if len(ms) >= 2:
+        cuts = statistics.quantiles(ms, n=100)
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = ms[0] if ms else 0.0
+    return {
+        "ops": len(ms),
+        "seconds": round(seconds, 4),
+        "ops_per_sec": round(len(ms) / seconds, 2) if seconds else 0.0,
+        "p50_ms": round(p50, 4),
+        "p95_ms": round(p95, 4),
+        "p99_ms": round(p99, 4),
+        "max_ms": round(ms[-1], 4) if ms else 0.0,
+    }
+
+
+def run_workload(name, db_path, spec, ops, seed):
+    """Run one workload in this process against db_path -> its results dict."""
+    plan, _ = WORKLOADS[name]
+    pool = ConnectionPool(SQLiteBackend(db_path), size=2)
+    svc = LibraryService(pool)
+    rng = random.Random(f"{seed}-{name}")
+    extra = {}
+    work_dir = tempfile.mkdtemp(prefix="lms-suite-")
+    try:
+        if name == "search":
+            started = time.perf_counter()
+            svc.search_index
+            extra["index_build_s"] = round(time.perf_counter() - started, 4)
+        calls = plan(svc, spec, rng, ops, work_dir)
+
+        latencies, errors, rejected, rows = [], [], 0, 0
+        started = time.perf_counter()
+        for fn, *args in calls:
+            t = time.perf_counter()
+            try:
+                result = fn(*args)
+                if isinstance(result, ExportStats):
+                    rows += result.rows
+            except OutOfStock:
+                rejected += 1
+            except Exception as e:
+                errors.append(f"{getattr(fn, '__name__', 'op')}{tuple(args)!r}: {e!r}")
+            latencies.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - started
+    finally:
+        pool.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = _summary(latencies, elapsed)
+    if rows:
+        extra["rows"] = rows
+        extra["rows_per_sec"] = round(rows / elapsed, 1)
+    extra["book_cache_hit_rate"] = round(svc.cache_stats()["books"]["hit_rate"], 4)
+    results.update(extra, errors=len(errors), rejected=rejected, error_samples=errors[:5],
+                   peak_rss_kb=peak_rss_kb())
+    return results
+
+# -------------------- RUN --------------------
+
+def _git(*args):
+    try:
+        out = subprocess.run(["git", *args], cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() if out.returncode == 0 else None
+
+
+def environment():
+    status = _git("status", "--porcelain", "--untracked-files=no")
+    return {
+        "commit": _git("rev-parse", "HEAD"),
+        "dirty": None if status is None else bool(status),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_suite(spec, path, names, ops, on_result=None):
+    """Run the named workloads against the library for spec at path -> results document."""
+    doc = {"version": RESULTS_VERSION, **environment(), "spec": asdict(spec), "ops": ops, "workloads": {}}
+    ctx = multiprocessing.get_context("spawn")
+    for name in names:
+        db_path = _scratch_copy(path) if WORKLOADS[name][1] else path
+        try:
+            with ProcessPoolExecutor(1, mp_context=ctx) as ex:
+                doc["workloads"][name] = ex.submit(run_workload, name, db_path, spec, ops, spec.seed).result()
+        finally:
+            if db_path != path:
+                _remove_db(db_path)
+        if on_result:
+            on_result(name, doc["workloads"][name])
+    return doc
+
+
+def compare(old, new):
+    """Lines comparing the COMPARED metrics of two results documents."""
+    lines = []
+    if old.get("spec") != new.get("spec"):
+        lines.append("warning: the two runs used different specs; the numbers are not comparable")
+    lines.append(f"{'workload':>12} | {'metric':>11} | {'before':>12} | {'after':>12} | change")
+    lines.append("-" * 68)
+    for name, after in new["workloads"].items():
+        before = old.get("workloads", {}).get(name)
+        if not before:
+            continue
+        for metric, higher_is_better in COMPARED:
+            a, b = before.get(metric), after.get(metric)
+            if not a or b is None:
+                continue
+            change = (b - a) / a
+            better = change > 0 if higher_is_better else change < 0
+            mark = "" if abs(change) < 0.05 else (" better" if better else " WORSE")
+            lines.append(f"{name:>12} | {metric:>11} | {a:>12,.2f} | {b:>12,.2f} | {change:+7.1%}{mark}")
+    return lines
+
+# -------------------- CLI --------------------
+
+def _print_result(name, r):
+    print(f"{name:>12} | {r['ops']:>6} | {r['ops_per_sec']:>9,.1f} | {r['p50_ms']:>8.2f} | {r['p95_ms']:>8.2f} | "
+          f"{r['p99_ms']:>8.2f} | {r['peak_rss_kb'] / 1024:>7.1f} | {r['errors']}/{r['rejected']}")
+    for e in r["error_samples"][:3]:
+        print(f"        {e}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Reproducible benchmark suite on a seeded synthetic library (SQLite).")
+    ap.add_argument("--scale", default="10k", help="books: 1k, 10k, 100k, 1m, 10m or any count (default: 10k)")
+    ap.add_argument("--members", help="members (default: from the scale)")
+    ap.add_argument("--issues", help="issues (default: from the scale)")
+    ap.add_argument("--bills", help="bills (default: from the scale)")
+    ap.add_argument("--seed", type=int, default=DEFAULT_SEED, help=f"random seed (default: {DEFAULT_SEED})")
+    ap.add_argument("--skew", type=float, default=DEFAULT_SKEW, help=f"Zipf exponent, 0 = uniform (default: {DEFAULT_SKEW})")
+    ap.add_argument("--months", type=int, default=MONTHS, help=f"months of history (default: {MONTHS})")
+    ap.add_argument("--ops", type=int, default=DEFAULT_OPS, help=f"operations per workload (default: {DEFAULT_OPS})")
+    ap.add_argument("--workloads", default=",".join(WORKLOADS), help="comma-separated subset (default: all)")
+    ap.add_argument("--data-dir", default=DATA_DIR, help=f"where generated libraries are kept (default: {DATA_DIR})")
+    ap.add_argument("--regenerate", action="store_true", help="generate the library again even if it exists")
+    ap.add_argument("--out", help="write the results as JSON to this file")
+    ap.add_argument("--compare", help="results JSON of an earlier run to compare against")
+    args = ap.parse_args(argv)
+
+    names = [n.strip() for n in args.workloads.split(",") if n.strip()]
+    unknown = [n for n in names if n not in WORKLOADS]
+    if unknown:
+        ap.error(f"unknown workload(s): {', '.join(unknown)} (choose from {', '.join(WORKLOADS)})")
+    spec = Spec.at_scale(parse_count(args.scale),
+                         *(parse_count(v) if v else None for v in (args.members, args.issues, args.bills)),
+                         seed=args.seed, skew=args.skew, months=args.months)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    path, generate_s = library_file(spec, args.data_dir, args.regenerate,
+                                    lambda table, n: print(f"\r  generating {table}: {n:,}   ", end="", flush=True))
+    if generate_s:
+        print(f"\rGenerated {path} in {generate_s:.1f}s")
+    print(f"{spec.books:,} books, {spec.members:,} members, {spec.issues:,} issues, {spec.bills:,} bills "
+          f"(seed {spec.seed}, skew {spec.skew:g}); {args.ops} ops per workload")
+    print(f"{'workload':>12} | {'ops':>6} | {'ops/sec':>9} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8} | "
+          f"{'peak MB':>7} | err/rej")
+    print("-" * 90)
+    doc = run_suite(spec, path, names, args.ops, on_result=_print_result)
+    doc["generate_s"] = round(generate_s, 2) if generate_s else None
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(doc, f, indent=2)
+            f.write("\n")
+    if baseline:
+        print()
+        print("\n".join(compare(baseline, doc)))
+    return 1 if any(r["errors"] for r in doc["workloads"].values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
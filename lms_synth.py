@@ -0,0 +1,388 @@
+"""
+Synthetic library generator
+---------------------------
+Fills an empty database with a made-up but plausible library: books,
+staff, members, issues, bills and bill_items, then rebuilds the reporting
+rollups. The same spec and seed always give the same rows, so benchmark
+numbers (lms_suite.py) can be compared across commits.
+
+    LMS_BACKEND=sqlite LMS_SQLITE_PATH=/tmp/synth.db python lms_synth.py --scale 100k
+
+The scale is the number of books (1k .. 10m); members, issues and bills
+follow from it (MEMBERS_PER_BOOK etc.) unless given explicitly. The skew
+is a Zipf exponent: with the default the most popular 5% of books get
+about half of the loans and sales, and heavy borrowers dominate likewise.
+History covers `months` months up to END_DATE, busier at weekends and
+growing over time; issues and bills are written in date order.
+
+"""
+
+import sys
+import math
+import random
+import datetime
+import argparse
+from array import array
+from dataclasses import dataclass
+
+from lms_db import ALLOWED_TABLES
+from lms_money import ZERO, from_paise
+from lms_overdue import fee_for
+from lms_rollups import rebuild
+from lms_service import MEMBERSHIP_TYPES, DEFAULT_ISSUE_DAYS, price_bill
+
+SCALES = {"1k": 1_000, "10k": 10_000, "100k": 100_000, "1m": 1_000_000, "10m": 10_000_000}
+MEMBERS_PER_BOOK = 0.2
+ISSUES_PER_BOOK = 1.0
+BILLS_PER_BOOK = 0.25
+STAFF = 25
+DEFAULT_SEED = 42
+DEFAULT_SKEW = 0.8          # Zipf exponent for book / member popularity; 0 = uniform
+MONTHS = 24
+END_DATE = datetime.date(2025, 12, 31)  # fixed, so a seed gives the same rows whenever it runs
+BATCH = 5000
+
+VIP_SHARE = 0.15
+GUEST_BILLS = 0.3           # share of bills with no member
+RETURNED = 0.92             # share of loans that come back (the rest stay open or are lost)
+MEAN_LOAN_DAYS = 12
+WEEKEND_BOOST = 1.4
+GROWTH = 0.5                # the last day is this much busier than the first
+
+WORDS = (
+    "river", "garden", "night", "stone", "empire", "glass", "winter", "shadow", "ocean", "fire",
+    "silver", "crown", "forest", "storm", "iron", "paper", "house", "city", "war", "love",
+    "light", "dark", "king", "queen", "island", "mountain", "secret", "journey", "history", "world",
+    "song", "blood", "star", "moon", "sun", "road", "time", "death", "life", "dream",
+    "memory", "letter", "bridge", "tower", "sea", "wind", "rain", "snow", "summer", "autumn",
+    "spring", "child", "mother", "father", "daughter", "son", "brother", "sister", "friend", "stranger",
+    "lost", "hidden", "broken", "golden", "black", "white", "red", "blue", "green", "last",
+    "first", "little", "great", "long", "deep", "wild", "silent", "burning", "falling", "rising",
+    "guide", "art", "science", "music", "kitchen", "code", "python", "data", "money", "mind",
+    "body", "health", "nature", "animal", "bird", "horse", "dragon", "ghost", "machine", "engine",
+)
+FIRST_NAMES = (
+    "Aarav", "Aditi", "Alice", "Amir", "Ana", "Arjun", "Ben", "Chen", "Chloe", "Daniel",
+    "Deepa", "Elena", "Emma", "Farah", "Grace", "Hana", "Ivan", "Jack", "Jia", "Kavya",
+    "Leo", "Lina", "Maya", "Meera", "Mohan", "Nadia", "Noah", "Omar", "Priya", "Rahul",
+    "Ravi", "Rosa", "Sam", "Sara", "Sofia", "Tara", "Tom", "Uma", "Vikram", "Zoe",
+)
+LAST_NAMES = (
+    "Ahmed", "Bose", "Brown", "Castro", "Chen", "Das", "Diaz", "Evans", "Fischer", "Garcia",
+    "Gupta", "Hall", "Ito", "Iyer", "Jones", "Kapoor", "Khan", "Kim", "Kumar", "Lee",
+    "Lopez", "Martin", "Mehta", "Menon", "Miller", "Mishra", "Nair", "Nguyen", "Novak", "Patel",
+    "Petrov", "Rao", "Reddy", "Rossi", "Roy", "Sato", "Shah", "Sharma", "Silva", "Singh",
+    "Smith", "Sousa", "Taylor", "Thomas", "Verma", "Wang", "Weber", "Wilson", "Yadav", "Zhang",
+)
+CATEGORIES = (
+    "Fiction", "Mystery", "Science Fiction", "Fantasy", "Romance", "History", "Biography", "Science",
+    "Technology", "Children", "Young Adult", "Poetry", "Travel", "Cookery", "Art", "Business",
+    "Health", "Philosophy", "Religion", "Reference",
+)
+ROLES = ("Librarian", "Assistant", "Clerk", "Manager", "Archivist")
+
+
+def parse_count(text):
+    """'250k' -> 250000, '1.5m' -> 1500000, '300' -> 300."""
+    text = text.strip().lower()
+    if text in SCALES:
+        return SCALES[text]
+    mult = {"k": 1_000, "m": 1_000_000}.get(text[-1:], 1)
+    n = float(text[:-1] if mult > 1 else text)
+    if n < 1:
+        raise ValueError(f"count must be >= 1: {text!r}")
+    return int(n * mult)
+
+
+@dataclass
+class Spec:
+    books: int
+    members: int
+    issues: int
+    bills: int
+    seed: int = DEFAULT_SEED
+    skew: float = DEFAULT_SKEW
+    months: int = MONTHS
+
+    @classmethod
+    def at_scale(cls, books, members=None, issues=None, bills=None, **kwargs):
+        """A spec for `books` books with the other tables in their usual proportions."""
+        return cls(books,
+                   members or max(int(books * MEMBERS_PER_BOOK), 1),
+                   issues if issues is not None else int(books * ISSUES_PER_BOOK),
+                   bills if bills is not None else int(books * BILLS_PER_BOOK),
+                   **kwargs)
+
+    @property
+    def tag(self):
+        """Short name for this spec, e.g. for caching a generated database file."""
+        return (f"b{self.books}-m{self.members}-i{self.issues}-bl{self.bills}"
+                f"-s{self.seed}-z{self.skew:g}-mo{self.months}")
+
+    @property
+    def start(self):
+        return END_DATE - datetime.timedelta(days=self.days - 1)
+
+    @property
+    def days(self):
+        return round(self.months * 365.25 / 12)
+
+    def year_months(self):
+        """'YYYY-MM' for every month the history touches, oldest first."""
+        months = []
+        day = self.start.replace(day=1)
+        while day <= END_DATE:
+            months.append(day.strftime("%Y-%m"))
+            day = (day + datetime.timedelta(days=32)).replace(day=1)
+        return months
+
+
+def book_id(i):
+    return f"B{i:08d}"
+
+
+class Zipf:
+    """
+    Draws 0..n-1 with P(k) ~ 1 / (k+1)^s by inverting the continuous CDF,
+    so it needs no table and works the same at n = 10M. pick() scatters the
+    popular ranks over the key range instead of bunching them at the start.
+    """
+
+    def __init__(self, n, s):
+        self.n = n
+        self.s = s
+        self._a = 1.0 - s
+        self._top = (n + 1) ** self._a - 1.0 if s != 1.0 else math.log(n + 1)
+        stride = max(int(n * 0.6180339887), 1) | 1
+        while math.gcd(stride, n) != 1:
+            stride += 2
+        self._stride = stride
+
+    def rank(self, rng):
+        u = rng.random()
+        if self.s == 1.0:
+            x = math.exp(u * self._top)
+        else:
+            x = (1.0 + u * self._top) ** (1.0 / self._a)
+        return min(int(x) - 1, self.n - 1)
+
+    def pick(self, rng):
+        return self.rank(rng) * self._stride % self.n
+
+
+def _spread(total, weights):
+    """Split total into len(weights) whole counts in proportion to weights (rounding carried along)."""
+    scale = total / sum(weights)
+    counts, acc, given = [], 0.0, 0
+    for w in weights:
+        acc += w * scale
+        n = round(acc) - given
+        counts.append(n)
+        given += n
+    return counts
+
+
+def day_weights(spec):
+    """Relative activity per day of the history: weekends and later days are busier."""
+    weights = []
+    for d in range(spec.days):
+        day = spec.start + datetime.timedelta(days=d)
+        weekend = WEEKEND_BOOST if day.weekday() >= 5 else 1.0
+        weights.append(weekend * (1.0 + GROWTH * d / max(spec.days - 1, 1)))
+    return weights
+
+
+def _name(rng):
+    return rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+
+
+def _author(k):
+    first = FIRST_NAMES[k % len(FIRST_NAMES)]
+    last = LAST_NAMES[k // len(FIRST_NAMES) % len(LAST_NAMES)]
+    initial = chr(65 + k // (len(FIRST_NAMES) * len(LAST_NAMES)) % 26)
+    return f"{first} {initial}. {last}"
+
+# -------------------- ROWS --------------------
+
+def book_rows(spec, rng, prices):
+    """(book_id, title, author, category, price, stock); appends each price in cents to `prices`."""
+    words = Zipf(len(WORDS), 1.0)
+    authors = Zipf(max(spec.books // 8, 1), spec.skew)
+    categories = Zipf(len(CATEGORIES), 1.0)
+    for i in range(spec.books):
+        title = " ".join(dict.fromkeys(WORDS[words.rank(rng)] for _ in range(rng.randint(2, 4)))).title()
+        cents = min(int(rng.lognormvariate(3.0, 0.5) * 100), 50000)
+        prices.append(cents)
+        stock = 0 if rng.random() < 0.05 else rng.randint(1, 10)
+        yield book_id(i), title, _author(authors.pick(rng)), CATEGORIES[categories.rank(rng)], from_paise(cents), stock
+
+
+def staff_rows(rng):
+    for i in range(STAFF):
+        first, last = _name(rng)
+        yield i + 1, f"{first} {last}", ROLES[0 if i < 3 else rng.randrange(1, len(ROLES))], f"9{rng.randrange(10 ** 9):09d}"
+
+
+def member_rows(spec, rng, vip):
+    """(member_id, name, phone, email, membership_type); sets vip[i] for VIP members."""
+    for i in range(spec.members):
+        first, last = _name(rng)
+        is_vip = rng.random() < VIP_SHARE
+        vip[i] = is_vip
+        email = f"{first}.{last}{i}@example.org".lower() if rng.random() < 0.8 else None
+        yield i + 1, f"{first} {last}", f"9{rng.randrange(10 ** 9):09d}", email, MEMBERSHIP_TYPES[is_vip]
+
+
+def issue_rows(spec, rng, vip):
+    """(member_id, book_id, issue_date, due_date, return_date, late_fee) in issue_date order."""
+    books = Zipf(spec.books, spec.skew)
+    members = Zipf(spec.members, spec.skew)
+    for d, count in enumerate(_spread(spec.issues, day_weights(spec))):
+        issued = spec.start + datetime.timedelta(days=d)
+        due = issued + datetime.timedelta(days=DEFAULT_ISSUE_DAYS)
+        for _ in range(count):
+            m = members.pick(rng)
+            returned, fee = None, ZERO
+            if rng.random() < RETURNED:
+                returned = issued + datetime.timedelta(days=1 + int(rng.expovariate(1 / MEAN_LOAN_DAYS)))
+                if returned > END_DATE:
+                    returned = None
+                else:
+                    fee = fee_for(MEMBERSHIP_TYPES[vip[m]], (returned - due).days)
+            yield m + 1, book_id(books.pick(rng)), issued, due, returned, fee
+
+
+def bill_rows(spec, rng, vip, prices):
+    """(bill row, [bill_items rows]) in bill_date order, priced the way create_bill prices them."""
+    books = Zipf(spec.books, spec.skew)
+    members = Zipf(spec.members, spec.skew)
+    bill_id = 0
+    for d, count in enumerate(_spread(spec.bills, day_weights(spec))):
+        day = datetime.datetime.combine(spec.start + datetime.timedelta(days=d), datetime.time(9))
+        for seconds in sorted(rng.randrange(11 * 3600) for _ in range(count)):
+            bill_id += 1
+            member_id, member_type = None, "Regular"
+            if rng.random() >= GUEST_BILLS:
+                m = members.pick(rng)
+                member_id, member_type = m + 1, MEMBERSHIP_TYPES[vip[m]]
+            items = {}
+            for _ in range(1 + min(int(rng.expovariate(1 / 1.5)), 9)):
+                b = books.pick(rng)
+                items[b] = 1 if rng.random() < 0.85 else rng.randint(2, 3)
+            rows = {book_id(b): (book_id(b), None, None, None, from_paise(prices[b]), None) for b in items}
+            receipt = price_bill(member_id, None, member_type, [(book_id(b), q) for b, q in items.items()],
+                                 rows, ZERO)
+            yield ((bill_id, member_id, day + datetime.timedelta(seconds=seconds), receipt.subtotal,
+                    receipt.discount_pct, receipt.discount_amt, receipt.grand_total),
+                   [(bill_id, line.book_id, line.qty, line.unit_price, line.line_total) for line in receipt.lines])
+
+# -------------------- LOAD --------------------
+
+INSERTS = {
+    "books": "INSERT INTO books (book_id, title, author, category, price, stock) VALUES (%s,%s,%s,%s,%s,%s)",
+    "staff": "INSERT INTO staff (staff_id, name, role, phone) VALUES (%s,%s,%s,%s)",
+    "members": "INSERT INTO members (member_id, name, phone, email, membership_type) VALUES (%s,%s,%s,%s,%s)",
+    "issues": "INSERT INTO issues (member_id, book_id, issue_date, due_date, return_date, late_fee) VALUES (%s,%s,%s,%s,%s,%s)",
+    "bills": "INSERT INTO bills (bill_id, member_id, bill_date, subtotal, discount_pct, discount_amt, grand_total) VALUES (%s,%s,%s,%s,%s,%s,%s)",
+    "bill_items": "INSERT INTO bill_items (bill_id, book_id, qty, unit_price, line_total) VALUES (%s,%s,%s,%s,%s)",
+}
+
+
+def _batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _load(con, cur, table, rows, progress):
+    done = 0
+    for batch in _batches(rows):
+        cur.executemany(INSERTS[table], batch)
+        con.commit()
+        done += len(batch)
+        if progress:
+            progress(table, done)
+    return done
+
+
+def _load_bills(con, cur, rows, progress):
+    done = lines = 0
+    for batch in _batches(rows):
+        items = [item for _, bill_items in batch for item in bill_items]
+        cur.executemany(INSERTS["bills"], [bill for bill, _ in batch])
+        cur.executemany(INSERTS["bill_items"], items)
+        con.commit()
+        done += len(batch)
+        lines += len(items)
+        if progress:
+            progress("bills", done)
+    return done, lines
+
+
+def generate(pool, spec, progress=None):
+    """
+    Write the library described by spec into the (migrated, empty) database
+    behind pool and rebuild the rollups. progress(table, rows_so_far) is
+    called after every batch. Returns {table: rows written}.
+    """
+    with pool.connection() as con:
+        cur = con.cursor()
+        for table in sorted(ALLOWED_TABLES):
+            cur.execute(f"SELECT COUNT(*) FROM {table}")
+            if cur.fetchone()[0]:
+                cur.close()
+                raise ValueError(f"Refusing to generate into a database that has {table}; use an empty one.")
+
+        rng = random.Random(spec.seed)
+        prices = array("I")
+        vip = bytearray(spec.members)
+        counts = {
+            "books": _load(con, cur, "books", book_rows(spec, rng, prices), progress),
+            "staff": _load(con, cur, "staff", staff_rows(rng), progress),
+            "members": _load(con, cur, "members", member_rows(spec, rng, vip), progress),
+            "issues": _load(con, cur, "issues", issue_rows(spec, rng, vip), progress),
+        }
+        counts["bills"], counts["bill_items"] = _load_bills(con, cur, bill_rows(spec, rng, vip, prices), progress)
+        cur.close()
+    rebuild(pool)
+    return counts
+
+# -------------------- CLI --------------------
+
+def main(argv=None):
+    from lms_db import get_pool
+    from lms_migrations import migrate
+
+    ap = argparse.ArgumentParser(description="Fill an empty library database with seeded synthetic data.")
+    ap.add_argument("--scale", default="10k", help="books: 1k, 10k, 100k, 1m, 10m or any count (default: 10k)")
+    ap.add_argument("--members", help="members (default: scale x %g)" % MEMBERS_PER_BOOK)
+    ap.add_argument("--issues", help="issues (default: scale x %g)" % ISSUES_PER_BOOK)
+    ap.add_argument("--bills", help="bills (default: scale x %g)" % BILLS_PER_BOOK)
+    ap.add_argument("--seed", type=int, default=DEFAULT_SEED, help=f"random seed (default: {DEFAULT_SEED})")
+    ap.add_argument("--skew", type=float, default=DEFAULT_SKEW, help=f"Zipf exponent, 0 = uniform (default: {DEFAULT_SKEW})")
+    ap.add_argument("--months", type=int, default=MONTHS, help=f"months of history up to {END_DATE} (default: {MONTHS})")
+    args = ap.parse_args(argv)
+
+    spec = Spec.at_scale(parse_count(args.scale),
+                         *(parse_count(v) if v else None for v in (args.members, args.issues, args.bills)),
+                         seed=args.seed, skew=args.skew, months=args.months)
+    pool = get_pool()
+    try:
+        migrate(pool)
+        counts = generate(pool, spec, lambda table, n: print(f"\r  {table}: {n:,}   ", end="", flush=True))
+        print("\rGenerated " + ", ".join(f"{n:,} {table}" for table, n in counts.items()) + ".")
+        return 0
+    except ValueError as e:
+        print(e)
+        return 1
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())